@@ -0,0 +1,333 @@
+# In this file, we decide which requests the API takes on when it is busier than it can handle.
+# Without this every request is accepted, so when one client floods the expensive list and search
+#  endpoints (say /api/movies?title=...), the worker threads all end up busy with those and every other
+#  client's requests wait behind them. Admission control keeps the cheap requests fast by turning some
+#  requests away early, with a response that tells the client when to try again:
+#   - Each class of route has its own limit on how many of its requests run at once in a worker: "point"
+#     lookups of one record, "list" requests that read many rows (lists, searches, analytics, exports) and
+#     "write" requests. A request over its limit waits in a short queue for a turn, and gets 503 Service
+#     Unavailable if the queue is full or it would have to wait longer than ADMISSION_MAX_QUEUE_TIME.
+#     A waiting request holds a worker thread too, so the list limit and queue are worked out from the
+#     worker's threads (see list_limits) to leave at least one thread free, and point lookups always have
+#     one to run on. A streamed response (say an export) keeps its turn until it has been sent.
+#   - Optionally, each client (by IP address) has a token bucket: it can make ADMISSION_RATE requests a
+#     second on average, in bursts of up to ADMISSION_BURST. Beyond that it gets 429 Too Many Requests.
+#     This is off unless ADMISSION_RATE is set, since behind a proxy every request comes from the proxy's
+#     address and all the clients would share one bucket, unless ADMISSION_TRUST_FORWARDED is set too.
+#   - How long requests wait in the queue is measured for each class (see AdmissionControl.stats, reported
+#     by GET /api/admission/status) and sent back in a Server-Timing header.
+# Streams and the status endpoints aren't limited. The limits are for each worker process.
+#
+# This works like the other Flask extensions we use (see api/compression.py). The settings can be changed
+#  in the app config:
+#   ADMISSION_ENABLED          - False turns admission control off (default True, or MOVIE_API_ADMISSION=0)
+#   ADMISSION_THREADS          - the threads in each worker (default GUNICORN_THREADS, as in gunicorn.conf.py, or 4)
+#   ADMISSION_RATE             - the average requests per second for each client, 0 for no limit
+#                                (default MOVIE_API_RATE_LIMIT, or 0)
+#   ADMISSION_BURST            - how many requests a client can make at once (default 100)
+#   ADMISSION_LIMITS           - the most requests of each route class running at once, e.g. {"list": 4}
+#                                (default DEFAULT_LIMITS, and list_limits for lists)
+#   ADMISSION_QUEUE_SIZES      - the most requests of each class waiting for a turn (default DEFAULT_QUEUE_SIZES,
+#                                and list_limits for lists)
+#   ADMISSION_MAX_QUEUE_TIME   - the most seconds a request waits for a turn (default 0.5)
+#   ADMISSION_ROUTE_CLASSES    - the class of each endpoint, added to DEFAULT_ROUTE_CLASSES (None for no limit)
+#   ADMISSION_TRUST_FORWARDED  - identify clients by X-Forwarded-For, behind a proxy you trust
+#                                (default MOVIE_API_TRUST_FORWARDED=1, or False)
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from flask import current_app, g, jsonify, request
+
+POINT, LIST, WRITE = "point", "list", "write"
+ROUTE_CLASSES = (POINT, LIST, WRITE)
+
+DEFAULT_LIMITS = {POINT: 16, WRITE: 4}
+DEFAULT_QUEUE_SIZES = {POINT: 64, WRITE: 16}
+
+# The class of each GET endpoint. Other GET endpoints count as lists, and other methods as writes.
+DEFAULT_ROUTE_CLASSES = {
+    "api.home": POINT,
+    "api.test_connection": POINT,
+    "api.lookup_user_by_id": POINT,
+    "api.lookup_ratings_for_user": POINT,
+    "api.lookup_stats_for_user": POINT,
+    "api.lookup_movie_by_id": POINT,
+    "api.lookup_ratings_for_movie": POINT,
+    "api.lookup_rating_by_id": POINT,
+    "api.lookup_pending_rating": POINT,
+    # The leaderboard is kept up to date as ratings are written, so reading it is cheap
+    "api.get_top_movies": POINT,
+    # Long lived, and they only wait for events
+    "api.stream_ratings": None,
+    # Must answer even (especially) when the API is overloaded
+    "api.get_cache_status": None,
+    "api.get_analytics_status": None,
+    "api.get_admission_status": None,
+    "api.get_cancelled_queries": None,
+}
+
+# How many clients' token buckets are kept, dropping the least recently seen
+MAX_CLIENTS = 10000
+
+# How many queue times are kept for each class, to work out percentiles from
+QUEUE_TIME_SAMPLES = 1000
+
+
+def list_limits(threads: int):
+    """
+    Work out how many list requests can run at once in a worker with this many threads, and how many can
+    wait for a turn. Together they leave at least one thread for the other requests (with a single
+    thread, one list request runs and none wait).
+    Returns:
+        tuple: The limit and the queue size.
+    """
+    limit = max(1, threads // 2)
+    return limit, max(0, threads - 1 - limit)
+
+
+class TokenBucket:
+    """
+    Allows rate requests a second on average, and up to burst at once.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """
+        Take a token if there is one.
+        Returns:
+            float: 0 if a token was taken, otherwise how many seconds until there will be one.
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class ClientRateLimiter:
+    """
+    A token bucket for each client, for the clients seen most recently.
+    """
+
+    def __init__(self, rate: float, burst: float, max_clients: int = MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def check(self, client: str) -> float:
+        """
+        Returns:
+            float: 0 if the client can make a request now, otherwise how many seconds it should wait.
+        """
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = self._buckets[client] = TokenBucket(self.rate, self.burst, now)
+                if len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(client)
+            wait = bucket.take(now)
+            if wait:
+                self.limited += 1
+            return wait
+
+
+class ConcurrencyLimiter:
+    """
+    Lets up to limit requests run at once, with up to queue_size more waiting for a turn.
+    """
+
+    def __init__(self, limit: int, queue_size: int):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+        self._queue_times = deque(maxlen=QUEUE_TIME_SAMPLES)
+        self._stats = {"admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0, "max_queue_time": 0.0}
+
+    def acquire(self, timeout: float):
+        """
+        Wait up to timeout seconds for a turn.
+        Returns:
+            float: How many seconds the request waited for its turn, or None if it didn't get one.
+        """
+        started = time.monotonic()
+        with self._condition:
+            if self.active >= self.limit:
+                if self.waiting >= self.queue_size:
+                    self._stats["rejected"] += 1
+                    return None
+                self.waiting += 1
+                self._stats["queued"] += 1
+                try:
+                    deadline = started + timeout
+                    while self.active >= self.limit:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._stats["timed_out"] += 1
+                            return None
+                        self._condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            queue_time = time.monotonic() - started
+            self._stats["admitted"] += 1
+            self._stats["max_queue_time"] = max(self._stats["max_queue_time"], queue_time)
+            self._queue_times.append(queue_time)
+            return queue_time
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def stats(self) -> dict:
+        with self._condition:
+            stats = dict(self._stats, limit=self.limit, queue_size=self.queue_size, active=self.active, waiting=self.waiting)
+            queue_times = sorted(self._queue_times)
+        stats["queue_time_p50"] = _percentile(queue_times, 0.5)
+        stats["queue_time_p99"] = _percentile(queue_times, 0.99)
+        return stats
+
+
+class AdmissionControl:
+    """
+    Rate limit each client and limit how many requests of each route class run at once.
+
+    Usage:
+        app = Flask(__name__)
+        AdmissionControl(app)
+    """
+
+    def __init__(self, app=None):
+        self.rate_limiter = None
+        self.limiters = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("ADMISSION_ENABLED", os.environ.get("MOVIE_API_ADMISSION", "1") == "1")
+        app.config.setdefault("ADMISSION_THREADS", int(os.environ.get("GUNICORN_THREADS", "4")))
+        app.config.setdefault("ADMISSION_RATE", float(os.environ.get("MOVIE_API_RATE_LIMIT", "0")))
+        app.config.setdefault("ADMISSION_BURST", 100)
+        app.config.setdefault("ADMISSION_LIMITS", {})
+        app.config.setdefault("ADMISSION_QUEUE_SIZES", {})
+        app.config.setdefault("ADMISSION_MAX_QUEUE_TIME", 0.5)
+        app.config.setdefault("ADMISSION_ROUTE_CLASSES", {})
+        app.config.setdefault("ADMISSION_TRUST_FORWARDED", os.environ.get("MOVIE_API_TRUST_FORWARDED", "0") == "1")
+        app.extensions["admission"] = self
+        self._config = app.config
+        self.reset()
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+
+    def reset(self):
+        """
+        Start again with no clients and no requests running, e.g. in a worker process that was forked from
+        a preloaded app.
+        """
+        config = self._config
+        list_limit, list_queue_size = list_limits(config["ADMISSION_THREADS"])
+        limits = {**DEFAULT_LIMITS, LIST: list_limit, **config["ADMISSION_LIMITS"]}
+        queue_sizes = {**DEFAULT_QUEUE_SIZES, LIST: list_queue_size, **config["ADMISSION_QUEUE_SIZES"]}
+        self.rate_limiter = ClientRateLimiter(config["ADMISSION_RATE"], config["ADMISSION_BURST"])
+        self.limiters = {
+            route_class: ConcurrencyLimiter(limits[route_class], queue_sizes[route_class])
+            for route_class in ROUTE_CLASSES
+        }
+
+    def route_class(self):
+        """
+        Returns:
+            str: The class of the current request's route, or None if it isn't limited.
+        """
+        if request.method == "OPTIONS" or request.endpoint is None or not request.endpoint.startswith("api."):
+            return None
+        classes = {**DEFAULT_ROUTE_CLASSES, **current_app.config["ADMISSION_ROUTE_CLASSES"]}
+        if request.endpoint in classes:
+            return classes[request.endpoint]
+        return LIST if request.method in ("GET", "HEAD") else WRITE
+
+    def client_id(self) -> str:
+        if current_app.config["ADMISSION_TRUST_FORWARDED"] and request.access_route:
+            return request.access_route[0]
+        return request.remote_addr or "unknown"
+
+    def before_request(self):
+        if not current_app.config["ADMISSION_ENABLED"]:
+            return None
+        route_class = self.route_class()
+        if route_class is None:
+            return None
+
+        wait = self.rate_limiter.check(self.client_id())
+        if wait:
+            return too_busy(429, "Too many requests, slow down", wait)
+
+        limiter = self.limiters[route_class]
+        queue_time = limiter.acquire(current_app.config["ADMISSION_MAX_QUEUE_TIME"])
+        if queue_time is None:
+            return too_busy(503, "The server is too busy, try again shortly", 1)
+        g.admission_limiter = limiter
+        g.admission_queue_time = queue_time
+        return None
+
+    def after_request(self, response):
+        queue_time = g.get("admission_queue_time")
+        if queue_time is not None:
+            response.headers.add("Server-Timing", f"queue;dur={queue_time * 1000:.1f}")
+        if response.is_streamed:
+            # The body is sent after the request has been torn down, so keep the turn until it has been
+            limiter = g.pop("admission_limiter", None)
+            if limiter is not None:
+                response.call_on_close(limiter.release)
+        return response
+
+    def teardown_request(self, error=None):
+        limiter = g.pop("admission_limiter", None)
+        if limiter is not None:
+            limiter.release()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: How many requests were rate limited, and for each route class how many requests are running
+            and waiting, how many were admitted, queued and turned away, and their queue times in seconds.
+        """
+        return {
+            "enabled": self._config["ADMISSION_ENABLED"],
+            "rate_limited": self.rate_limiter.limited,
+            "classes": {route_class: limiter.stats() for route_class, limiter in self.limiters.items()},
+        }
+
+
+def too_busy(status: int, message: str, retry_after: float):
+    response = jsonify({'message': message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def _percentile(values: list, fraction: float):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
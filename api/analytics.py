@@ -0,0 +1,442 @@
+# In this file, we answer aggregate questions about the ratings (GET /api/analytics/...) from NumPy arrays
+#  held in memory instead of from SQL.
+# Working out something like the average rating of every genre used to mean reading every rating row from
+#  SQLite and adding them up in Python one at a time. Here each column of the ratings table is kept as one
+#  compact NumPy array (17 bytes per rating, plus the sort orders below), and a group-by is a single
+#  vectorized call such as np.bincount, which is orders of magnitude faster than iterating rows.
+#   - Ratings are kept in half points (RATING_SCALE), so that a rating of 4.5 still fits in an int8.
+#   - Dates are kept as the number of days since 1970-01-01 (NO_DATE if a rating has none).
+#   - by_movie and by_user are the row numbers sorted by movie and by user, and movie_indptr / user_indptr
+#     say where each ID's rows start in them (the CSR layout of a sparse matrix), so all of one movie's (or
+#     one user's) ratings can be found without a scan.
+# The arrays are a snapshot, refreshed at most every REFRESH_INTERVAL seconds using the change log. If the
+#  only changes since the snapshot are new ratings, just those rows are read and appended. Anything else
+#  (a rating updated or deleted, the data reloaded) reloads the whole table, and a change to a movie reloads
+#  the (much smaller) movie columns. Each refresh builds new arrays and swaps them in, so a query never sees
+#  a half-updated snapshot and queries don't need to take a lock.
+# With MOVIE_API_ANALYTICS_SNAPSHOTS=1 the workers don't keep arrays of their own at all. They memory-map
+#  the arrays from a snapshot on disk instead (see snapshot.py), so however many workers there are, the
+#  operating system holds one copy of the arrays in its page cache and shares it between them.
+import os
+import threading
+import time
+import numpy as np
+from api import services
+
+# How many seconds old the arrays can be before a query checks the change log for new ratings
+REFRESH_INTERVAL = float(os.environ.get("MOVIE_API_ANALYTICS_REFRESH", "0.5"))
+# Ratings are stored multiplied by this, so half points can be stored as whole numbers
+RATING_SCALE = 2
+# The date stored for ratings that don't have one
+NO_DATE = np.iinfo(np.int32).min
+# How many rows are read from SQLite at a time while loading
+LOAD_BATCH_SIZE = 10000
+# The most rows any analytics query returns
+MAX_RESULTS = 1000
+# Read the arrays from the shared snapshot files instead of keeping a copy in each worker
+USE_SNAPSHOTS = os.environ.get("MOVIE_API_ANALYTICS_SNAPSHOTS", "0") == "1"
+# How many seconds old a snapshot can be before a worker that notices builds a new one (if anything changed)
+SNAPSHOT_MAX_AGE = float(os.environ.get("MOVIE_API_SNAPSHOT_MAX_AGE", "60"))
+
+# The days since 1970-01-01 of a rating's date, worked out by SQLite while the rows are read
+RATING_DAYS_SQL = f"COALESCE(CAST(julianday(date) - 2440587.5 AS INTEGER), {NO_DATE})"
+
+
+class MovieColumns:
+    """
+    The movie details the analytics group ratings by, indexed by movie_id.
+    """
+
+    def __init__(self, year_by_id, titles: dict, genre_names: list, genre_index, genre_movie_id):
+        # Looking up a movie's release year is a plain array index
+        self.year_by_id = year_by_id
+        self.titles = titles
+        # The movie_genres junction table as two arrays, genre_index points into genre_names
+        self.genre_names = genre_names
+        self.genre_index = genre_index
+        self.genre_movie_id = genre_movie_id
+
+    @property
+    def nbytes(self) -> int:
+        return self.year_by_id.nbytes + self.genre_index.nbytes + self.genre_movie_id.nbytes
+
+
+class RatingColumns:
+    """
+    A snapshot of the ratings table as NumPy arrays, one per column, along with its movie columns.
+    """
+
+    # The arrays that are worked out from the columns, unless they are given (e.g. read from a snapshot)
+    INDEX_ARRAYS = ("by_movie", "by_user", "movie_indptr", "user_indptr")
+
+    def __init__(self, rating_id, user_id, movie_id, rating, days, movies: MovieColumns, change_seq: int,
+                 by_movie=None, by_user=None, movie_indptr=None, user_indptr=None):
+        self.rating_id = rating_id
+        self.user_id = user_id
+        self.movie_id = movie_id
+        self.rating = rating
+        self.days = days
+        self.movies = movies
+        # The last change in the change log that the snapshot includes
+        self.change_seq = change_seq
+        # A stable sort keeps each movie's (or user's) ratings in the order they were added
+        self.by_movie = np.argsort(movie_id, kind="stable") if by_movie is None else by_movie
+        self.by_user = np.argsort(user_id, kind="stable") if by_user is None else by_user
+        # The rows of movie m are by_movie[movie_indptr[m]:movie_indptr[m + 1]], and the same for users
+        self.movie_indptr = _index_pointers(movie_id) if movie_indptr is None else movie_indptr
+        self.user_indptr = _index_pointers(user_id) if user_indptr is None else user_indptr
+
+    def __len__(self):
+        return len(self.rating_id)
+
+    @property
+    def max_rating_id(self) -> int:
+        return int(self.rating_id[-1]) if len(self.rating_id) else 0
+
+    @property
+    def nbytes(self) -> int:
+        arrays = (self.rating_id, self.user_id, self.movie_id, self.rating, self.days,
+                  self.by_movie, self.by_user, self.movie_indptr, self.user_indptr)
+        return sum(array.nbytes for array in arrays) + self.movies.nbytes
+
+    def append(self, new_columns: tuple, movies: MovieColumns, change_seq: int) -> "RatingColumns":
+        """
+        Returns:
+            RatingColumns: A new snapshot with the new rows added at the end.
+        """
+        old_columns = (self.rating_id, self.user_id, self.movie_id, self.rating, self.days)
+        columns = [np.concatenate((old, new)) for old, new in zip(old_columns, new_columns)]
+        return RatingColumns(*columns, movies=movies, change_seq=change_seq)
+
+    def movie_rows(self, movie_id: int) -> np.ndarray:
+        if movie_id < 0 or movie_id + 1 >= len(self.movie_indptr):
+            return self.by_movie[:0]
+        return self.by_movie[self.movie_indptr[movie_id]:self.movie_indptr[movie_id + 1]]
+
+    def user_rows(self, user_id: int) -> np.ndarray:
+        if user_id < 0 or user_id + 1 >= len(self.user_indptr):
+            return self.by_user[:0]
+        return self.by_user[self.user_indptr[user_id]:self.user_indptr[user_id + 1]]
+
+    def rows_of_users(self, user_ids: np.ndarray) -> np.ndarray:
+        """
+        Find the rows of every rating by any of the given (unique) users, who must all have ratings.
+        """
+        starts = self.user_indptr[user_ids]
+        lengths = self.user_indptr[user_ids + 1] - starts
+        # Joins the ranges start..start+length of each user together without a Python loop
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return self.by_user[offsets]
+
+    def movie_totals(self):
+        """
+        Returns:
+            tuple of np.ndarray: The number of ratings and the sum of the ratings of every movie, indexed by movie_id.
+        """
+        size = max(len(self.movies.year_by_id), int(self.movie_id.max()) + 1 if len(self) else 0)
+        counts = np.bincount(self.movie_id, minlength=size)
+        sums = np.bincount(self.movie_id, weights=self.rating, minlength=size) / RATING_SCALE
+        return counts, sums
+
+
+def _index_pointers(ids: np.ndarray) -> np.ndarray:
+    # Where each ID's rows start in the rows sorted by that ID, with one extra entry for where the last ends
+    return np.concatenate(([0], np.cumsum(np.bincount(ids)))).astype(np.int64)
+
+
+def read_ratings(conn, after_rating_id: int = 0) -> tuple:
+    """
+    Read the ratings added after a rating ID into column arrays.
+    Returns:
+        tuple of np.ndarray: The rating_id, user_id, movie_id, rating (in half points) and date (in days) columns.
+    """
+    cursor = conn.execute(
+        f"""
+        SELECT rating_id, COALESCE(user_id, 0), COALESCE(movie_id, 0),
+               CAST(ROUND(COALESCE(rating, 0) * {RATING_SCALE}) AS INTEGER), {RATING_DAYS_SQL}
+        FROM ratings WHERE rating_id > ? ORDER BY rating_id
+        """,
+        (after_rating_id,),
+    )
+    dtypes = (np.int32, np.int32, np.int32, np.int8, np.int32)
+    batches = []
+    while True:
+        rows = cursor.fetchmany(LOAD_BATCH_SIZE)
+        if not rows:
+            break
+        batches.append([np.array(column, dtype=dtype) for column, dtype in zip(zip(*rows), dtypes)])
+    if not batches:
+        return tuple(np.empty(0, dtype=dtype) for dtype in dtypes)
+    return tuple(np.concatenate(column) for column in zip(*batches))
+
+
+def read_movies(conn) -> MovieColumns:
+    rows = conn.execute("SELECT movie_id, title, COALESCE(CAST(release_year AS INTEGER), 0) FROM movies").fetchall()
+    genre_rows = conn.execute(
+        "SELECT g.name, mg.movie_id FROM movie_genres mg JOIN genres g ON g.genre_id = mg.genre_id ORDER BY g.name"
+    ).fetchall()
+    genre_names = sorted({row[0] for row in genre_rows})
+    genre_positions = {name: index for index, name in enumerate(genre_names)}
+    year_by_id = np.zeros(max((row[0] for row in rows), default=0) + 1, dtype=np.int32)
+    for movie_id, _, release_year in rows:
+        year_by_id[movie_id] = release_year
+    return MovieColumns(
+        year_by_id=year_by_id,
+        titles={row[0]: row[1] for row in rows},
+        genre_names=genre_names,
+        genre_index=np.array([genre_positions[row[0]] for row in genre_rows], dtype=np.int32),
+        genre_movie_id=np.array([row[1] for row in genre_rows], dtype=np.int32),
+    )
+
+
+def format_rating(half_points: int):
+    rating = half_points / RATING_SCALE
+    return int(rating) if rating.is_integer() else rating
+
+
+class AnalyticsEngine:
+    """
+    Keeps the ratings snapshot up to date and runs the analytics queries on it.
+    """
+
+    def __init__(self, refresh_interval: float = REFRESH_INTERVAL, snapshots=None):
+        self.refresh_interval = refresh_interval
+        # The snapshot.SnapshotReader to read the arrays from, None to keep them in this process
+        self.snapshots = snapshots
+        self.columns = None
+        self.loads = 0
+        self.appends = 0
+        self.last_refresh_seconds = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def get_columns(self) -> RatingColumns:
+        """
+        Get the current snapshot, first bringing it up to date if it hasn't been checked for a while.
+        """
+        checked_at = self._checked_at
+        if checked_at is None or time.monotonic() - checked_at >= self.refresh_interval:
+            with self._lock:
+                # Another thread may have refreshed it while we waited for the lock
+                if self._checked_at == checked_at:
+                    self.refresh()
+        return self.columns
+
+    def refresh(self) -> str:
+        """
+        Bring the snapshot up to date with the database.
+        Returns:
+            str: "loaded" if everything was read again, "appended" if only new ratings were read,
+            or "unchanged".
+        """
+        started = time.perf_counter()
+        if self.snapshots is not None:
+            result = self._refresh_from_snapshot()
+            self._checked_at = time.monotonic()
+            self.last_refresh_seconds = time.perf_counter() - started
+            return result
+        result = "unchanged"
+        conn = services.get_read_connection(use_replica=False)
+        try:
+            # One read transaction, so the change sequence number and the rows agree with each other
+            conn.execute("BEGIN")
+            latest_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+            columns = self.columns
+            if columns is None or latest_seq != columns.change_seq:
+                changes = set() if columns is None else {
+                    (row[0], row[1]) for row in conn.execute(
+                        "SELECT DISTINCT entity, op FROM change_log WHERE seq > ? AND seq <= ?",
+                        (columns.change_seq, latest_seq),
+                    )
+                }
+                if columns is None or any(entity == "*" or (entity == "rating" and op != "create")
+                                          for entity, op in changes):
+                    self.columns = RatingColumns(*read_ratings(conn), movies=read_movies(conn), change_seq=latest_seq)
+                    self.loads += 1
+                    result = "loaded"
+                else:
+                    movies = read_movies(conn) if any(entity == "movie" for entity, _ in changes) else columns.movies
+                    # Rating IDs only go up, so the new ratings are the ones after the last one we have
+                    new_columns = read_ratings(conn, columns.max_rating_id)
+                    self.columns = columns.append(new_columns, movies, latest_seq)
+                    self.appends += 1
+                    result = "appended"
+        finally:
+            conn.close()
+        self._checked_at = time.monotonic()
+        self.last_refresh_seconds = time.perf_counter() - started
+        return result
+
+    def _refresh_from_snapshot(self) -> str:
+        from api import snapshot  # snapshot.py builds on this module, so it can't be imported at the top
+        columns = self.snapshots.load()
+        if columns is None:
+            # Nothing has been published yet, wait for whichever worker gets to build the first one
+            snapshot.build_snapshot(self.snapshots.directory, wait=True)
+            columns = self.snapshots.load()
+        elif (time.time() - self.snapshots.created_at >= SNAPSHOT_MAX_AGE
+              and services.get_latest_change_seq() != columns.change_seq):
+            # If another worker is already building a newer one we carry on with this one in the meantime
+            if snapshot.build_snapshot(self.snapshots.directory, wait=False) is not None:
+                columns = self.snapshots.load()
+        result = "unchanged" if columns is self.columns else "loaded"
+        if result == "loaded":
+            self.columns = columns
+            self.loads += 1
+        return result
+
+    def movie_averages(self, min_ratings: int = 1, limit: int = 100) -> list:
+        """
+        The number of ratings and the average rating of each movie, highest average first.
+        """
+        _check_limit(limit)
+        columns = self.get_columns()
+        counts, sums = columns.movie_totals()
+        movie_ids = np.flatnonzero(counts >= max(min_ratings, 1))
+        averages = sums[movie_ids] / counts[movie_ids]
+        # Highest average first, then the most ratings, then the lowest ID
+        order = np.lexsort((movie_ids, -counts[movie_ids], -averages))[:limit]
+        return [
+            {
+                'movie_id': int(movie_id),
+                'title': columns.movies.titles.get(int(movie_id)),
+                'rating_count': int(counts[movie_id]),
+                'average_rating': round(float(average), 4),
+            }
+            for movie_id, average in zip(movie_ids[order], averages[order])
+        ]
+
+    def genre_averages(self) -> list:
+        """
+        The number of ratings and the average rating of the movies in each genre, highest average first.
+        A movie with several genres counts towards each of them.
+        """
+        columns = self.get_columns()
+        movies = columns.movies
+        counts, sums = columns.movie_totals()
+        known = movies.genre_movie_id < len(counts)
+        genre_index = movies.genre_index[known]
+        genre_movie_id = movies.genre_movie_id[known]
+        genre_counts = np.bincount(genre_index, weights=counts[genre_movie_id], minlength=len(movies.genre_names))
+        genre_sums = np.bincount(genre_index, weights=sums[genre_movie_id], minlength=len(movies.genre_names))
+        rated = np.flatnonzero(genre_counts)
+        averages = genre_sums[rated] / genre_counts[rated]
+        order = np.lexsort((rated, -averages))
+        return [
+            {
+                'genre': movies.genre_names[index],
+                'rating_count': int(genre_counts[index]),
+                'average_rating': round(float(average), 4),
+            }
+            for index, average in zip(rated[order], averages[order])
+        ]
+
+    def year_averages(self) -> list:
+        """
+        The number of ratings and the average rating of the movies released in each year, oldest year first.
+        """
+        columns = self.get_columns()
+        counts, sums = columns.movie_totals()
+        year_by_id = np.zeros(len(counts), dtype=np.int32)
+        year_by_id[:len(columns.movies.year_by_id)] = columns.movies.year_by_id
+        # Movies without a release year (or that have been deleted) are left out
+        movie_ids = np.flatnonzero((counts > 0) & (year_by_id > 0))
+        years, year_index = np.unique(year_by_id[movie_ids], return_inverse=True)
+        year_counts = np.bincount(year_index, weights=counts[movie_ids], minlength=len(years))
+        year_sums = np.bincount(year_index, weights=sums[movie_ids], minlength=len(years))
+        return [
+            {
+                'release_year': int(year),
+                'rating_count': int(count),
+                'average_rating': round(float(total / count), 4),
+            }
+            for year, count, total in zip(years, year_counts, year_sums)
+        ]
+
+    def distribution(self, movie_id: int = None, user_id: int = None) -> dict:
+        """
+        How many times each rating was given, optionally only to one movie and/or by one user.
+        Returns:
+            dict: The number of ratings, keyed by the rating (as a string, e.g. "4" or "4.5").
+        """
+        columns = self.get_columns()
+        if movie_id is not None:
+            rows = columns.movie_rows(movie_id)
+            if user_id is not None:
+                rows = rows[columns.user_id[rows] == user_id]
+        elif user_id is not None:
+            rows = columns.user_rows(user_id)
+        else:
+            rows = slice(None)
+        ratings, counts = np.unique(columns.rating[rows], return_counts=True)
+        return {str(format_rating(int(rating))): int(count) for rating, count in zip(ratings, counts)}
+
+    def co_ratings(self, movie_id: int, limit: int = 10) -> dict:
+        """
+        Find the movies rated most often by the users who rated a given movie ("people who rated this also rated").
+        Returns:
+            dict: The number of users who rated the movie, and the other movies with how many of those
+            users rated each one, most first.
+        """
+        _check_limit(limit)
+        columns = self.get_columns()
+        raters = np.unique(columns.user_id[columns.movie_rows(movie_id)])
+        rows = columns.rows_of_users(raters)
+        other_movies = columns.movie_id[rows]
+        other = other_movies != movie_id
+        # A user who rated the same movie twice still only counts once
+        pairs = np.unique((other_movies[other].astype(np.int64) << 32) | columns.user_id[rows][other].astype(np.int64))
+        counts = np.bincount((pairs >> 32).astype(np.int64))
+        movie_ids = np.flatnonzero(counts)
+        order = np.lexsort((movie_ids, -counts[movie_ids]))[:limit]
+        return {
+            'movie_id': movie_id,
+            'rater_count': int(len(raters)),
+            'co_rated': [
+                {
+                    'movie_id': int(other_id),
+                    'title': columns.movies.titles.get(int(other_id)),
+                    'co_rating_count': int(counts[other_id]),
+                }
+                for other_id in movie_ids[order]
+            ],
+        }
+
+    def stats(self) -> dict:
+        columns = self.columns
+        return {
+            'ratings': len(columns) if columns is not None else 0,
+            'memory_bytes': columns.nbytes if columns is not None else 0,
+            'change_seq': columns.change_seq if columns is not None else None,
+            'snapshot_version': self.snapshots.version if self.snapshots is not None else None,
+            'loads': self.loads,
+            'appends': self.appends,
+            'last_refresh_seconds': round(self.last_refresh_seconds, 6) if self.last_refresh_seconds is not None else None,
+        }
+
+
+def _check_limit(limit: int):
+    if limit < 1 or limit > MAX_RESULTS:
+        raise ValueError(f"The limit must be between 1 and {MAX_RESULTS}")
+
+
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> AnalyticsEngine:
+    """
+    Get this process's analytics engine, creating it if needed.
+    Each worker process keeps its own copy of the arrays, unless they are shared through snapshots (USE_SNAPSHOTS).
+    """
+    global _engine, _engine_pid
+    with _engine_lock:
+        if _engine is None or _engine_pid != os.getpid():
+            snapshots = None
+            if USE_SNAPSHOTS:
+                from api.snapshot import SnapshotReader
+                snapshots = SnapshotReader()
+            _engine = AnalyticsEngine(snapshots=snapshots)
+            _engine_pid = os.getpid()
+        return _engine
@@ -0,0 +1,92 @@
+# In this file, we serve the Swagger UI (http://localhost:5000/apidocs) without slowing down start up.
+# Setting up flasgger means importing it (and everything it depends on) and parsing docs/openapi.yaml with
+#  PyYAML, which together take longer than creating the rest of the app. Every worker process used to pay
+#  for that when it started, even though hardly any requests are for the docs.
+# Instead, the docs are served by a small Flask app of their own, which is only created the first time one
+#  of the docs URLs is requested. Until then the only cost is checking the start of each request's path.
+# The parsed spec is also kept as JSON in docs/__pycache__, which is much quicker to read than the YAML,
+#  and is parsed again whenever openapi.yaml changes.
+import json
+import os
+import threading
+from pathlib import Path
+
+# The URLs that flasgger serves: the UI page, the spec it loads and the UI's static files
+DOCS_PATH_PREFIXES = ("/apidocs", "/apispec", "/flasgger_static")
+
+
+def load_openapi_spec(spec_file: Path) -> dict:
+    """
+    Load an OpenAPI spec from a YAML file, using the cached JSON copy if it is up to date.
+    Args:
+        spec_file (Path): The YAML file, e.g. docs/openapi.yaml.
+    Returns:
+        dict: The parsed spec.
+    """
+    spec_file = Path(spec_file)
+    cache_file = spec_file.parent / "__pycache__" / f"{spec_file.stem}.json"
+    source = spec_file.stat()
+    source_version = [source.st_mtime_ns, source.st_size]
+    try:
+        with open(cache_file, "r") as file:
+            cached = json.load(file)
+        if cached["source_version"] == source_version:
+            return cached["spec"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    import yaml  # Only needed when the cache is missing or out of date
+    with open(spec_file, "r") as file:
+        spec = yaml.safe_load(file)
+    try:
+        cache_file.parent.mkdir(exist_ok=True)
+        temporary_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        with open(temporary_file, "w") as file:
+            json.dump({"source_version": source_version, "spec": spec}, file, default=str)
+        os.replace(temporary_file, cache_file)
+    except OSError:
+        # Not being able to write the cache only means the YAML is parsed again next time
+        pass
+    return spec
+
+
+class LazySwagger:
+    """
+    Serve the Swagger UI for an app, setting it up the first time it is requested.
+
+    Usage:
+        app = Flask(__name__)
+        LazySwagger(app, Path("docs/openapi.yaml"))
+    """
+
+    def __init__(self, app, spec_file: Path):
+        self.spec_file = Path(spec_file)
+        self.docs_app = None
+        self._lock = threading.Lock()
+        self._app_wsgi = app.wsgi_app
+        app.wsgi_app = self
+        app.extensions["lazy_swagger"] = self
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO", "").startswith(DOCS_PATH_PREFIXES):
+            return self.get_docs_app()(environ, start_response)
+        return self._app_wsgi(environ, start_response)
+
+    def get_docs_app(self):
+        if self.docs_app is None:
+            with self._lock:
+                if self.docs_app is None:
+                    self.docs_app = create_docs_app(load_openapi_spec(self.spec_file))
+        return self.docs_app
+
+
+def create_docs_app(openapi_spec: dict):
+    """
+    Create the Flask app that serves the Swagger UI for the given spec.
+    """
+    from flask import Flask
+    from flasgger import Swagger
+
+    docs_app = Flask(__name__)
+    Swagger(docs_app, template=openapi_spec)
+    return docs_app
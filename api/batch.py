@@ -0,0 +1,118 @@
+# In this file, we run a list of writes as one unit of work (POST /api/batch).
+# An ingest client that adds a movie and its 50 ratings one request at a time makes 51 round trips and 51
+#  commits, and if it stops part way through the database is left with half of its data. A batch sends all
+#  of the operations in one request and runs them in one services.transaction(): they are all committed
+#  together with a single commit, or if any of them fails none of them are.
+#
+# A batch is a JSON object with a list of operations, run in order:
+#   {"operations": [
+#       {"op": "create", "entity": "movie", "data": {"title": "...", "genre": "...", "release_year": 2024, "director": "..."}},
+#       {"op": "create", "entity": "rating", "data": {"user_id": 7, "movie_id": "$0", "rating": 5, "review": "", "date": "2024-05-01"}},
+#       {"op": "update", "entity": "user", "id": 7, "data": {"username": "...", "email": "..."}},
+#       {"op": "delete", "entity": "rating", "id": 12}
+#   ]}
+# A value of "$N" stands for the ID of the record created by operation N, so later operations can refer to
+#  records that don't have an ID until the batch runs (above, the new rating is for the new movie).
+from api import services
+from api.models import User, Movie, Rating, create_user_from_dict
+
+# The most operations one batch can have, so one request can't hold the write lock for too long
+MAX_OPERATIONS = 1000
+
+BATCH_OPS = ("create", "update", "delete")
+BATCH_ENTITIES = ("user", "movie", "rating")
+
+
+class BatchError(ValueError):
+    """
+    Raised when an operation in a batch is invalid or fails, after the whole batch has been rolled back.
+    """
+
+    def __init__(self, message: str, index: int = None):
+        super().__init__(message)
+        self.index = index
+
+    def to_dict(self):
+        return {'message': str(self), 'index': self.index}
+
+
+def run_batch(operations) -> list:
+    """
+    Run a list of operations in one transaction.
+    Args:
+        operations (list): The operations, each a dict with "op", "entity" and "data" and/or "id".
+    Returns:
+        list: One result per operation, with its op, entity and the ID of the record it affected.
+    Raises:
+        BatchError: If an operation is invalid or fails. Nothing in the batch is saved.
+        services.DatabaseBusyError: If the write lock couldn't be taken.
+    """
+    if not isinstance(operations, list) or not operations:
+        raise BatchError("operations must be a list with at least one operation")
+    if len(operations) > MAX_OPERATIONS:
+        raise BatchError(f"A batch can have at most {MAX_OPERATIONS} operations")
+
+    results = []
+    with services.transaction():
+        for index, operation in enumerate(operations):
+            try:
+                results.append(run_operation(operation, results))
+            except KeyError as error:
+                raise BatchError(f"Operation {index} is missing {error.args[0]}", index) from error
+            except (TypeError, ValueError) as error:
+                raise BatchError(f"Operation {index} failed: {error}", index) from error
+    return results
+
+
+def run_operation(operation: dict, results: list) -> dict:
+    """
+    Run one operation of a batch.
+    Args:
+        operation (dict): The operation.
+        results (list): The results of the operations before it, for resolving "$N" references.
+    Returns:
+        dict: The operation's result.
+    """
+    if not isinstance(operation, dict):
+        raise ValueError("an operation must be an object")
+    op, entity = operation.get("op"), operation.get("entity")
+    if op not in BATCH_OPS:
+        raise ValueError(f"op must be one of: {', '.join(BATCH_OPS)}")
+    if entity not in BATCH_ENTITIES:
+        raise ValueError(f"entity must be one of: {', '.join(BATCH_ENTITIES)}")
+    data = operation.get("data") or {}
+    if not isinstance(data, dict):
+        raise ValueError("data must be an object")
+    data = {name: resolve_reference(value, results) for name, value in data.items()}
+    record_id = resolve_reference(operation["id"], results) if op != "create" else None
+
+    if op == "create":
+        if entity == "user":
+            record_id = services.create_user(create_user_from_dict(data))
+        elif entity == "movie":
+            record_id = services.create_movie(Movie.from_dict(data))
+        else:
+            record_id = services.create_rating(Rating.from_dict(data))
+    elif op == "update":
+        if entity == "user":
+            services.update_user(User(record_id, data["username"], data["email"]))
+        elif entity == "movie":
+            services.update_movie(Movie.from_dict({**data, "movie_id": record_id}))
+        else:
+            services.update_rating(Rating.from_dict({**data, "rating_id": record_id}))
+    else:
+        delete = {"user": services.delete_user, "movie": services.delete_movie, "rating": services.delete_rating}
+        delete[entity](record_id)
+    return {"op": op, "entity": entity, "id": record_id}
+
+
+def resolve_reference(value, results: list):
+    """
+    Replace a "$N" reference with the ID created by operation N, leaving any other value as it is.
+    """
+    if not (isinstance(value, str) and value.startswith("$") and value[1:].isdigit()):
+        return value
+    index = int(value[1:])
+    if index >= len(results) or results[index]["op"] != "create":
+        raise ValueError(f"{value} doesn't refer to an earlier create operation")
+    return results[index]["id"]
@@ -0,0 +1,203 @@
+# In this file, we compress responses before they are sent to the client.
+# Large JSON responses like /api/movies shrink to a fraction of their size with gzip, which saves bandwidth
+#  and makes the API faster for clients on slow connections.
+# This works like the other Flask extensions we use (e.g. CORS): create it with the app and it registers an
+#  after_request hook that compresses any response the client said it can accept.
+#
+# The settings can be changed in the app config:
+#   COMPRESS_MIN_SIZE   - responses smaller than this many bytes are sent as they are (default 500)
+#   COMPRESS_LEVEL      - the zlib compression level from 1 (fastest) to 9 (smallest) (default 6)
+#   COMPRESS_CACHE_SIZE - how many bytes of compressed bodies to keep for reuse (default 8 MB, 0 turns it off)
+#   COMPRESS_MIMETYPES  - the content types that are worth compressing
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+from flask import current_app, request
+
+DEFAULT_MIMETYPES = (
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/csv",
+    "text/event-stream",
+)
+
+# The wbits value that makes zlib write each format
+ENCODING_WBITS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+
+class CompressedBodyCache:
+    """
+    A least recently used cache of compressed response bodies, limited by the total number of bytes it holds.
+    Bodies are keyed by a hash of the uncompressed body, so the same payload is only compressed once no
+    matter which request produced it.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'<CompressedBodyCache {len(self._entries)} entries, {self.current_bytes} bytes>'
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = body
+            self.current_bytes += len(body)
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else None,
+            }
+
+
+class Compress:
+    """
+    Compress responses with gzip or deflate, whichever the client prefers.
+
+    Usage:
+        app = Flask(__name__)
+        Compress(app)
+    """
+
+    def __init__(self, app=None):
+        self.cache = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("COMPRESS_MIN_SIZE", 500)
+        app.config.setdefault("COMPRESS_LEVEL", 6)
+        app.config.setdefault("COMPRESS_CACHE_SIZE", 8 * 1024 * 1024)
+        app.config.setdefault("COMPRESS_MIMETYPES", DEFAULT_MIMETYPES)
+        self.cache = CompressedBodyCache(app.config["COMPRESS_CACHE_SIZE"])
+        app.extensions["compress"] = self
+        app.after_request(self.after_request)
+
+    def reset(self):
+        """
+        Start again with an empty cache, e.g. in a worker process that was forked from a preloaded app.
+        """
+        if self.cache is not None:
+            self.cache = CompressedBodyCache(self.cache.max_bytes)
+
+    def after_request(self, response):
+        config = current_app.config
+
+        # Whatever we decide, the response depends on the Accept-Encoding header, so caches must know that
+        response.vary.add("Accept-Encoding")
+        if (
+            response.status_code < 200
+            or response.status_code in (204, 206, 304)
+            or response.direct_passthrough
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in config["COMPRESS_MIMETYPES"]
+        ):
+            return response
+
+        encoding = request.accept_encodings.best_match(list(ENCODING_WBITS))
+        if encoding is None:
+            return response
+
+        level = config["COMPRESS_LEVEL"]
+        if response.is_streamed:
+            # We don't know how big a streamed response will be, so it is always compressed as it goes
+            response.response = compress_stream(response.response, encoding, level)
+            response.headers.pop("Content-Length", None)
+        else:
+            body = response.get_data()
+            if len(body) < config["COMPRESS_MIN_SIZE"]:
+                return response
+            response.set_data(self.compress_body(body, encoding, level, is_cacheable(response)))
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+    def compress_body(self, body: bytes, encoding: str, level: int, cacheable: bool = True) -> bytes:
+        """
+        Compress a whole response body, reusing an earlier result if the same body has been compressed before.
+        """
+        if not cacheable or self.cache is None or self.cache.max_bytes <= 0:
+            return compress_bytes(body, encoding, level)
+        # Hashing the body is much cheaper than compressing it again
+        key = (encoding, level, hashlib.sha1(body).digest())
+        compressed = self.cache.get(key)
+        if compressed is None:
+            compressed = compress_bytes(body, encoding, level)
+            self.cache.put(key, compressed)
+        return compressed
+
+
+def is_cacheable(response) -> bool:
+    """
+    Decide whether a compressed body is worth keeping for reuse.  Only successful GET responses are kept,
+    and never ones the server has said shouldn't be stored.
+    """
+    if request.method != "GET" or response.status_code != 200:
+        return False
+    cache_control = response.cache_control
+    return not (cache_control.no_store or cache_control.private)
+
+
+def compress_bytes(body: bytes, encoding: str, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, ENCODING_WBITS[encoding])
+    return compressor.compress(body) + compressor.flush()
+
+
+def compress_stream(chunks, encoding: str, level: int):
+    """
+    Compress a streamed response one chunk at a time.
+    Each chunk is flushed as soon as it is compressed, so the client still receives data as it is produced
+    (which matters for things like event streams) rather than when the compressor's buffer fills up.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, ENCODING_WBITS[encoding])
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        # Let the original generator clean up if the client goes away part way through
+        if hasattr(chunks, "close"):
+            chunks.close()
@@ -0,0 +1,181 @@
+# In this file, we export whole tables as newline-delimited JSON or CSV (GET /api/export/<table> and
+#  utility/export_data.py).
+# The list endpoints build their whole response in memory, which doesn't work for the full dataset. An
+#  export instead reads the table through one cursor, FETCH_SIZE rows at a time, and hands each batch on as
+#  soon as it is formatted, so memory use stays the same however big the table is.
+# Every table in an export is read from an ExportSnapshot, a view of the database at a single moment, so
+#  the ratings in an export never refer to a movie that was added after the movies were exported.
+#   - The database is normally in WAL mode (see services.WAL_MODE), so the snapshot is simply a read
+#     transaction, which doesn't hold up writers.
+#   - Otherwise a read transaction would block every write until the export finished (however slowly the
+#     client downloads it), so the export reads a read replica instead (see services.get_read_replica).
+#     A replica is only ever replaced whole, never changed, so it stays the same for as long as it is read.
+# The CSV columns are the same as the files in utility/data, so an export can be loaded again with load_data.
+import csv
+import io
+import json
+import logging
+import sqlite3
+import time
+from api import services
+
+# The columns of each table that can be exported, in the same order as the files load_data reads
+EXPORT_COLUMNS = {
+    "movies": ("movie_id", "title", "genre", "release_year", "director"),
+    "users": ("user_id", "username", "email", "date_joined"),
+    "ratings": ("rating_id", "user_id", "movie_id", "rating", "review", "date"),
+}
+
+# The formats an export can be written in, with their content type and file extension
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv", "csv"),
+}
+
+# How many rows are read from the cursor (and formatted) at a time
+FETCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class ExportStats:
+    """
+    How much of a table has been exported and how quickly.
+    """
+
+    def __init__(self, table: str):
+        self.table = table
+        self.rows = 0
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def __repr__(self):
+        return f'<ExportStats {self.table} - {self.rows} rows>'
+
+    @property
+    def seconds(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    def to_dict(self):
+        seconds = self.seconds
+        return {
+            'table': self.table,
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'seconds': round(seconds, 4),
+            'rows_per_second': round(self.rows / seconds) if seconds > 0 else None,
+            'megabytes_per_second': round(self.bytes / seconds / 1_000_000, 3) if seconds > 0 else None,
+        }
+
+
+class ExportSnapshot:
+    """
+    A read-only view of the whole database at one moment, which every table in an export is read from.
+
+    Usage:
+        with ExportSnapshot() as snapshot:
+            for chunk in snapshot.export("ratings", "csv"):
+                file.write(chunk)
+    """
+
+    def __init__(self):
+        primary = services.get_read_connection(use_replica=False)
+        if primary.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal":
+            self.connection = primary
+        else:
+            primary.close()
+            self.connection = self._open_replica()
+        # The first read of the transaction fixes what every later read sees
+        self.connection.execute("BEGIN")
+        # Everything up to this change is in the export, later ones can be followed with /api/changes
+        self.change_seq = self.connection.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+        self.stats = {}
+
+    def _open_replica(self) -> sqlite3.Connection:
+        # Without replicas turned on, exports still share one replica (refreshed once it is out of date)
+        if services.READ_REPLICA_COUNT > 0:
+            return services.get_read_connection()
+        return sqlite3.connect(f"{services.get_read_replica(0).as_uri()}?mode=ro", uri=True)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def iter_rows(self, table: str, fetch_size: int = FETCH_SIZE):
+        """
+        Read a table in primary key order, a batch of rows at a time.
+        Yields:
+            list of tuple: The next batch of rows, with the columns in EXPORT_COLUMNS order.
+        """
+        columns = EXPORT_COLUMNS[table]
+        cursor = self.connection.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY {columns[0]}")
+        try:
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def export(self, table: str, export_format: str = "ndjson", fetch_size: int = FETCH_SIZE):
+        """
+        Export a table.
+        Args:
+            table (str): "movies", "users" or "ratings".
+            export_format (str, optional): "ndjson" (one JSON object per line, the default) or "csv".
+            fetch_size (int, optional): How many rows to read at a time.
+        Yields:
+            str: The export, a batch of rows at a time.
+        Raises:
+            ValueError: If the table or format isn't one that can be exported.
+        """
+        if table not in EXPORT_COLUMNS:
+            raise ValueError(f"The table must be one of: {', '.join(EXPORT_COLUMNS)}")
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"The format must be one of: {', '.join(EXPORT_FORMATS)}")
+        return self._export(table, export_format, fetch_size)
+
+    def _export(self, table: str, export_format: str, fetch_size: int):
+        columns = EXPORT_COLUMNS[table]
+        stats = self.stats[table] = ExportStats(table)
+        if export_format == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator="\n")
+            writer.writerow(columns)
+        for rows in self.iter_rows(table, fetch_size):
+            if export_format == "csv":
+                writer.writerows(rows)
+                chunk = buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            else:
+                chunk = "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+            stats.rows += len(rows)
+            stats.bytes += len(chunk.encode("utf-8"))
+            yield chunk
+        if export_format == "csv" and stats.rows == 0:
+            # Nothing but the header was written
+            chunk = buffer.getvalue()
+            stats.bytes += len(chunk.encode("utf-8"))
+            yield chunk
+        stats.finished = time.perf_counter()
+        logger.info("Exported %(rows)d %(table)s in %(seconds).3fs (%(rows_per_second)s rows/s)", stats.to_dict())
+
+
+def stream_table(snapshot: ExportSnapshot, table: str, export_format: str = "ndjson", fetch_size: int = FETCH_SIZE):
+    """
+    Export one table from a snapshot and close the snapshot when done (or when the client goes away).
+    """
+    try:
+        yield from snapshot.export(table, export_format, fetch_size)
+    finally:
+        snapshot.close()
@@ -1,7 +1,18 @@
 # In this file, we define the classes that represent the data in our application.
 # If our classes got to be too numerous, we could refactor them into separate files,
 #  likely if we went this path, we would put them into a models directory rather than in the api directory.
+# Each class lists the fields that its to_dict method can return in FIELDS, so that clients can ask for
+#  just the fields they need (e.g. /api/users?fields=id,username) and the rest are never loaded or sent.
+def select_fields(data: dict, fields=None) -> dict:
+    """
+    Keep only the requested keys of a dictionary, or all of them if no fields were requested.
+    """
+    if fields is None:
+        return data
+    return {key: value for key, value in data.items() if key in fields}
+
 class User:
+    FIELDS = ('id', 'username', 'email', 'date_joined')
     
     def __init__(self, id: int, username: str, email: str):
         self.id = id
@@ -12,13 +23,13 @@ class User:
     def __repr__(self):
         return f'<User {self.id} - {self.username}>'
     
-    def to_dict(self):
-        return {
+    def to_dict(self, fields=None):
+        return select_fields({
             'id': self.id,
             'username': self.username,
             'email': self.email,
             'date_joined': self.date_joined
-        }
+        }, fields)
 
 # This function will take a dictionary and return a User object
 def create_user_from_dict( data: dict) -> User:
@@ -29,6 +40,7 @@ def create_user_from_dict( data: dict) -> User:
     return User(data.get('id',None), data['username'], data['email'])
 
 class Movie:
+    FIELDS = ('movie_id', 'title', 'genre', 'release_year', 'director')
 
     def __init__(self, movie_id: int, title: str, genre: str, release_year: int, director: str):
         self.movie_id = movie_id
@@ -44,16 +56,17 @@ class Movie:
     # This function will return a dictionary representation of the Movie object
     # This is useful for converting the object to JSON
     # If the ratings attribute is a list of Rating objects, we would need to convert them to dictionaries as well
-    def to_dict(self):
-        movie_dict = {
+    # fields limits the movie's own fields, rating_fields limits the fields of each of its ratings
+    def to_dict(self, fields=None, rating_fields=None):
+        movie_dict = select_fields({
             'movie_id': self.movie_id,
             'title': self.title,
             'genre': self.genre,
             'release_year': self.release_year,
             'director': self.director
-        }
+        }, fields)
         if len(self.ratings) > 0:
-            movie_dict['ratings'] = [rating.to_dict() for rating in self.ratings]
+            movie_dict['ratings'] = [rating.to_dict(rating_fields) for rating in self.ratings]
         return movie_dict
 
     # This function will take a dictionary and return a Movie object, this is useful to convert JSON to an object
@@ -78,6 +91,7 @@ class Movie:
 
 
 class Rating:
+    FIELDS = ('rating_id', 'user_id', 'movie_id', 'rating', 'review', 'date')
 
     def __init__(
         self,
@@ -98,15 +112,15 @@ class Rating:
     def __repr__(self):
         return f"<Rating {self.rating_id}>"
 
-    def to_dict(self):
-        return {
+    def to_dict(self, fields=None):
+        return select_fields({
             "rating_id": self.rating_id,
             "user_id": self.user_id,
             "movie_id": self.movie_id,
             "rating": self.rating,
             "review": self.review,
             "date": self.date,
-        }
+        }, fields)
 
     # This function will take a dictionary and return a Rating object
     # See the advanced_concepts documenation for more information on class methods
@@ -120,4 +134,152 @@ class Rating:
             rating=data["rating"],
             review=data["review"],
             date=data["date"],
-        )
\ No newline at end of file
+        )
+
+class MovieScore:
+
+    def __init__(self, movie: Movie, score: float, rating_count: int, rating_sum: float):
+        self.movie = movie
+        self.score = score
+        self.rating_count = rating_count
+        self.rating_sum = rating_sum
+
+    def __repr__(self):
+        return f'<MovieScore {self.movie.movie_id} - {self.score:.2f}>'
+
+    @property
+    def average_rating(self) -> float:
+        if self.rating_count == 0:
+            return None
+        return self.rating_sum / self.rating_count
+
+    # The leaderboard entry is the movie itself with its ranking figures added alongside,
+    #  so clients can treat it like any other movie in the API
+    def to_dict(self):
+        movie_dict = self.movie.to_dict()
+        movie_dict['score'] = round(self.score, 4)
+        movie_dict['rating_count'] = self.rating_count
+        movie_dict['average_rating'] = self.average_rating
+        return movie_dict
+
+
+class MovieSearchResult:
+
+    def __init__(self, movies: list, next_cursor: str = None, facets: dict = None):
+        self.movies = movies
+        self.next_cursor = next_cursor
+        self.facets = facets or {}
+
+    def __repr__(self):
+        return f'<MovieSearchResult {len(self.movies)} movies>'
+
+    def to_dict(self):
+        result = {
+            'movies': [movie.to_dict() for movie in self.movies],
+            'next_cursor': self.next_cursor,
+        }
+        if self.facets:
+            # JSON object keys have to be strings, the decade facet is keyed by year
+            result['facets'] = {
+                facet: {str(value): count for value, count in counts.items()}
+                for facet, counts in self.facets.items()
+            }
+        return result
+
+
+class UserStats:
+
+    def __init__(self, user_id: int, rating_count: int, rating_sum: float, histogram: dict,
+                 favorite_genres: list, favorite_directors: list, activity: list):
+        self.user_id = user_id
+        self.rating_count = rating_count
+        self.rating_sum = rating_sum
+        # The number of ratings given for each rating value, e.g. {'4': 2, '5': 1}
+        self.histogram = histogram
+        # Lists of (name, rating count, average rating), favourite first
+        self.favorite_genres = favorite_genres
+        self.favorite_directors = favorite_directors
+        # A list of (month, rating count, average rating), oldest month first
+        self.activity = activity
+
+    def __repr__(self):
+        return f'<UserStats {self.user_id} - {self.rating_count} ratings>'
+
+    @property
+    def average_rating(self) -> float:
+        if self.rating_count == 0:
+            return None
+        return self.rating_sum / self.rating_count
+
+    def to_dict(self):
+        def named_averages(entries):
+            return [
+                {'name': name, 'rating_count': count, 'average_rating': round(average, 4)}
+                for name, count, average in entries
+            ]
+
+        return {
+            'user_id': self.user_id,
+            'rating_count': self.rating_count,
+            'average_rating': self.average_rating,
+            'histogram': self.histogram,
+            'favorite_genres': named_averages(self.favorite_genres),
+            'favorite_directors': named_averages(self.favorite_directors),
+            'activity': [
+                {'month': month, 'rating_count': count, 'average_rating': round(average, 4)}
+                for month, count, average in self.activity
+            ],
+            'first_active': self.activity[0][0] if self.activity else None,
+            'last_active': self.activity[-1][0] if self.activity else None,
+        }
+
+
+class RatingBucket:
+
+    def __init__(self, period: str, period_start: str, rating_count: int, rating_sum: float):
+        self.period = period
+        self.period_start = period_start
+        self.rating_count = rating_count
+        self.rating_sum = rating_sum
+
+    def __repr__(self):
+        return f'<RatingBucket {self.period} {self.period_start} - {self.rating_count} ratings>'
+
+    @property
+    def average_rating(self) -> float:
+        if self.rating_count == 0:
+            return None
+        return self.rating_sum / self.rating_count
+
+    def to_dict(self):
+        return {
+            'period': self.period,
+            'period_start': self.period_start,
+            'rating_count': self.rating_count,
+            'average_rating': round(self.average_rating, 4) if self.rating_count else None,
+        }
+
+
+class Change:
+
+    def __init__(self, seq: int, entity: str, entity_id: int, op: str, data: dict = None, changed_at: str = None):
+        self.seq = seq
+        self.entity = entity
+        self.entity_id = entity_id
+        self.op = op
+        # The record's new values for a create or update, None for a delete
+        self.data = data
+        self.changed_at = changed_at
+
+    def __repr__(self):
+        return f'<Change {self.seq} - {self.op} {self.entity} {self.entity_id}>'
+
+    def to_dict(self):
+        return {
+            'seq': self.seq,
+            'entity': self.entity,
+            'id': self.entity_id,
+            'op': self.op,
+            'data': self.data,
+            'changed_at': self.changed_at,
+        }
@@ -0,0 +1,308 @@
+# In this file, we build the SQL for searching movies.
+# Rather than gluing strings together in every service function, a MovieQuery collects the filters, the
+#  sort order and the page size, and compile() turns them into one SQL statement plus its parameters.
+# The SQL only depends on the "shape" of the query (which filters are used and how many values each has),
+#  not on the values themselves, so we cache the compiled text per shape. Identical SQL text also lets
+#  sqlite3 reuse its prepared statement for the connection instead of parsing the query again.
+import base64
+import json
+from functools import lru_cache
+from typing import List
+
+# The columns a search can be sorted by, and the SQL expression for each.
+# Every expression has an index behind it (see services.BASE_TABLE_INDEXES) apart from the average
+#  rating, which comes from the movie_scores leaderboard table.
+SORT_COLUMNS = {
+    "title": "m.title",
+    "year": "m.release_year",
+    "rating": "COALESCE(s.rating_sum / s.rating_count, 0)",
+}
+
+# The sort columns that can be NULL. SQLite sorts NULLs before every other value, so paging past them
+#  needs its own comparison (a row comparison with a NULL in it is never true)
+NULLABLE_SORT_COLUMNS = {"title", "year"}
+
+# What the sort value in a cursor can be
+CURSOR_VALUE_TYPES = (str, int, float, type(None))
+
+# The facets that can be counted alongside a search
+FACETS = ("genre", "decade", "director")
+
+
+def split_names(values) -> List[str]:
+    """
+    Split a comma separated string (or a list of them) into a list of distinct, trimmed names.
+    Args:
+        values (str or list): e.g. "Anthony Russo, Joe Russo" or ["Action", "Drama"].
+    Returns:
+        List[str]: The names in the order they first appear, e.g. ["Anthony Russo", "Joe Russo"].
+    """
+    if not values:
+        return []
+    if isinstance(values, str):
+        values = [values]
+    names = []
+    seen = set()
+    for value in values:
+        for name in str(value).split(","):
+            name = name.strip()
+            if name and name.lower() not in seen:
+                seen.add(name.lower())
+                names.append(name)
+    return names
+
+
+class MovieQuery:
+    """
+    A search over the movies table.  Each method adds to the query and returns it, so calls can be chained:
+
+        query = MovieQuery().with_genres("Action, Sci-Fi").released_between(1990, 1999).sort_by("rating", descending=True)
+    """
+
+    def __init__(self):
+        self.genres = []
+        self.directors = []
+        self.year_from = None
+        self.year_to = None
+        self.title_prefix = None
+        self.sort = "title"
+        self.descending = False
+        self.page_size = None
+        self.cursor = None
+
+    def __repr__(self):
+        return f'<MovieQuery {self._shape()}>'
+
+    def with_genres(self, genres) -> 'MovieQuery':
+        self.genres = split_names(genres)
+        return self
+
+    def with_directors(self, directors) -> 'MovieQuery':
+        self.directors = split_names(directors)
+        return self
+
+    def released_between(self, year_from: int = None, year_to: int = None) -> 'MovieQuery':
+        # Either end can be left open
+        self.year_from = year_from or None
+        self.year_to = year_to or None
+        return self
+
+    def title_starts_with(self, title: str) -> 'MovieQuery':
+        self.title_prefix = title or None
+        return self
+
+    def sort_by(self, column: str, descending: bool = False) -> 'MovieQuery':
+        if column not in SORT_COLUMNS:
+            raise ValueError(f"Can't sort movies by '{column}', use one of {', '.join(SORT_COLUMNS)}")
+        self.sort = column
+        self.descending = descending
+        return self
+
+    def limit(self, page_size: int) -> 'MovieQuery':
+        if page_size is not None and page_size < 1:
+            raise ValueError("The limit must be at least 1")
+        self.page_size = page_size
+        return self
+
+    def after(self, cursor: str) -> 'MovieQuery':
+        """
+        Continue from the page that returned the given cursor.  The cursor holds the sort value and the
+        movie ID of the last movie on that page, so the next page starts with a seek on the sort index
+        rather than counting past an OFFSET.
+        """
+        self.cursor = decode_cursor(cursor) if cursor else None
+        return self
+
+    def _shape(self) -> tuple:
+        return (
+            len(self.genres),
+            len(self.directors),
+            self.year_from is not None,
+            self.year_to is not None,
+            self.title_prefix is not None,
+            self.sort,
+            self.descending,
+            _cursor_kind(self.cursor),
+            self.page_size is not None,
+        )
+
+    def _filter_params(self) -> list:
+        # These must be in the same order as the clauses that _where_clauses() generates
+        params = list(self.genres) + list(self.directors)
+        for value in (self.year_from, self.year_to):
+            if value is not None:
+                params.append(value)
+        if self.title_prefix is not None:
+            params.append(f"{self.title_prefix}%")
+        return params
+
+    def compile(self):
+        """
+        Build the SQL for a page of matching movies.
+        Returns:
+            tuple: The SQL text and a list of its parameters.
+        """
+        params = self._filter_params()
+        if self.cursor is not None:
+            # After a NULL sort value only the movie ID is compared
+            params.extend(self.cursor if self.cursor[0] is not None else self.cursor[1:])
+        if self.page_size is not None:
+            # Fetch one extra row so that we know whether there is another page
+            params.append(self.page_size + 1)
+        return _compile_page(self._shape()), params
+
+    def compile_facets(self, facets):
+        """
+        Build the SQL that counts matching movies by each of the given facets in a single statement.
+        Args:
+            facets (list of str): Any of "genre", "decade" and "director".
+        Returns:
+            tuple: The SQL text and a list of its parameters.
+        """
+        for facet in facets:
+            if facet not in FACETS:
+                raise ValueError(f"Can't count movies by '{facet}', use one of {', '.join(FACETS)}")
+        # Facets ignore the sort order and paging, they count everything that matches
+        shape = self._shape()[:5]
+        return _compile_facets(shape, tuple(facets)), self._filter_params()
+
+    def next_cursor(self, last_row) -> str:
+        """
+        Make the cursor for the page after the one ending with the given row.
+        """
+        return encode_cursor([last_row["sort_value"], last_row["movie_id"]])
+
+
+def encode_cursor(values) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> list:
+    """
+    Read a cursor made by encode_cursor().
+    Returns:
+        list: The sort value (a string, a number or None) and the ID of the last row of the previous page.
+    Raises:
+        ValueError: If the cursor wasn't made by encode_cursor().
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ValueError("The cursor is not valid") from None
+    if (
+        not isinstance(values, list)
+        or len(values) != 2
+        or not isinstance(values[0], CURSOR_VALUE_TYPES)
+        or isinstance(values[0], bool)
+        or not isinstance(values[1], int)
+        or isinstance(values[1], bool)
+    ):
+        raise ValueError("The cursor is not valid")
+    return values
+
+
+def _cursor_kind(cursor):
+    if cursor is None:
+        return None
+    return "null" if cursor[0] is None else "value"
+
+
+def _where_clauses(shape) -> List[str]:
+    genre_count, director_count, has_year_from, has_year_to, has_title = shape[:5]
+    clauses = []
+    # Genre and director filters go through the lookup tables: a seek on the name's unique index,
+    #  then on the junction table's (name id, movie id) primary key
+    for count, junction_table, lookup_table, id_column in (
+        (genre_count, "movie_genres", "genres", "genre_id"),
+        (director_count, "movie_directors", "directors", "director_id"),
+    ):
+        if count:
+            placeholders = ", ".join("?" for _ in range(count))
+            clauses.append(
+                f"m.movie_id IN (SELECT j.movie_id FROM {lookup_table} l "
+                f"JOIN {junction_table} j ON j.{id_column} = l.{id_column} WHERE l.name IN ({placeholders}))"
+            )
+    # Year ranges are a range scan on the release year index
+    if has_year_from:
+        clauses.append("m.release_year >= ?")
+    if has_year_to:
+        clauses.append("m.release_year <= ?")
+    if has_title:
+        clauses.append("m.title LIKE ?")
+    return clauses
+
+
+@lru_cache(maxsize=256)
+def _compile_page(shape) -> str:
+    sort, descending, cursor_kind, has_limit = shape[5:]
+    sort_expression = SORT_COLUMNS[sort]
+    query = (
+        f"SELECT m.movie_id, m.title, m.genre, m.release_year, m.director, {sort_expression} AS sort_value "
+        "FROM movies m"
+    )
+    # Only join the leaderboard when we need it for sorting
+    if sort == "rating":
+        query += " LEFT JOIN movie_scores s ON s.movie_id = m.movie_id"
+
+    clauses = _where_clauses(shape)
+    if cursor_kind is not None:
+        # Keyset paging: carry on from the last (sort value, movie ID) we returned
+        clauses.append(_after_cursor(sort, sort_expression, descending, cursor_kind))
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+
+    direction = "DESC" if descending else "ASC"
+    query += f" ORDER BY {sort_expression} {direction}, m.movie_id {direction}"
+    if has_limit:
+        query += " LIMIT ?"
+    return query
+
+
+def _after_cursor(sort: str, sort_expression: str, descending: bool, cursor_kind: str) -> str:
+    comparison = "<" if descending else ">"
+    after_value = f"({sort_expression}, m.movie_id) {comparison} (?, ?)"
+    if sort not in NULLABLE_SORT_COLUMNS:
+        return after_value
+    # NULLs come first going up and last going down
+    if cursor_kind == "null":
+        after_null = f"{sort_expression} IS NULL AND m.movie_id {comparison} ?"
+        return f"({after_null})" if descending else f"({after_null} OR {sort_expression} IS NOT NULL)"
+    return f"({after_value} OR {sort_expression} IS NULL)" if descending else after_value
+
+
+@lru_cache(maxsize=256)
+def _compile_facets(shape, facets) -> str:
+    clauses = _where_clauses(shape)
+    where = " WHERE " + " AND ".join(clauses) if clauses else ""
+    # The matching movies are found once and then grouped for every facet in the same statement
+    query = f"WITH matched AS MATERIALIZED (SELECT m.movie_id, m.release_year FROM movies m{where}) "
+    selects = []
+    for facet in facets:
+        if facet == "decade":
+            selects.append(
+                "SELECT 'decade' AS facet, (release_year / 10) * 10 AS value, COUNT(*) AS count "
+                "FROM matched WHERE release_year IS NOT NULL GROUP BY value"
+            )
+        else:
+            lookup_table, junction_table, id_column = {
+                "genre": ("genres", "movie_genres", "genre_id"),
+                "director": ("directors", "movie_directors", "director_id"),
+            }[facet]
+            selects.append(
+                f"SELECT '{facet}' AS facet, l.name AS value, COUNT(*) AS count FROM matched "
+                f"JOIN {junction_table} j ON j.movie_id = matched.movie_id "
+                f"JOIN {lookup_table} l ON l.{id_column} = j.{id_column} GROUP BY l.name"
+            )
+    return query + " UNION ALL ".join(selects)
+
+
+def compiled_statement_info():
+    """
+    Report how well the compiled statement caches are doing.
+    Returns:
+        dict: The hits, misses and size of the page and facet caches.
+    """
+    return {
+        name: cache.cache_info()._asdict()
+        for name, cache in (("page", _compile_page), ("facets", _compile_facets))
+    }
@@ -0,0 +1,263 @@
+# In this file, we keep the results of recent read queries so that repeating one doesn't run it again.
+# Most of the search traffic is the same few queries (the movie list, the same title prefixes, the same
+#  genre pages), and each one used to be run from scratch on every request.
+#
+# A result is stored under its SQL, with the whitespace normalized, and its parameters. Along with it we
+#  keep the tables the query read, which SQLite reports itself (see services._cached_read), so views,
+#  joins and subqueries are all accounted for.
+# When a write transaction commits, the services layer tells the cache which tables it wrote to and every
+#  result that read one of them is dropped, so a read never sees data older than this process's own writes.
+#  Writes made by other processes (other gunicorn workers) can't be seen this way. If the workers share a
+#  set of table generations (the shared cache, see api/shared_cache.py), each result is checked against
+#  them before it is used. Otherwise a result is dropped once it is older than max_age seconds, the same
+#  idea as READ_REPLICA_MAX_STALENESS.
+# The results are kept within a memory budget (max_bytes, estimated from the values in them), evicting the
+#  least recently used results first.
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Strings in SQL, whose whitespace is part of the value and must be kept as it is
+SQL_STRING_PATTERN = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+# Means "every table", for writes that change the schema
+ALL_TABLES = "*"
+
+# SQL functions whose result changes from one run to the next, so queries that use them aren't cached
+VOLATILE_SQL_PATTERN = re.compile(
+    r"\b(random|randomblob|changes|total_changes|last_insert_rowid)\s*\(|'now'", re.IGNORECASE
+)
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    Collapse the whitespace in a statement (outside of its strings), so the same query written over
+    different lines is cached once.
+    """
+    parts = SQL_STRING_PATTERN.split(sql)
+    for index in range(0, len(parts), 2):
+        parts[index] = WHITESPACE_PATTERN.sub(" ", parts[index])
+    return "".join(parts).strip()
+
+
+def is_cacheable(sql: str) -> bool:
+    return VOLATILE_SQL_PATTERN.search(sql) is None
+
+
+def make_key(sql: str, params=()) -> tuple:
+    if isinstance(params, dict):
+        params = tuple(sorted(params.items()))
+    return normalize_sql(sql), tuple(params or ())
+
+
+def estimate_size(value) -> int:
+    """
+    Roughly how many bytes a result takes up, counting the Python objects that hold it.
+    """
+    if isinstance(value, (str, bytes)):
+        return 49 + len(value)
+    if isinstance(value, (tuple, list, sqlite3.Row)):
+        return 56 + 8 * len(value) + sum(estimate_size(item) for item in value)
+    if isinstance(value, dict):
+        return 64 + sum(estimate_size(key) + estimate_size(item) + 16 for key, item in value.items())
+    return 32
+
+
+class _Entry:
+    __slots__ = ("result", "tables", "size", "stored_at", "clock")
+
+    def __init__(self, result, tables, size, stored_at, clock):
+        self.result = result
+        self.tables = tables
+        self.size = size
+        self.stored_at = stored_at
+        self.clock = clock
+
+
+class QueryCache:
+    """
+    A least-recently-used cache of query results, invalidated by the tables they read.
+    """
+
+    def __init__(self, max_bytes: int, max_age: float = None, generations=None):
+        """
+        Args:
+            max_bytes (int): The memory budget for the results, 0 turns the cache off.
+            max_age (float, optional): How many seconds a result is kept. Defaults to no limit.
+            generations (optional): Table generations shared with other processes, with current() and
+                changed_since(tables, clock) (e.g. a shared_cache.SharedCache).
+        """
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.generations = generations
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._keys_by_table = {}
+        self._bytes = 0
+        # Counts invalidations, so a result read before one isn't stored after it (see start_read)
+        self._generation = 0
+        self._invalidated_at = {}
+        self._stats = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key, name: str = "query"):
+        """
+        Returns:
+            The cached result, or None if there isn't one (or it is too old).
+        """
+        with self._lock:
+            stats = self._stats_for(name)
+            entry = self._entries.get(key)
+            if entry is not None and self.max_age is not None and time.monotonic() - entry.stored_at > self.max_age:
+                self._remove(key)
+                stats["expired"] += 1
+                entry = None
+            if entry is not None and self.generations is not None and self.generations.changed_since(entry.tables, entry.clock):
+                # Another process has written to one of its tables
+                self._remove(key)
+                stats["expired"] += 1
+                entry = None
+            if entry is None:
+                stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            stats["hits"] += 1
+            return entry.result
+
+    def start_read(self) -> tuple:
+        """
+        Call before running a query whose result will be stored with put().
+        Returns:
+            tuple: A token for put(), so that a result that a write overtook while it was being read isn't
+            stored: the count of this cache's invalidations, and the shared clock (if there is one).
+        """
+        clock = self.generations.current() if self.generations is not None else None
+        with self._lock:
+            return self._generation, clock
+
+    def put(self, key, result, tables, started: tuple, name: str = "query") -> bool:
+        """
+        Store a query's result.
+        Args:
+            key: The query's key, from make_key().
+            result: The result, which mustn't be changed afterwards.
+            tables (set of str): The tables the query read.
+            started (tuple): The token from start_read(), taken before the query ran.
+            name (str, optional): What the query is for, to report hit ratios by.
+        Returns:
+            bool: Whether the result was stored.
+        """
+        if not tables:
+            # Without knowing what it read, nothing would ever invalidate it
+            return False
+        size = estimate_size(result) + estimate_size(key[0]) + estimate_size(key[1])
+        generation, clock = started
+        with self._lock:
+            if size > self.max_bytes:
+                self._stats_for(name)["too_large"] += 1
+                return False
+            if any(self._invalidated_at.get(table, -1) > generation for table in (*tables, ALL_TABLES)):
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(result, frozenset(tables), size, time.monotonic(), clock)
+            self._bytes += size
+            for table in tables:
+                self._keys_by_table.setdefault(table, set()).add(key)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats_for(name)["evictions"] += 1
+            return True
+
+    def invalidate(self, tables) -> int:
+        """
+        Drop every result that read one of these tables.
+        Args:
+            tables (iterable of str): The tables that were written to, or ALL_TABLES.
+        Returns:
+            int: How many results were dropped.
+        """
+        tables = set(tables)
+        if not tables:
+            return 0
+        with self._lock:
+            self._generation += 1
+            for table in tables:
+                self._invalidated_at[table] = self._generation
+            if ALL_TABLES in tables:
+                dropped = len(self._entries)
+                self._entries.clear()
+                self._keys_by_table.clear()
+                self._bytes = 0
+                return dropped
+            keys = set()
+            for table in tables:
+                keys.update(self._keys_by_table.pop(table, ()))
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        self.invalidate({ALL_TABLES})
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: The size of the cache and, overall and for each kind of query, the hits, misses and hit ratio.
+        """
+        with self._lock:
+            by_name = {name: dict(stats) for name, stats in self._stats.items()}
+            entries, used = len(self._entries), self._bytes
+        totals = {}
+        for stats in by_name.values():
+            for counter, value in stats.items():
+                totals[counter] = totals.get(counter, 0) + value
+            stats["hit_ratio"] = _hit_ratio(stats)
+        totals["hit_ratio"] = _hit_ratio(totals) if totals else None
+        return {
+            "enabled": self.enabled,
+            "entries": entries,
+            "bytes": used,
+            "max_bytes": self.max_bytes,
+            "max_age": self.max_age,
+            "total": totals,
+            "queries": by_name,
+        }
+
+    def reset(self):
+        """
+        Empty the cache and its statistics, and replace its lock (for a newly forked worker).
+        """
+        self._lock = threading.Lock()
+        self._entries.clear()
+        self._keys_by_table.clear()
+        self._bytes = 0
+        self._stats.clear()
+
+    def _stats_for(self, name: str) -> dict:
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = self._stats[name] = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "too_large": 0}
+        return stats
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        for table in entry.tables:
+            keys = self._keys_by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_table[table]
+
+
+def _hit_ratio(stats: dict):
+    lookups = stats.get("hits", 0) + stats.get("misses", 0)
+    return stats.get("hits", 0) / lookups if lookups else None
@@ -0,0 +1,257 @@
+# In this file, we send new ratings to clients as they happen, using Server-Sent Events (GET /api/ratings/stream).
+# Dashboards used to poll /api/movies/<id>/ratings every few seconds to show new reviews, so every open
+#  dashboard cost a query every few seconds whether anything had changed or not.
+# Each worker process now has one RatingHub. The hub has a single thread that reads the new rating entries
+#  from the change log (see services.get_changes) and hands each one to every open stream that wants it, so
+#  a thousand viewers cost one small query rather than a thousand.
+#   - A rating saved by this process wakes the hub straight away (services.add_commit_listener).
+#   - A rating saved by another worker is picked up the next time the hub checks the log, at most
+#     POLL_INTERVAL seconds later. The change log is in the database, so this works across every worker
+#     without them having to talk to each other.
+# Each event's id is the change's sequence number. A browser that loses the connection reconnects with a
+#  Last-Event-ID header, and the stream first replays whatever it missed from the change log. A stream
+#  replays at most MAX_REPLAY changes: if the client missed more, it is sent a "resync" event and the
+#  stream ends, and the browser reconnects from where the replay got to (see event_stream).
+import json
+import os
+import queue
+import threading
+import time
+from api import services
+from api.models import Change
+
+# How often (in seconds) the hub checks the change log for ratings saved by other workers
+POLL_INTERVAL = float(os.environ.get("MOVIE_API_STREAM_POLL_INTERVAL", "0.5"))
+# The most changes the hub reads in one go
+POLL_BATCH_SIZE = 500
+# How many events can wait for a slow client before its stream is closed (it can reconnect and catch up)
+SUBSCRIBER_QUEUE_SIZE = 1000
+# The most missed changes one stream replays before it asks the client to resync
+MAX_REPLAY = 5000
+# How long (in milliseconds) browsers should wait before reconnecting
+RECONNECT_DELAY = 3000
+
+# Only new and changed ratings are sent, a deleted rating has no movie or user left to filter on
+STREAMED_OPS = ("create", "update")
+
+
+class Subscription:
+    """
+    One open stream: the events it is waiting to send and what it wants to be sent.
+    """
+
+    def __init__(self, movie_id: int = None, user_id: int = None, max_queue: int = SUBSCRIBER_QUEUE_SIZE):
+        self.movie_id = movie_id
+        self.user_id = user_id
+        self.overflowed = False
+        self._queue = queue.Queue(max_queue)
+
+    def __repr__(self):
+        return f'<Subscription movie={self.movie_id} user={self.user_id}>'
+
+    def matches(self, change: Change) -> bool:
+        if change.entity != "rating" or change.op not in STREAMED_OPS:
+            return False
+        data = change.data or {}
+        if self.movie_id is not None and data.get("movie_id") != self.movie_id:
+            return False
+        if self.user_id is not None and data.get("user_id") != self.user_id:
+            return False
+        return True
+
+    def put(self, change: Change):
+        try:
+            self._queue.put_nowait(change)
+        except queue.Full:
+            # The client isn't keeping up. Its stream is closed, and it resumes from the log when it reconnects.
+            self.overflowed = True
+
+    def get(self, timeout: float):
+        """
+        Wait for the next event.
+        Returns:
+            Change: The next change, or None if there wasn't one within the timeout.
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class RatingHub:
+    """
+    Reads new ratings from the change log and passes them on to the open streams in this process.
+    """
+
+    def __init__(self, poll_interval: float = POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.last_seq = None
+        self.polls = 0
+        self.published = 0
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def subscribe(self, movie_id: int = None, user_id: int = None) -> Subscription:
+        subscription = Subscription(movie_id, user_id)
+        with self._lock:
+            if self.last_seq is None:
+                # Only changes made from now on are sent live, earlier ones are replayed by event_stream
+                self.last_seq = services.get_latest_change_seq()
+            self._subscriptions.add(subscription)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="rating-hub", daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            if not self._subscriptions:
+                # Nobody is listening, so there is no need to keep up with the log until someone is
+                self.last_seq = None
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscriptions)
+
+    def notify(self):
+        # Called after every commit in this process (see services.add_commit_listener)
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                self.poll()
+            except Exception:
+                # The database may be briefly unavailable (e.g. while it is reloaded), try again next time
+                pass
+
+    def poll(self) -> int:
+        """
+        Pass every rating change since the last poll on to the streams that want it.
+        Returns:
+            int: The number of changes read from the log.
+        """
+        with self._lock:
+            since = self.last_seq
+            subscriptions = list(self._subscriptions)
+        if since is None or not subscriptions:
+            return 0
+        changes = services.get_changes(since=since, limit=POLL_BATCH_SIZE, entity="rating", fresh=True)
+        for change in changes:
+            for subscription in subscriptions:
+                if subscription.matches(change):
+                    subscription.put(change)
+                    self.published += 1
+        with self._lock:
+            self.polls += 1
+            if changes and self.last_seq is not None:
+                self.last_seq = max(self.last_seq, changes[-1].seq)
+        if len(changes) == POLL_BATCH_SIZE:
+            # There are more waiting, don't wait for the next interval to read them
+            self._wake.set()
+        return len(changes)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "subscribers": len(self._subscriptions),
+                "last_seq": self.last_seq,
+                "polls": self.polls,
+                "published": self.published,
+            }
+
+
+def format_event(change: Change) -> str:
+    return f"id: {change.seq}\nevent: rating\ndata: {json.dumps(change.to_dict())}\n\n"
+
+
+def format_resync(seq: int) -> str:
+    # The id makes a browser reconnect from here, a client of its own can catch up from /api/changes?since=
+    return f"id: {seq}\nevent: resync\ndata: {json.dumps({'since': seq})}\n\n"
+
+
+def event_stream(hub: RatingHub, movie_id: int = None, user_id: int = None, last_event_id: int = None,
+                 heartbeat: float = 15, max_duration: float = None):
+    """
+    Generate the text of an event stream of the ratings that match.
+    The stream only subscribes to the hub once it is read, and unsubscribes when it ends or is closed, so a
+    response whose body is never read (e.g. to a HEAD request) leaves nothing behind.
+    Args:
+        hub (RatingHub): The hub to subscribe to.
+        movie_id (int, optional): Only send ratings of this movie.
+        user_id (int, optional): Only send ratings by this user.
+        last_event_id (int, optional): The id of the last event the client saw. The changes after it are
+            replayed from the change log before the live events. If there are more than MAX_REPLAY of
+            them, the stream sends a "resync" event with the last change it replayed and ends.
+        heartbeat (float, optional): Send a comment after this many seconds without an event, which keeps
+            proxies from closing the connection and lets us notice clients that have gone away.
+        max_duration (float, optional): Close the stream after this many seconds, the client reconnects and
+            carries on from its last event. This stops one viewer from holding a server thread forever.
+    Yields:
+        str: The stream, an event (or comment) at a time.
+    """
+    started = time.monotonic()
+    sent_seq = last_event_id or 0
+    # Subscribed before the replay, so nothing saved while it runs is missed
+    subscription = hub.subscribe(movie_id=movie_id, user_id=user_id)
+    try:
+        yield f"retry: {RECONNECT_DELAY}\n\n"
+        if last_event_id is not None:
+            replayed = 0
+            caught_up = False
+            while replayed < MAX_REPLAY:
+                changes = services.get_changes(since=sent_seq, limit=POLL_BATCH_SIZE, entity="rating", fresh=True)
+                for change in changes:
+                    if subscription.matches(change):
+                        yield format_event(change)
+                    sent_seq = change.seq
+                replayed += len(changes)
+                if len(changes) < POLL_BATCH_SIZE:
+                    caught_up = True
+                    break
+            if not caught_up:
+                # The live events start after changes that haven't been replayed yet, so they can't follow on
+                yield format_resync(sent_seq)
+                return
+
+        while not subscription.overflowed:
+            if max_duration is not None and time.monotonic() - started >= max_duration:
+                break
+            timeout = heartbeat
+            if max_duration is not None:
+                timeout = min(heartbeat, max(0.0, max_duration - (time.monotonic() - started)))
+            change = subscription.get(timeout=timeout)
+            if change is None:
+                yield ": heartbeat\n\n"
+            elif change.seq > sent_seq:
+                # Changes already sent while catching up are skipped
+                yield format_event(change)
+                sent_seq = change.seq
+    finally:
+        hub.unsubscribe(subscription)
+
+
+_hub = None
+_hub_pid = None
+_hub_lock = threading.Lock()
+
+
+def get_hub() -> RatingHub:
+    """
+    Get this process's rating hub, creating it if needed.
+    A forked worker process doesn't inherit the parent's hub thread, so it gets a hub of its own.
+    """
+    global _hub, _hub_pid
+    with _hub_lock:
+        if _hub is None or _hub_pid != os.getpid():
+            if _hub is not None:
+                services.remove_commit_listener(_hub.notify)
+            _hub = RatingHub()
+            _hub_pid = os.getpid()
+            services.add_commit_listener(_hub.notify)
+        return _hub
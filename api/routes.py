@@ -1,6 +1,13 @@
-from flask import jsonify, request, Blueprint
+from flask import jsonify, request, Blueprint, abort, make_response, current_app, Response
+import os
+import queue
 import api.services as services
+import api.write_behind as write_behind
+import api.rating_stream as rating_stream
+import api.export as export
+import api.batch as batch
 from api.models import User, create_user_from_dict, Movie, Rating
+from api.movie_query import MovieQuery
 from datetime import datetime
 
 # Create a Blueprint instance
@@ -11,6 +18,82 @@ from datetime import datetime
 
 api_bp = Blueprint("api", __name__)
 
+# The most IDs that can be looked up in one batch request
+MAX_BATCH_IDS = 1000
+
+def parse_id_list(ids: str):
+    """
+    Parse a comma separated list of IDs from a query string, e.g. "1,2,3".
+
+    Returns:
+        list of int: The IDs, or None if the list isn't valid or is too long.
+    """
+    try:
+        id_list = [int(id) for id in ids.split(",") if id.strip()]
+    except ValueError:
+        return None
+    if len(id_list) == 0 or len(id_list) > MAX_BATCH_IDS:
+        return None
+    return id_list
+
+def parse_fields(allowed_fields):
+    """
+    Read the optional "fields" query string parameter, e.g. ?fields=rating_id,rating
+    The fields are passed down to the services so that only those columns are read from the database.
+
+    Args:
+        allowed_fields (tuple): The fields the model can return, e.g. Rating.FIELDS.
+
+    Returns:
+        list of str: The requested fields, or None if the parameter wasn't given (meaning all fields).
+        If any of the fields isn't allowed, the request is ended with a 400 response.
+    """
+    fields = request.args.get("fields")
+    if fields is None:
+        return None
+    field_list = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown_fields = [field for field in field_list if field not in allowed_fields]
+    if len(field_list) == 0 or unknown_fields:
+        message = f'fields must be a comma separated list of: {", ".join(allowed_fields)}'
+        abort(make_response(jsonify({'message': message}), 400))
+    return field_list
+
+@api_bp.errorhandler(services.DatabaseBusyError)
+def database_busy(error):
+    """
+    A write couldn't get the database's write lock, even after retrying, because other workers kept it busy.
+    Rather than failing with a 500, ask the client to try again shortly.
+    """
+    response = jsonify({'message': 'The database is busy, try again shortly'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+# How many seconds a request's queries can run before they are cancelled (see services.set_deadline).
+#  It can be changed with REQUEST_DEADLINE in the app config or MOVIE_API_REQUEST_DEADLINE, 0 for no limit.
+#  It is well under gunicorn's worker timeout (30 seconds), so a slow query never gets a worker restarted.
+REQUEST_DEADLINE = float(os.environ.get("MOVIE_API_REQUEST_DEADLINE", "10"))
+
+# Endpoints whose queries take as long as they need: the stream stays open for minutes and exports are
+#  big on purpose
+NO_DEADLINE_ENDPOINTS = {"api.stream_ratings", "api.export_table"}
+
+@api_bp.before_request
+def start_request_deadline():
+    seconds = current_app.config.get("REQUEST_DEADLINE", REQUEST_DEADLINE)
+    if seconds and request.endpoint not in NO_DEADLINE_ENDPOINTS:
+        services.set_deadline(seconds, request.endpoint)
+
+@api_bp.teardown_request
+def end_request_deadline(error=None):
+    services.clear_deadline()
+
+@api_bp.errorhandler(services.QueryTimeoutError)
+def query_cancelled(error):
+    """
+    A query ran past the request's deadline and was cancelled, so the worker can get on with other requests.
+    """
+    return jsonify({'message': 'The request took too long and was cancelled'}), 504
+
 @api_bp.route('/')
 def home():
     """
@@ -34,6 +117,40 @@ def test_connection():
     services.get_db_connection()
     return jsonify({'message': 'Successfully connected to the API'}), 200
 
+@api_bp.route('/cache/status', methods=['GET'])
+def get_cache_status():
+    """
+    Report how many query results this worker has cached, how much memory they use and the hit ratios.
+
+    Returns:
+        tuple: A tuple containing a JSON response and status code 200.
+    """
+    return jsonify(services.get_query_cache_stats()), 200
+
+@api_bp.route('/admission/status', methods=['GET'])
+def get_admission_status():
+    """
+    Report how many requests this worker has rate limited, and for each route class how many requests are
+    running and waiting, how many were turned away and how long they waited for a turn.
+
+    Returns:
+        tuple: A tuple containing a JSON response and status code 200, or 404 if admission control isn't set up.
+    """
+    admission = current_app.extensions.get("admission")
+    if admission is None:
+        return jsonify({'message': 'Admission control is not set up'}), 404
+    return jsonify(admission.stats()), 200
+
+@api_bp.route('/queries/cancelled', methods=['GET'])
+def get_cancelled_queries():
+    """
+    Report the queries this worker has cancelled because their request's deadline passed.
+
+    Returns:
+        tuple: A tuple containing a JSON response and status code 200.
+    """
+    return jsonify(services.get_cancelled_queries()), 200
+
 # ---------------------------------------------------------
 # Users
 # ---------------------------------------------------------
@@ -43,14 +160,27 @@ def get_users():
     Retrieve a list of all users or filter users by name.
     If the query string parameter "starts_with" is provided, filter users by name.
     If the query string parameter "contains" is provided, filter users by name containing the string.
+    If the query string parameter "ids" is provided, return those users along with any IDs that weren't found.
 
     Returns:
         tuple: A tuple containing a JSON response with all users and an HTTP status code 200.
     """
     # Example: /api/users?starts_with=A
     # Example: /api/users?contains=John
+    # Example: /api/users?ids=1,2,3
     # Example: /api/users
     
+    # Example: /api/users?fields=id,username
+    fields = parse_fields(User.FIELDS)
+
+    # If a list of IDs is provided, look them all up at once
+    if request.args.get("ids") is not None:
+        user_ids = parse_id_list(request.args["ids"])
+        if user_ids is None:
+            return jsonify({'message': f'ids must be a comma separated list of up to {MAX_BATCH_IDS} integers'}), 400
+        users, missing_ids = services.get_users_by_ids(user_ids, fields=fields)
+        return jsonify({'users': [user.to_dict(fields) for user in users], 'missing_ids': missing_ids}), 200
+
     # Get the query string parameter "starts_with" from the request if it's there
     user_name = request.args.get("starts_with")  # Accessing query string parameter
     # If user_name is not provided
@@ -58,16 +188,16 @@ def get_users():
         # See if the query string parameter "contains" is provided
         contains_user_name = request.args.get("contains")
         if contains_user_name:
-            user_list = services.get_users_by_name(contains_user_name, starts_with=False)
+            user_list = services.get_users_by_name(contains_user_name, starts_with=False, fields=fields)
         # If neither "starts_with" nor "contains" is provided, get all users
         else:
-            user_list = services.get_all_users()
+            user_list = services.get_all_users(fields=fields)
     else:
         # If user_name is provided, filter users by name
-        user_list = services.get_users_by_name(user_name)
+        user_list = services.get_users_by_name(user_name, fields=fields)
 
     # Convert the list of User objects to a list of dictionaries so that we can jsonify it
-    user_dict_list = [user.to_dict() for user in user_list]
+    user_dict_list = [user.to_dict(fields) for user in user_list]
     return (jsonify(user_dict_list), 200)
 
 @api_bp.route('/users/<int:user_id>', methods=['GET'])
@@ -87,9 +217,10 @@ def lookup_user_by_id(user_id):
     # Example: /api/users/1
     
     # Using the database services to get the user by ID
-    user = services.get_user_by_id(user_id)
+    fields = parse_fields(User.FIELDS)
+    user = services.get_user_by_id(user_id, fields=fields)
     if user:
-        return jsonify(user.to_dict()), 200
+        return jsonify(user.to_dict(fields)), 200
     return jsonify({'message': 'User not found'}), 404
 
 @api_bp.route('/users/<int:user_id>/ratings', methods=['GET'])
@@ -103,11 +234,32 @@ def lookup_ratings_for_user(user_id):
     Returns:
         tuple: A tuple containing a JSON response with all ratings for the user and an HTTP status code.
     """
-    ratings = services.get_user_ratings(user_id)
-    rating_list = [rating.to_dict() for rating in ratings]
+    # Example: /api/users/1/ratings?fields=movie_id,rating
+    fields = parse_fields(Rating.FIELDS)
+    ratings = services.get_user_ratings(user_id, fields=fields)
+    rating_list = [rating.to_dict(fields) for rating in ratings]
     ratings_dict = {'user_id': user_id, 'ratings': rating_list}
     return jsonify(ratings_dict), 200
 
+@api_bp.route('/users/<int:user_id>/stats', methods=['GET'])
+def lookup_stats_for_user(user_id):
+    """
+    Retrieve a user's rating statistics: how many ratings they have given and their average, a histogram of
+    their ratings, their favourite genres and directors, and how many ratings they gave each month.
+
+    Args:
+        user_id (int): The unique identifier of the user.
+
+    Returns:
+        tuple: A tuple containing a JSON response and an HTTP status code.
+            - The statistics with status code 200.
+            - If the user doesn't exist, a JSON object with an error message and status code 404.
+    """
+    stats = services.get_user_stats(user_id)
+    if stats is None:
+        return jsonify({'message': 'User not found'}), 404
+    return jsonify(stats.to_dict()), 200
+
 @api_bp.route('/users', methods=['POST'])
 def add_new_user():
     """
@@ -179,18 +331,88 @@ def get_movies():
     """
     Retrieve a list of all movies.
     If the query string parameter "title" is provided, filter movies by title.
+    If the query string parameter "ids" is provided, return those movies along with any IDs that weren't found.
     
     Returns:
         tuple: A tuple containing a JSON response with all movies and an HTTP status code 200.
     """
+    # Example: /api/movies?ids=1,2,3
+    # Example: /api/movies?fields=movie_id,title
+    fields = parse_fields(Movie.FIELDS)
+    if request.args.get("ids") is not None:
+        movie_ids = parse_id_list(request.args["ids"])
+        if movie_ids is None:
+            return jsonify({'message': f'ids must be a comma separated list of up to {MAX_BATCH_IDS} integers'}), 400
+        movies, missing_ids = services.get_movies_by_ids(movie_ids, fields=fields)
+        return jsonify({'movies': [movie.to_dict(fields) for movie in movies], 'missing_ids': missing_ids}), 200
+
     movie_name = request.args.get("title")
     # If a "start_with" query parameter is provided, filter movies by name otherwise get all movies
-    movies = services.get_movies_by_name(movie_name, starts_with=True) if movie_name else services.get_all_movies()
+    movies = services.get_movies_by_name(movie_name, starts_with=True, fields=fields) if movie_name else services.get_all_movies(fields=fields)
     
     # Convert the list of Movie objects to a list of dictionaries so that we can jsonify it
-    movie_list = [movie.to_dict() for movie in movies]
+    movie_list = [movie.to_dict(fields) for movie in movies]
     return jsonify(movie_list), 200
 
+@api_bp.route('/movies/top', methods=['GET'])
+def get_top_movies():
+    """
+    Retrieve the highest ranked movies by Bayesian average rating.
+    The query string parameters "genre", "min_ratings" and "limit" are all optional.
+
+    Returns:
+        tuple: A tuple containing a JSON response with the ranked movies and an HTTP status code 200.
+    """
+    # Example: /api/movies/top?genre=Drama&min_ratings=3&limit=5
+    genre = request.args.get("genre", "")
+    min_ratings = request.args.get("min_ratings", 1, type=int)
+    # Cap the limit so that nobody can ask for the whole table through this endpoint
+    limit = min(request.args.get("limit", 10, type=int), 100)
+    if limit < 1:
+        return jsonify({'message': 'The limit must be at least 1'}), 400
+
+    top_movies = services.get_top_movies(genre=genre, min_ratings=min_ratings, limit=limit)
+    return jsonify([movie_score.to_dict() for movie_score in top_movies]), 200
+
+@api_bp.route('/movies/search', methods=['GET'])
+def search_movies():
+    """
+    Search movies by genre, director, release year range and title, with sorting, paging and facet counts.
+    All of the query string parameters are optional:
+        genre / director: a comma separated list (or repeated parameter), movies with any of them match
+        year, year_from, year_to: an exact release year or a range
+        title: movies whose title starts with this
+        sort: "title", "year" or "rating", with a leading "-" for descending order
+        limit: the page size (default 20, at most 100)
+        cursor: the next_cursor from the previous page
+        facets: a comma separated list of "genre", "decade" and "director" to count the matches by
+
+    Returns:
+        tuple: A tuple containing a JSON response with the page of movies and an HTTP status code.
+            - 200 with the movies, the next_cursor (null on the last page) and any facet counts.
+            - 400 if one of the parameters isn't valid.
+    """
+    # Example: /api/movies/search?genre=Action,Sci-Fi&year_from=2000&sort=-rating&limit=5&facets=decade,director
+    args = request.args
+    year = args.get("year", type=int)
+    sort = args.get("sort", "title")
+    facets = [facet.strip() for facet in args.get("facets", "").split(",") if facet.strip()]
+    try:
+        query = (
+            MovieQuery()
+            .with_genres(args.getlist("genre"))
+            .with_directors(args.getlist("director"))
+            .released_between(args.get("year_from", year, type=int), args.get("year_to", year, type=int))
+            .title_starts_with(args.get("title"))
+            .sort_by(sort.lstrip("-"), descending=sort.startswith("-"))
+            .limit(min(args.get("limit", 20, type=int), 100))
+            .after(args.get("cursor"))
+        )
+        result = services.search_movies(query, facets=facets)
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
+    return jsonify(result.to_dict()), 200
+
 @api_bp.route('/movies/<int:movie_id>', methods=['GET'])
 def lookup_movie_by_id(movie_id):
     """
@@ -204,9 +426,10 @@ def lookup_movie_by_id(movie_id):
             - If the movie is found, returns a JSON object with movie information and status code 200.
             - If the movie is not found, returns a JSON object with an error message and status code 404.
     """
-    movie = services.get_movie_by_id(movie_id)
+    fields = parse_fields(Movie.FIELDS)
+    movie = services.get_movie_by_id(movie_id, fields=fields)
     if movie:
-        return jsonify(movie.to_dict()), 200
+        return jsonify(movie.to_dict(fields)), 200
     return jsonify({'message': 'Movie not found'}), 404
 
 @api_bp.route('/movies/<int:movie_id>/ratings', methods=['GET'])
@@ -220,11 +443,13 @@ def lookup_ratings_for_movie(movie_id):
     Returns:
         tuple: A tuple containing a JSON response with all ratings for the movie and an HTTP status code.
     """
-    ratings = services.get_movie_ratings(movie_id)
+    # The fields parameter applies to the ratings, e.g. /api/movies/1/ratings?fields=user_id,rating
+    fields = parse_fields(Rating.FIELDS)
+    ratings = services.get_movie_ratings(movie_id, fields=fields)
     rating_list = ratings
     movie = services.get_movie_by_id(movie_id)
     movie.ratings = rating_list
-    return jsonify(movie.to_dict()), 200
+    return jsonify(movie.to_dict(rating_fields=fields)), 200
 
 
 @api_bp.route('/movies', methods=['POST'])
@@ -295,15 +520,175 @@ def add_new_rating():
     This function retrieves rating data from a JSON request, creates a new Rating object,
     and adds it to the system using the create_rating function.
 
+    If write-behind is turned on (RATING_WRITE_BEHIND in the app config), the rating is queued and saved
+    with other ratings in one transaction. Unless the query string parameter "wait" is "true", the response
+    is then sent straight away with a tracking ID for /ratings/pending/<tracking_id>.
+
     Returns:
         Response: A JSON response containing a success message and the added rating,
                   with a status code of 201 (Created).
+                  With write-behind: 202 (Accepted) with the tracking ID if not waiting, 503 if the queue
+                  is full, or 500 if the rating couldn't be saved.
+                  400 if the date isn't a date, or the user or movie doesn't exist.
     """
     new_rating_dict = request.get_json()
     new_rating = Rating.from_dict(new_rating_dict)
-    new_rating_id = services.create_rating(new_rating)
-    new_rating.rating_id = new_rating_id
-    return jsonify({'message': 'Rating added', 'rating': new_rating.to_dict()}), 201
+    # Dates are stored as YYYY-MM-DD, check the date before the rating is saved or queued
+    try:
+        new_rating.date = services.normalize_date(new_rating.date)
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
+    if not current_app.config.get("RATING_WRITE_BEHIND", False):
+        try:
+            new_rating_id = services.create_rating(new_rating)
+        except ValueError as error:
+            return jsonify({'message': str(error)}), 400
+        new_rating.rating_id = new_rating_id
+        return jsonify({'message': 'Rating added', 'rating': new_rating.to_dict()}), 201
+
+    # Example: /api/ratings?wait=true
+    try:
+        ticket = write_behind.get_writer().submit(new_rating)
+    except queue.Full:
+        response = jsonify({'message': 'Too many ratings waiting to be saved, try again shortly'})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    if request.args.get("wait", "false").lower() != "true":
+        return jsonify({'message': 'Rating accepted', **ticket.to_dict()}), 202
+    if not ticket.wait(timeout=current_app.config.get("RATING_WRITE_TIMEOUT", 10)):
+        # Still queued, the client can follow it up with the tracking ID
+        return jsonify({'message': 'Rating accepted', **ticket.to_dict()}), 202
+    if ticket.status == write_behind.FAILED:
+        return jsonify({'message': 'Rating could not be saved', **ticket.to_dict()}), 500
+    return jsonify({'message': 'Rating added', 'rating': new_rating.to_dict(), 'tracking_id': ticket.tracking_id}), 201
+
+@api_bp.route('/batch', methods=['POST'])
+def run_batch():
+    """
+    Run a list of create, update and delete operations as one transaction, with one commit.
+    Either every operation is saved or, if any of them fails, none are. See api/batch.py for the format.
+
+    Returns:
+        tuple: A tuple containing a JSON response and an HTTP status code.
+            - 200 with the result of each operation (its op, entity and ID).
+            - 400 with the index of the operation that failed, if the batch or an operation isn't valid.
+    """
+    body = request.get_json(silent=True) or {}
+    try:
+        results = batch.run_batch(body.get("operations") if isinstance(body, dict) else None)
+    except batch.BatchError as error:
+        return jsonify(error.to_dict()), 400
+    return jsonify({'message': 'Batch committed', 'results': results}), 200
+
+@api_bp.route('/ratings', methods=['GET'])
+def get_ratings():
+    """
+    Retrieve the ratings given within a range of dates, oldest first, a page at a time.
+    All of the query string parameters are optional:
+        from / to: the first and last dates to include, as YYYY-MM-DD
+        movie_id: only include ratings of this movie
+        limit: the page size (default 100, at most 1000)
+        cursor: the next_cursor from the previous page
+        fields: the rating fields to return
+
+    Returns:
+        tuple: A tuple containing a JSON response and an HTTP status code.
+            - 200 with the ratings and the next_cursor (null on the last page).
+            - 400 if one of the parameters isn't valid.
+    """
+    # Example: /api/ratings?from=2023-01-01&to=2023-01-31&movie_id=3
+    fields = parse_fields(Rating.FIELDS)
+    try:
+        ratings, next_cursor = services.get_ratings(
+            date_from=request.args.get("from"),
+            date_to=request.args.get("to"),
+            movie_id=request.args.get("movie_id", type=int),
+            limit=request.args.get("limit", 100, type=int),
+            cursor=request.args.get("cursor"),
+            fields=fields,
+        )
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
+    return jsonify({'ratings': [rating.to_dict(fields) for rating in ratings], 'next_cursor': next_cursor}), 200
+
+@api_bp.route('/ratings/rollup', methods=['GET'])
+def get_rating_rollup():
+    """
+    Count and average the ratings given each day or week.
+    All of the query string parameters are optional:
+        period: "day" (the default) or "week" (weeks start on Monday)
+        from / to: the first and last dates to include, as YYYY-MM-DD
+        movie_id: only include ratings of this movie
+
+    Returns:
+        tuple: A tuple containing a JSON response and an HTTP status code.
+            - 200 with a list of periods that have ratings, oldest first.
+            - 400 if one of the parameters isn't valid.
+    """
+    # Example: /api/ratings/rollup?period=week&from=2023-01-01&movie_id=3
+    try:
+        buckets = services.get_rating_rollup(
+            period=request.args.get("period", "day"),
+            date_from=request.args.get("from"),
+            date_to=request.args.get("to"),
+            movie_id=request.args.get("movie_id", type=int),
+        )
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
+    return jsonify([bucket.to_dict() for bucket in buckets]), 200
+
+@api_bp.route('/ratings/stream', methods=['GET'])
+def stream_ratings():
+    """
+    Send new and updated ratings as they are saved, as a stream of Server-Sent Events.
+    The query string parameters are optional:
+        movie_id: only send ratings of this movie
+        user_id: only send ratings by this user
+    A client that reconnects with a Last-Event-ID header (browsers do this by themselves) is first sent the
+    ratings it missed. Without a browser the same can be done with the last_event_id parameter. If it missed
+    too many, it is sent a "resync" event and the stream ends, so it can carry on from that event's id.
+
+    Returns:
+        Response: A text/event-stream response, or a JSON error message with status code 400 if
+        one of the parameters isn't valid.
+    """
+    # Example: /api/ratings/stream?movie_id=3
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try:
+        movie_id = int(request.args["movie_id"]) if "movie_id" in request.args else None
+        user_id = int(request.args["user_id"]) if "user_id" in request.args else None
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return jsonify({'message': 'movie_id, user_id and Last-Event-ID must be whole numbers'}), 400
+
+    stream = rating_stream.event_stream(
+        rating_stream.get_hub(), movie_id, user_id, last_event_id,
+        heartbeat=current_app.config.get("RATING_STREAM_HEARTBEAT", 15),
+        max_duration=current_app.config.get("RATING_STREAM_MAX_DURATION", 300),
+    )
+    response = Response(stream, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # Stop proxies such as nginx from holding the events back in a buffer
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+@api_bp.route('/ratings/pending/<tracking_id>', methods=['GET'])
+def lookup_pending_rating(tracking_id):
+    """
+    Check on a rating that was queued by the write-behind writer.
+
+    Args:
+        tracking_id (str): The tracking ID returned when the rating was added.
+
+    Returns:
+        tuple: A tuple containing a JSON response and an HTTP status code.
+            - The ticket's status ("pending", "committed" or "failed") and the rating, with status code 200.
+            - If the tracking ID isn't known (to this worker), a JSON object with an error message and status code 404.
+    """
+    ticket = write_behind.get_writer().get_ticket(tracking_id)
+    if ticket:
+        return jsonify(ticket.to_dict()), 200
+    return jsonify({'message': 'Tracking ID not found'}), 404
 
 @api_bp.route('/ratings/<int:rating_id>', methods=['PUT'])
 def update_existing_rating(rating_id):
@@ -319,14 +704,38 @@ def update_existing_rating(rating_id):
 
     Returns:
         Response: A JSON response containing a message and the updated rating object,
-                  along with an HTTP status code 200.
+                  along with an HTTP status code 200 (or 400 if the date isn't a date).
     """
     rating_dict = request.get_json()
     rating = Rating.from_dict(rating_dict)
     rating.rating_id = rating_id
-    services.update_rating(rating)
+    try:
+        services.update_rating(rating)
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
     return jsonify({'message': 'Rating updated', 'rating': rating.to_dict()}), 200
 
+@api_bp.route('/ratings', methods=['DELETE'])
+def remove_ratings():
+    """
+    Delete all of a movie's ratings, all of a user's ratings, or a user's ratings of a movie,
+    picked with the movie_id and user_id query string parameters.
+
+    Returns:
+        tuple: A tuple containing a JSON response and an HTTP status code.
+            - 200 with the number of ratings deleted.
+            - 400 if neither movie_id nor user_id is given.
+    """
+    # Example: /api/ratings?movie_id=3
+    try:
+        deleted = services.delete_ratings(
+            movie_id=request.args.get("movie_id", type=int),
+            user_id=request.args.get("user_id", type=int),
+        )
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
+    return jsonify({'message': 'Ratings deleted', 'deleted': deleted}), 200
+
 @api_bp.route('/ratings/<int:rating_id>', methods=['DELETE'])
 def remove_rating(rating_id):
     """
@@ -357,7 +766,186 @@ def lookup_rating_by_id(rating_id):
             - If the rating is found, returns a JSON object with rating information and status code 200.
             - If the rating is not found, returns a JSON object with an error message and status code 404.
     """
-    rating = services.get_rating_by_id(rating_id)
+    fields = parse_fields(Rating.FIELDS)
+    rating = services.get_rating_by_id(rating_id, fields=fields)
     if rating:
-        return jsonify(rating.to_dict()), 200
-    return jsonify({'message': 'Rating not found'}), 404
\ No newline at end of file
+        return jsonify(rating.to_dict(fields)), 200
+    return jsonify({'message': 'Rating not found'}), 404
+
+
+# ---------------------------------------------------------
+# Change feed
+# ---------------------------------------------------------
+@api_bp.route('/changes', methods=['GET'])
+def get_changes():
+    """
+    Retrieve the changes made to users, movies and ratings after a given sequence number, oldest first.
+    Consumers keep the next_since value from each response and pass it back as "since" to carry on from
+    where they left off.
+    The query string parameters are all optional:
+        since: the sequence number of the last change already seen (default 0, everything in the log)
+        limit: the most changes to return (default 100, at most 1000)
+        entity: only return changes to "user", "movie" or "rating" records
+
+    Returns:
+        tuple: A tuple containing a JSON response and an HTTP status code.
+            - 200 with the changes, next_since and has_more (true if there are more changes waiting).
+            - 400 if one of the parameters isn't valid.
+    """
+    # Example: /api/changes?since=120&limit=500
+    since = request.args.get("since", 0, type=int)
+    limit = request.args.get("limit", 100, type=int)
+    entity = request.args.get("entity")
+    if entity is not None and entity not in ("user", "movie", "rating"):
+        return jsonify({'message': 'entity must be one of: user, movie, rating'}), 400
+    try:
+        changes, has_more = services.get_changes_page(since=since, limit=limit, entity=entity)
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
+    return jsonify({
+        'changes': [change.to_dict() for change in changes],
+        'next_since': changes[-1].seq if changes else since,
+        'has_more': has_more,
+    }), 200
+
+# ---------------------------------------------------------
+# Analytics
+# ---------------------------------------------------------
+def get_analytics_engine():
+    # NumPy takes a while to import, so the analytics module is only loaded when it is first used
+    from api import analytics
+    return analytics.get_engine()
+
+@api_bp.route('/analytics/movies', methods=['GET'])
+def get_movie_analytics():
+    """
+    Retrieve the number of ratings and the average rating of each movie, highest average first.
+    The query string parameters are optional:
+        min_ratings: leave out movies with fewer ratings than this (default 1)
+        limit: the most movies to return (default 100, at most 1000)
+
+    Returns:
+        tuple: A tuple containing a JSON response and an HTTP status code.
+            - 200 with a list of movies and their averages.
+            - 400 if one of the parameters isn't valid.
+    """
+    # Example: /api/analytics/movies?min_ratings=3&limit=10
+    try:
+        averages = get_analytics_engine().movie_averages(
+            min_ratings=request.args.get("min_ratings", 1, type=int),
+            limit=request.args.get("limit", 100, type=int),
+        )
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
+    return jsonify(averages), 200
+
+@api_bp.route('/analytics/genres', methods=['GET'])
+def get_genre_analytics():
+    """
+    Retrieve the number of ratings and the average rating of the movies in each genre, highest average first.
+
+    Returns:
+        tuple: A tuple containing a JSON response with a list of genres and status code 200.
+    """
+    return jsonify(get_analytics_engine().genre_averages()), 200
+
+@api_bp.route('/analytics/years', methods=['GET'])
+def get_year_analytics():
+    """
+    Retrieve the number of ratings and the average rating of the movies released in each year, oldest first.
+
+    Returns:
+        tuple: A tuple containing a JSON response with a list of years and status code 200.
+    """
+    return jsonify(get_analytics_engine().year_averages()), 200
+
+@api_bp.route('/analytics/distribution', methods=['GET'])
+def get_rating_distribution():
+    """
+    Count how many times each rating has been given.
+    The query string parameters are optional:
+        movie_id: only count ratings of this movie
+        user_id: only count ratings by this user
+
+    Returns:
+        tuple: A tuple containing a JSON response with the counts keyed by rating (e.g. {"4": 12, "5": 3})
+        and status code 200.
+    """
+    # Example: /api/analytics/distribution?movie_id=3
+    distribution = get_analytics_engine().distribution(
+        movie_id=request.args.get("movie_id", type=int),
+        user_id=request.args.get("user_id", type=int),
+    )
+    return jsonify(distribution), 200
+
+@api_bp.route('/analytics/movies/<int:movie_id>/co-ratings', methods=['GET'])
+def get_co_ratings(movie_id):
+    """
+    Find the movies most often rated by the users who rated this movie.
+    The query string parameter is optional:
+        limit: the most movies to return (default 10, at most 1000)
+
+    Args:
+        movie_id (int): The unique identifier of the movie.
+
+    Returns:
+        tuple: A tuple containing a JSON response and an HTTP status code.
+            - 200 with the number of users who rated the movie and the other movies they rated, most first.
+            - 400 if the limit isn't valid.
+            - 404 if the movie doesn't exist.
+    """
+    # Example: /api/analytics/movies/3/co-ratings?limit=5
+    if services.get_movie_by_id(movie_id) is None:
+        return jsonify({'message': 'Movie not found'}), 404
+    try:
+        co_ratings = get_analytics_engine().co_ratings(movie_id, limit=request.args.get("limit", 10, type=int))
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
+    return jsonify(co_ratings), 200
+
+@api_bp.route('/analytics/status', methods=['GET'])
+def get_analytics_status():
+    """
+    Report how many ratings the analytics arrays hold, how much memory they use and how they were last refreshed.
+
+    Returns:
+        tuple: A tuple containing a JSON response and status code 200.
+    """
+    engine = get_analytics_engine()
+    engine.get_columns()
+    return jsonify(engine.stats()), 200
+
+# ---------------------------------------------------------
+# Export
+# ---------------------------------------------------------
+@api_bp.route('/export/<table>', methods=['GET'])
+def export_table(table):
+    """
+    Download a whole table, streamed a batch of rows at a time so that it never has to fit in memory.
+    The query string parameter is optional:
+        format: "ndjson" (one JSON object per line, the default) or "csv" (the same columns as load_data reads)
+
+    Args:
+        table (str): "movies", "users" or "ratings".
+
+    Returns:
+        Response: The streamed export. The X-Export-Change-Seq header is the last change included in it,
+        changes made since can be fetched from /api/changes?since=<that number>.
+        A JSON error message with status code 404 if the table can't be exported, or 400 if the format isn't valid.
+    """
+    # Example: /api/export/ratings?format=csv
+    export_format = request.args.get("format", "ndjson")
+    if table not in export.EXPORT_COLUMNS:
+        return jsonify({'message': f"Table {table} can't be exported"}), 404
+    if export_format not in export.EXPORT_FORMATS:
+        return jsonify({'message': f"format must be one of: {', '.join(export.EXPORT_FORMATS)}"}), 400
+
+    snapshot = export.ExportSnapshot()
+    content_type, extension = export.EXPORT_FORMATS[export_format]
+    response = Response(export.stream_table(snapshot, table, export_format), mimetype=content_type)
+    # The body may never be read (a HEAD request, or a client that goes away first), so the snapshot is
+    #  also closed along with the response
+    response.call_on_close(snapshot.close)
+    response.headers["Content-Disposition"] = f'attachment; filename="{table}.{extension}"'
+    response.headers["X-Export-Change-Seq"] = str(snapshot.change_seq)
+    return response
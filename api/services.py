@@ -1,8 +1,53 @@
+import itertools
+import json
+import os
+import random
 import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import date, datetime
 from typing import List
-from api.models import User, Rating, Movie
+from api.models import User, Rating, Movie, MovieScore, MovieSearchResult, UserStats, RatingBucket, Change
+from api.movie_query import MovieQuery, split_names, encode_cursor, decode_cursor
+from api.query_cache import QueryCache, ALL_TABLES, make_key, is_cacheable
+from api.shared_cache import SharedCache
+from api.single_flight import SingleFlight
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl, so the cross-process write lock isn't available there
+    fcntl = None
+
+DATABASE_FILE = Path(__file__).parents[1] / "data" / "movie_data.db"
+
+# The database is switched to write-ahead logging (WAL) the first time a process prepares it (see
+#  ensure_schema). Readers then see a consistent snapshot without holding up the writer, which is what lets
+#  an export (api/export.py) read from one read transaction for as long as the download takes. The journal
+#  mode is kept in the database file. MOVIE_DB_WAL=0 leaves the journal mode as it is.
+WAL_MODE = os.environ.get("MOVIE_DB_WAL", "1") == "1"
+
+# The derived tables (see ensure_schema) only need to be checked once per process
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+# Read replicas
+# Functions that only read (the get_* functions and SELECTs through run_query) use read-only connections.
+#  By default these are opened on the main database file. With READ_REPLICA_COUNT above zero they are
+#  opened on snapshot copies of it instead, so readers never wait on the writer's lock. A snapshot is
+#  refreshed from the main database with the sqlite3 backup API once it is older than
+#  READ_REPLICA_MAX_STALENESS seconds, which is how stale a read is allowed to be.
+# The settings can be given as environment variables or changed with configure_read_replicas().
+READ_REPLICA_COUNT = int(os.environ.get("MOVIE_DB_READ_REPLICAS", "0"))
+READ_REPLICA_MAX_STALENESS = float(os.environ.get("MOVIE_DB_REPLICA_MAX_STALENESS", "1.0"))
+READ_REPLICA_DIRECTORY = Path(os.environ.get("MOVIE_DB_REPLICA_DIR", DATABASE_FILE.parent / "replicas"))
+
+_replica_counter = itertools.count()
+_replica_refresh_lock = threading.Lock()
+
 def get_db_connection():
     """
     Establishes and returns a connection to the SQLite database.
@@ -13,14 +58,457 @@ def get_db_connection():
     Returns:
         sqlite3.Connection: A connection object to the SQLite database.
     """
-    DATABASE_PATH = Path(__file__).parents[1] / "data"
-    connection = sqlite3.connect(DATABASE_PATH/'movie_data.db')
+    connection = sqlite3.connect(DATABASE_FILE)
     connection.row_factory = sqlite3.Row  # This allows you to access columns by name
+    if not _schema_ready:
+        ensure_schema(connection)
+    # SQLite only enforces foreign keys on connections that ask for it (see "Referential integrity")
+    connection.execute("PRAGMA foreign_keys = ON")
     return connection
 
+def get_read_connection(use_replica: bool = True):
+    """
+    Returns a read-only connection for functions that don't change anything.
+
+    The connection is to one of the read replicas if they are turned on (see READ_REPLICA_COUNT),
+    otherwise it is to the main database file. Either way, trying to write through it raises an error.
+
+    Args:
+        use_replica (bool, optional): Set to False to always read the main database file, for readers that
+            must see every committed write straight away. Defaults to True.
+    Returns:
+        sqlite3.Connection: A read-only connection with sqlite3.Row as the row factory.
+    """
+    joined = _current_transaction()
+    if joined is not None:
+        # Inside a transaction, reads go through its connection so they see its uncommitted writes
+        return _TransactionConnection(joined.connection)
+    if not _schema_ready:
+        # Make sure the derived tables exist before anything tries to read them
+        get_db_connection().close()
+    database_file = DATABASE_FILE
+    if use_replica and READ_REPLICA_COUNT > 0:
+        database_file = get_read_replica(next(_replica_counter) % READ_REPLICA_COUNT)
+    # With a deadline, the connection's cursors raise QueryTimeoutError for the queries it cancels
+    factory = _DeadlineConnection if _current_deadline() is not None else sqlite3.Connection
+    connection = sqlite3.connect(f"{database_file.as_uri()}?mode=ro", uri=True, factory=factory)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA foreign_keys = ON")
+    _watch_deadline(connection)
+    return connection
+
+def configure_read_replicas(count: int = None, max_staleness: float = None, directory=None):
+    """
+    Change the read replica settings for this process.
+    Args:
+        count (int, optional): How many snapshot copies to spread reads over, 0 reads from the main database.
+        max_staleness (float, optional): How many seconds old a snapshot can be before it is refreshed.
+        directory (str or Path, optional): Where to keep the snapshot files.
+    """
+    global READ_REPLICA_COUNT, READ_REPLICA_MAX_STALENESS, READ_REPLICA_DIRECTORY
+    if count is not None:
+        READ_REPLICA_COUNT = count
+    if max_staleness is not None:
+        READ_REPLICA_MAX_STALENESS = max_staleness
+    if directory is not None:
+        READ_REPLICA_DIRECTORY = Path(directory)
+
+def get_read_replica(index: int) -> Path:
+    """
+    Find the snapshot file for a read replica, refreshing it first if it is too old.
+    Args:
+        index (int): Which replica to use.
+    Returns:
+        Path: The replica's database file.
+    """
+    replica_file = READ_REPLICA_DIRECTORY / f"{DATABASE_FILE.stem}.replica{index}.db"
+    try:
+        age = time.time() - replica_file.stat().st_mtime
+    except FileNotFoundError:
+        age = None
+    if age is None or age > READ_REPLICA_MAX_STALENESS:
+        # If another thread is already refreshing a replica we carry on with the snapshot we have,
+        #  unless there isn't one yet
+        if _replica_refresh_lock.acquire(blocking=age is None):
+            try:
+                refresh_read_replica(replica_file)
+            finally:
+                _replica_refresh_lock.release()
+    return replica_file
+
+def refresh_read_replica(replica_file: Path):
+    """
+    Copy the main database into a replica file.
+    The copy is written to a temporary file and then renamed over the replica, so connections that are
+    already reading the old snapshot carry on undisturbed (on any OS that allows replacing open files)
+    and new connections only ever see a complete snapshot.
+    Args:
+        replica_file (Path): The replica's database file.
+    """
+    replica_file.parent.mkdir(parents=True, exist_ok=True)
+    temporary_file = replica_file.with_name(f"{replica_file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    primary = get_db_connection()
+    snapshot = sqlite3.connect(temporary_file)
+    try:
+        primary.backup(snapshot)
+        # The copy keeps the main database's WAL mode, and a -wal file left beside the replica would be
+        #  applied to the next snapshot renamed over it
+        snapshot.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        snapshot.close()
+        primary.close()
+    os.replace(temporary_file, replica_file)
+
+def ensure_schema(conn):
+    """
+    Create any derived tables that are missing from the database and fill them from the base tables.
+
+    Derived tables (like the movie leaderboard) are maintained by the write functions in this module,
+    so a database that was built before they existed needs them backfilled once before it is used.
+
+    Args:
+        conn (sqlite3.Connection): An open connection to the database.
+    """
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        if WAL_MODE:
+            # This can't run inside a transaction, and once the database is in WAL mode it does nothing
+            conn.execute("PRAGMA journal_mode = WAL")
+        cursor = conn.cursor()
+        # BEGIN IMMEDIATE takes the write lock, so only one worker process builds the tables
+        cursor.execute("BEGIN IMMEDIATE")
+        existing = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'index')")}
+        # Rating dates are normalized once, when the index on them is first created
+        if "idx_ratings_date" not in existing:
+            _normalize_rating_dates(cursor)
+        for statement in CHANGE_LOG_DDL + BASE_TABLE_INDEXES:
+            cursor.execute(statement)
+        for table_names, statements, rebuild in DERIVED_TABLES:
+            for statement in statements:
+                cursor.execute(statement)
+            if not existing.issuperset(table_names):
+                rebuild(cursor)
+        # Databases created before the ratings table had foreign keys are migrated once
+        if not cursor.execute("SELECT * FROM pragma_foreign_key_list('ratings')").fetchall():
+            _add_rating_foreign_keys(cursor)
+        conn.commit()
+        _schema_ready = True
+        _invalidate_caches({ALL_TABLES})
+
+def rebuild_derived_tables(conn):
+    """
+    Rebuild every derived table from scratch, for instance after the base tables have been reloaded.
+
+    Args:
+        conn (sqlite3.Connection): An open connection to the database.
+    """
+    cursor = conn.cursor()
+    _normalize_rating_dates(cursor)
+    for statement in CHANGE_LOG_DDL + BASE_TABLE_INDEXES:
+        cursor.execute(statement)
+    for table_names, statements, rebuild in DERIVED_TABLES:
+        for table_name in table_names:
+            cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+        for statement in statements:
+            cursor.execute(statement)
+        rebuild(cursor)
+    # Anyone following the change log has to start again from the reloaded data
+    _log_change(cursor, "*", None, "reset")
+    conn.commit()
+    _invalidate_caches({ALL_TABLES})
+
+# Write coordination
+# SQLite allows one writer at a time. With several gunicorn workers, a write that finds another worker
+#  holding the lock used to fail straight away with "database is locked". Every write now goes through
+#  write_transaction(), which:
+#   - starts the transaction with BEGIN IMMEDIATE, so the write lock is taken up front rather than part way
+#     through (when SQLite can't wait for it and has to give up),
+#   - waits up to WRITE_BUSY_TIMEOUT seconds for the lock, then backs off for a random time (exponential
+#     backoff with jitter, so waiting workers don't all retry at once) and tries again, up to
+#     WRITE_RETRY_ATTEMPTS times before raising DatabaseBusyError,
+#   - optionally takes an exclusive lock on WRITE_LOCK_FILE first (MOVIE_DB_WRITE_FILE_LOCK=1), which queues
+#     writers from every process in the operating system instead of having them poll SQLite's lock.
+# How long writers wait for the lock is recorded, see get_write_stats().
+WRITE_BUSY_TIMEOUT = float(os.environ.get("MOVIE_DB_BUSY_TIMEOUT", "0.25"))
+WRITE_RETRY_ATTEMPTS = int(os.environ.get("MOVIE_DB_WRITE_RETRIES", "8"))
+WRITE_RETRY_BASE_DELAY = float(os.environ.get("MOVIE_DB_RETRY_BASE_DELAY", "0.01"))
+WRITE_RETRY_MAX_DELAY = float(os.environ.get("MOVIE_DB_RETRY_MAX_DELAY", "0.5"))
+WRITE_FILE_LOCK = os.environ.get("MOVIE_DB_WRITE_FILE_LOCK", "0") == "1" and fcntl is not None
+WRITE_LOCK_FILE = DATABASE_FILE.with_name(f"{DATABASE_FILE.name}.lock")
+
+# The SQLite result codes for a database that another connection is using
+SQLITE_BUSY = 5
+SQLITE_LOCKED = 6
+
+_write_stats_lock = threading.Lock()
+_write_stats = {
+    "transactions": 0,
+    "retries": 0,
+    "busy_failures": 0,
+    "total_lock_wait": 0.0,
+    "max_lock_wait": 0.0,
+}
+
+# Functions to call after each write transaction in this process commits, see add_commit_listener()
+_commit_listeners = []
+
+class DatabaseBusyError(sqlite3.OperationalError):
+    """
+    Raised when a write couldn't get the database's write lock after every retry.
+    """
+
+def is_busy_error(error: Exception) -> bool:
+    """
+    Check whether an error means that another connection has the database locked.
+    """
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    error_code = getattr(error, "sqlite_errorcode", None)
+    if error_code is not None:
+        return error_code & 0xFF in (SQLITE_BUSY, SQLITE_LOCKED)
+    message = str(error).lower()
+    return "locked" in message or "busy" in message
+
+def retry_while_busy(action, is_busy=is_busy_error):
+    """
+    Call a function, retrying with exponential backoff and jitter for as long as the database is busy.
+    Args:
+        action (callable): The function to call, with no arguments.
+        is_busy (callable, optional): Decides whether an exception is worth retrying.
+    Returns:
+        The function's return value.
+    Raises:
+        DatabaseBusyError: If the database was still busy after WRITE_RETRY_ATTEMPTS tries.
+    """
+    delay = WRITE_RETRY_BASE_DELAY
+    for attempt in range(1, WRITE_RETRY_ATTEMPTS + 1):
+        try:
+            return action()
+        except Exception as error:
+            if not is_busy(error):
+                raise
+            if attempt >= WRITE_RETRY_ATTEMPTS:
+                _record_write_stat("busy_failures", 1)
+                raise DatabaseBusyError(f"The database is busy, gave up after {attempt} attempts") from error
+        _record_write_stat("retries", 1)
+        time.sleep(random.uniform(0, delay))
+        delay = min(delay * 2, WRITE_RETRY_MAX_DELAY)
+
+# Units of work
+# Each write function runs in its own write_transaction(), so a client that creates a movie and then adds
+#  50 ratings to it makes 51 commits (each one waiting for the disk), and if it fails part way through the
+#  first few writes are already saved. transaction() groups any number of service calls into one:
+#
+#       with services.transaction():
+#           movie_id = services.create_movie(movie)
+#           for rating in ratings:
+#               services.create_rating(rating)
+#
+# Every write_transaction() started in the same thread while a transaction is open joins it instead of
+#  opening its own connection, so everything is committed once at the end, or rolled back if anything
+#  raises. A joined block runs inside a SAVEPOINT, so when it fails only its own changes are undone and the
+#  caller can choose to carry on. Reads made in the transaction (get_read_connection) use its connection,
+#  so they see its uncommitted writes. The commit listeners are only called for the final commit.
+# The transaction belongs to the thread that opened it; other threads (e.g. the write-behind writer) are
+#  not affected by it.
+_transaction_state = threading.local()
+
+class _Transaction:
+    def __init__(self, connection, cursor):
+        self.connection = connection
+        self.cursor = cursor
+        self.depth = 0
+
+class _TransactionConnection:
+    """
+    The connection of an open transaction, handed to a read function. The read function closes its
+    connection when it is done, which mustn't close the transaction's.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def close(self):
+        pass
+
+def _current_transaction():
+    return getattr(_transaction_state, "transaction", None)
+
+def transaction():
+    """
+    Run several service calls as one unit of work, with one connection and one commit.
+    Everything is rolled back if the block raises. Transactions can be nested, an inner one simply joins
+    the outer one.
+
+    Usage:
+        with services.transaction() as cursor:
+            services.create_movie(movie)
+            services.create_rating(rating)
+
+    Yields:
+        sqlite3.Cursor: A cursor on the transaction's connection.
+    Raises:
+        DatabaseBusyError: If the write lock couldn't be taken.
+    """
+    return write_transaction()
+
+@contextmanager
+def write_transaction():
+    """
+    Run a block of writes as one transaction that holds the write lock from the start.
+    The transaction is committed when the block finishes and rolled back if it raises.
+    If this thread already has a transaction open (see transaction()), the block joins it instead.
+
+    Usage:
+        with write_transaction() as cursor:
+            cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+
+    Yields:
+        sqlite3.Cursor: A cursor on a connection to the main database.
+    Raises:
+        DatabaseBusyError: If the write lock couldn't be taken.
+    """
+    joined = _current_transaction()
+    if joined is not None:
+        with _joined_transaction(joined) as cursor:
+            yield cursor
+        return
+    started = time.monotonic()
+    lock_file = _acquire_write_file_lock() if WRITE_FILE_LOCK else None
+    conn = None
+    try:
+        conn = get_db_connection()
+        conn.execute(f"PRAGMA busy_timeout = {int(WRITE_BUSY_TIMEOUT * 1000)}")
+        # Note the tables written to, so the query cache can drop what read them once this commits
+        written_tables = set()
+        conn.set_authorizer(_table_recorder(written_tables, WRITE_ACTIONS))
+        cursor = conn.cursor()
+        retry_while_busy(lambda: cursor.execute("BEGIN IMMEDIATE"))
+        _record_lock_wait(time.monotonic() - started)
+        _transaction_state.transaction = _Transaction(conn, cursor)
+        try:
+            yield cursor
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            _transaction_state.transaction = None
+        # The commit can still have to wait for readers to finish with the file
+        retry_while_busy(conn.commit)
+        _invalidate_caches(written_tables)
+        for listener in list(_commit_listeners):
+            listener()
+    finally:
+        if conn is not None:
+            conn.close()
+        if lock_file is not None:
+            _release_write_file_lock(lock_file)
+
+@contextmanager
+def _joined_transaction(joined: _Transaction):
+    joined.depth += 1
+    savepoint = f"joined_{joined.depth}"
+    joined.cursor.execute(f"SAVEPOINT {savepoint}")
+    try:
+        yield joined.cursor
+    except BaseException:
+        # Some errors make SQLite roll back the whole transaction, taking the savepoint with it
+        if joined.connection.in_transaction:
+            joined.cursor.execute(f"ROLLBACK TO {savepoint}")
+            joined.cursor.execute(f"RELEASE {savepoint}")
+        raise
+    else:
+        joined.cursor.execute(f"RELEASE {savepoint}")
+    finally:
+        joined.depth -= 1
+
+def _acquire_write_file_lock():
+    lock_file = open(WRITE_LOCK_FILE, "a")
+    try:
+        retry_while_busy(
+            lambda: fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB),
+            is_busy=lambda error: isinstance(error, BlockingIOError),
+        )
+    except BaseException:
+        lock_file.close()
+        raise
+    return lock_file
+
+def _release_write_file_lock(lock_file):
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    finally:
+        lock_file.close()
+
+def _record_write_stat(name: str, amount):
+    with _write_stats_lock:
+        _write_stats[name] += amount
+
+def _record_lock_wait(seconds: float):
+    with _write_stats_lock:
+        _write_stats["transactions"] += 1
+        _write_stats["total_lock_wait"] += seconds
+        _write_stats["max_lock_wait"] = max(_write_stats["max_lock_wait"], seconds)
+
+def get_write_stats() -> dict:
+    """
+    Report how much the writers in this process have had to wait for the write lock.
+    Returns:
+        dict: The number of write transactions, retries and writes that gave up, and the total,
+        average and longest wait for the lock in seconds.
+    """
+    with _write_stats_lock:
+        stats = dict(_write_stats)
+    stats["average_lock_wait"] = stats["total_lock_wait"] / stats["transactions"] if stats["transactions"] else None
+    return stats
+
+def reset_write_stats():
+    with _write_stats_lock:
+        for name in _write_stats:
+            _write_stats[name] = 0
+
+def add_commit_listener(listener):
+    """
+    Call a function after every write transaction in this process commits.
+    The function is called with no arguments, in the thread that made the write, so it should only do
+    something quick such as waking up another thread.
+    """
+    if listener not in _commit_listeners:
+        _commit_listeners.append(listener)
+
+def remove_commit_listener(listener):
+    if listener in _commit_listeners:
+        _commit_listeners.remove(listener)
+
+def reset_after_fork():
+    """
+    Give a newly forked worker process its own locks and counters.
+    A lock that one of the parent's threads held at the moment of the fork would stay locked in the child
+    forever, and the write stats should only count the worker's own writes.
+    """
+    global _schema_lock, _replica_refresh_lock, _replica_counter, _write_stats_lock, _cancelled_lock
+    _schema_lock = threading.Lock()
+    _replica_refresh_lock = threading.Lock()
+    _replica_counter = itertools.count()
+    _write_stats_lock = threading.Lock()
+    _cancelled_lock = threading.Lock()
+    reset_write_stats()
+    reset_cancelled_queries()
+    query_cache.reset()
+    single_flight.reset()
+    if shared_cache is not None:
+        shared_cache.reset()
+
 def run_query(query, params=None):
     """
     Run a query on the database and return the results.
+    Queries that only read (see is_read_only) run on a read-only connection (which may be a read replica),
+    anything else runs on the main database and is committed.
 
     Args:
         query (str): The SQL query to be executed.
@@ -29,15 +517,450 @@ def run_query(query, params=None):
     Returns:
         list of dict: A list of dictionaries representing the query results.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    if params is not None:
-        cursor.execute(query, params)
+    if not is_read_only(query, params):
+        with write_transaction() as cursor:
+            cursor.execute(query, params if params is not None else ())
+            return cursor.fetchall()
+
+    def read(cursor):
+        cursor.execute(query, params if params is not None else ())
+        return tuple(cursor.fetchall())
+
+    if not is_cacheable(query):
+        return list(_cached_read("run_query", None, read))
+    return list(_cached_read("run_query", make_key(query, params), read))
+
+def is_read_only(query, params=None) -> bool:
+    """
+    Decide whether a query only reads. A WITH clause can lead into an INSERT, UPDATE or DELETE, so those
+    are prepared (not run) with an authorizer that notes whether the statement would change any table.
+    Inside a transaction nothing counts as read-only, so the query runs on the transaction's connection.
+    """
+    statement = query.lstrip().upper()
+    if _current_transaction() is not None or not statement.startswith(("SELECT", "WITH")):
+        return False
+    if statement.startswith("SELECT"):
+        return True
+    if not _schema_ready:
+        get_db_connection().close()
+    written_tables = set()
+    conn = sqlite3.connect(f"{DATABASE_FILE.as_uri()}?mode=ro", uri=True)
+    try:
+        conn.set_authorizer(_table_recorder(written_tables, WRITE_ACTIONS))
+        # EXPLAIN prepares the statement without running it
+        conn.execute(f"EXPLAIN {query}", params if params is not None else ())
+    finally:
+        conn.close()
+    return not written_tables
+
+# ---------------------------------------------------------
+# Request deadlines
+# A request can be given a deadline (routes.py gives every request one, see REQUEST_DEADLINE), and a query
+#  it is running on a read connection when the deadline passes is cancelled. SQLite calls a progress
+#  handler every DEADLINE_CHECK_STEPS steps of a query, and once the time is up the handler tells it to
+#  stop. The query then raises QueryTimeoutError (rather than SQLite's own "interrupted" error, see
+#  _DeadlineCursor) and the routes answer with 504.
+#  Without this, one pathological search (say a "contains" search over a huge users table) can keep a
+#  worker thread busy for as long as it takes.
+# Only reads are cancelled. Writes only hold the write lock briefly, and a write cut short part way through
+#  would just be rolled back and retried by the client, so there is nothing to gain.
+# Each cancelled query is recorded with its SQL, see get_cancelled_queries().
+DEADLINE_CHECK_STEPS = 1000
+
+# How many of the most recently cancelled queries are kept
+CANCELLED_QUERY_HISTORY = 100
+
+_deadline_state = threading.local()
+_cancelled_queries = deque(maxlen=CANCELLED_QUERY_HISTORY)
+_cancelled_lock = threading.Lock()
+_cancelled_count = 0
+
+class QueryTimeoutError(sqlite3.OperationalError):
+    """
+    Raised when a query is cancelled because the deadline of the request that ran it has passed.
+    """
+
+class _Deadline:
+    def __init__(self, seconds: float, name: str):
+        self.seconds = seconds
+        self.name = name
+        self.started = time.monotonic()
+        self.expires = self.started + seconds
+        # The statement running now, counted so that each cancelled statement is recorded once
+        self.statement = None
+        self.statements = 0
+        self.recorded = 0
+        self.cancelled = False
+
+def set_deadline(seconds: float, name: str = None):
+    """
+    Cancel the queries this thread runs on read connections opened from now on, once the time is up.
+    Args:
+        seconds (float): How many seconds from now the deadline is, None for no deadline.
+        name (str, optional): What the deadline is for (e.g. the endpoint), recorded with cancelled queries.
+    """
+    _deadline_state.deadline = _Deadline(seconds, name) if seconds is not None else None
+
+def clear_deadline():
+    _deadline_state.deadline = None
+
+def _current_deadline():
+    return getattr(_deadline_state, "deadline", None)
+
+def is_query_timeout(error: Exception) -> bool:
+    """
+    Check whether an error means that a query was cancelled because its deadline passed.
+    """
+    if isinstance(error, QueryTimeoutError):
+        return True
+    deadline = _current_deadline()
+    return (
+        isinstance(error, sqlite3.OperationalError) and deadline is not None and deadline.cancelled
+        and "interrupted" in str(error)
+    )
+
+class _DeadlineCursor(sqlite3.Cursor):
+    """
+    A cursor that raises QueryTimeoutError when its query is cancelled because the deadline passed.
+    SQLite can stop a query while it is being run or while its rows are fetched, so both are covered.
+    """
+
+    def execute(self, *args):
+        try:
+            return super().execute(*args)
+        except sqlite3.OperationalError as error:
+            _raise_if_timeout(error)
+            raise
+
+    def executemany(self, *args):
+        try:
+            return super().executemany(*args)
+        except sqlite3.OperationalError as error:
+            _raise_if_timeout(error)
+            raise
+
+    def fetchone(self):
+        try:
+            return super().fetchone()
+        except sqlite3.OperationalError as error:
+            _raise_if_timeout(error)
+            raise
+
+    def fetchmany(self, *args):
+        try:
+            return super().fetchmany(*args)
+        except sqlite3.OperationalError as error:
+            _raise_if_timeout(error)
+            raise
+
+    def fetchall(self):
+        try:
+            return super().fetchall()
+        except sqlite3.OperationalError as error:
+            _raise_if_timeout(error)
+            raise
+
+    def __next__(self):
+        try:
+            return super().__next__()
+        except sqlite3.OperationalError as error:
+            _raise_if_timeout(error)
+            raise
+
+class _DeadlineConnection(sqlite3.Connection):
+    def cursor(self, factory=_DeadlineCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+def _raise_if_timeout(error: sqlite3.OperationalError):
+    if not isinstance(error, QueryTimeoutError) and is_query_timeout(error):
+        raise QueryTimeoutError(str(error)) from error
+
+def _watch_deadline(connection):
+    """
+    Have SQLite stop this connection's queries once the current thread's deadline (if it has one) passes.
+    """
+    deadline = _current_deadline()
+    if deadline is None:
+        return
+
+    def trace(statement):
+        deadline.statement = statement
+        deadline.statements += 1
+
+    def check():
+        if time.monotonic() < deadline.expires:
+            return 0
+        deadline.cancelled = True
+        if deadline.recorded != deadline.statements:
+            deadline.recorded = deadline.statements
+            _record_cancelled_query(deadline)
+        # Anything but 0 interrupts the query
+        return 1
+
+    connection.set_trace_callback(trace)
+    connection.set_progress_handler(check, DEADLINE_CHECK_STEPS)
+
+def _record_cancelled_query(deadline: _Deadline):
+    global _cancelled_count
+    with _cancelled_lock:
+        _cancelled_count += 1
+        _cancelled_queries.append({
+            "name": deadline.name,
+            "sql": (deadline.statement or "")[:1000],
+            "deadline": deadline.seconds,
+            "elapsed": round(time.monotonic() - deadline.started, 3),
+            "cancelled_at": datetime.now().isoformat(timespec="seconds"),
+        })
+
+def get_cancelled_queries() -> dict:
+    """
+    Report the queries that were cancelled because their deadline passed, in this process.
+    Returns:
+        dict: How many queries have been cancelled, and the most recent of them (newest first) with the
+        request they were for, their SQL, the deadline and how long the request had been running.
+    """
+    with _cancelled_lock:
+        return {"cancelled": _cancelled_count, "recent": list(reversed(_cancelled_queries))}
+
+def reset_cancelled_queries():
+    global _cancelled_count
+    with _cancelled_lock:
+        _cancelled_count = 0
+        _cancelled_queries.clear()
+
+# ---------------------------------------------------------
+# Query result cache
+# ---------------------------------------------------------
+# run_query (for SELECTs) and the movie list and search functions keep their results in query_cache (see
+#  api/query_cache.py), so a repeated query is answered without touching the database. A result is dropped
+#  when a write transaction in this process commits a change to any table it read, or once it is older than
+#  QUERY_CACHE_MAX_AGE seconds, which is how long a write made by another process can take to show up.
+# QUERY_CACHE_BYTES is the memory budget for the results, 0 turns the cache off.
+QUERY_CACHE_BYTES = int(os.environ.get("MOVIE_DB_QUERY_CACHE_BYTES", str(16 * 1024 * 1024)))
+QUERY_CACHE_MAX_AGE = float(os.environ.get("MOVIE_DB_QUERY_CACHE_MAX_AGE", "1.0"))
+
+# With MOVIE_DB_SHARED_CACHE=1 (which gunicorn.conf.py sets) the results are also kept in shared_cache, a
+#  memory-mapped file that every worker uses (see api/shared_cache.py), so a result read by one worker is
+#  there for all of them. Every commit moves on the shared generations of the tables it wrote, so each
+#  worker stops using what a write changed as soon as it commits, in its own query_cache too; results then
+#  don't need QUERY_CACHE_MAX_AGE.
+SHARED_CACHE = os.environ.get("MOVIE_DB_SHARED_CACHE", "0") == "1" and fcntl is not None
+SHARED_CACHE_FILE = Path(os.environ.get("MOVIE_DB_SHARED_CACHE_FILE", DATABASE_FILE.with_name(f"{DATABASE_FILE.name}.cache")))
+SHARED_CACHE_SLOTS = int(os.environ.get("MOVIE_DB_SHARED_CACHE_SLOTS", "2048"))
+SHARED_CACHE_SLOT_SIZE = int(os.environ.get("MOVIE_DB_SHARED_CACHE_SLOT_SIZE", "8192"))
+
+shared_cache = SharedCache(SHARED_CACHE_FILE, SHARED_CACHE_SLOTS, SHARED_CACHE_SLOT_SIZE) if SHARED_CACHE else None
+query_cache = QueryCache(
+    QUERY_CACHE_BYTES, QUERY_CACHE_MAX_AGE if shared_cache is None else None, generations=shared_cache
+)
+
+# Concurrent calls for the same result that isn't cached share one read of the database (see
+#  api/single_flight.py), so a burst of requests for a popular page right after a write has invalidated it
+#  runs its queries once rather than once per request. MOVIE_DB_SINGLE_FLIGHT=0 turns this off.
+SINGLE_FLIGHT = os.environ.get("MOVIE_DB_SINGLE_FLIGHT", "1") == "1"
+
+single_flight = SingleFlight()
+
+def _invalidate_caches(tables):
+    query_cache.invalidate(tables)
+    # Reads that started before this write mustn't be shared with the callers that come after it
+    single_flight.forget()
+    if shared_cache is not None:
+        shared_cache.invalidate(tables)
+
+# What SQLite's authorizer reports for a statement that reads a table, and for one that changes one
+READ_ACTIONS = {sqlite3.SQLITE_READ}
+WRITE_ACTIONS = {sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE, sqlite3.SQLITE_DELETE}
+SCHEMA_ACTIONS = {sqlite3.SQLITE_CREATE_TABLE, sqlite3.SQLITE_DROP_TABLE, sqlite3.SQLITE_ALTER_TABLE}
+
+def _table_recorder(tables: set, actions):
+    """
+    Make an authorizer for sqlite3.Connection.set_authorizer that adds the tables a statement uses to a set.
+    SQLite calls it for every table (and column) a statement touches while the statement is prepared,
+    including tables read through subqueries and changed by ON DELETE CASCADE. It allows everything.
+    """
+    def record(action, first, second, database, trigger):
+        if action in actions and first:
+            tables.add(first)
+        elif action in SCHEMA_ACTIONS:
+            tables.add(ALL_TABLES)
+        return sqlite3.SQLITE_OK
+    return record
+
+def _cached_read(name: str, key, read):
+    """
+    Run a read through the query cache. If the result isn't cached and the same read is already running
+    in another thread, wait for that one and share its result.
+    Args:
+        name (str): What the read is for, to report the cache's hit ratios by.
+        key (tuple): The cache key from make_key(), or None to skip the cache.
+        read (callable): Runs the read on the cursor it is given and returns the result. The result is
+            shared by every caller that gets it from the cache or waited for it, so it must be a tuple (or
+            otherwise not be changed).
+    Returns:
+        The result of read().
+    """
+    # Inside a transaction the read might see its uncommitted writes, which mustn't be shared
+    if key is None or _current_transaction() is not None or not (query_cache.enabled or SINGLE_FLIGHT):
+        conn = get_read_connection()
+        try:
+            return read(conn.cursor())
+        finally:
+            conn.close()
+
+    if query_cache.enabled:
+        result = query_cache.get(key, name)
+        if result is not None:
+            return result
+    if SINGLE_FLIGHT:
+        try:
+            return single_flight.do(key, lambda: _read_through(name, key, read), name)
+        except QueryTimeoutError:
+            deadline = _current_deadline()
+            if deadline is not None and deadline.cancelled:
+                raise
+            # It was the deadline of the request that ran the read which passed, not this one's, so run the
+            #  read again with the time this request has left
+            return _read_through(name, key, read)
+    return _read_through(name, key, read)
+
+def _read_through(name: str, key, read):
+    """
+    Read a result that isn't in this worker's query cache, from the shared cache or the database, and
+    cache it.
+    """
+    if not query_cache.enabled:
+        return _run_read(get_read_connection(), read)
+    if not _schema_ready:
+        get_db_connection().close()
+    # Taken before looking anything up, so a write that commits from here on stops the result being kept
+    started = query_cache.start_read()
+    if shared_cache is not None:
+        shared = shared_cache.get(key)
+        if shared is not None:
+            tables, result = shared
+            query_cache.put(key, result, tables, started, name)
+            return result
+
+    tables = set()
+    # Not a read replica, which could be behind a write that has already invalidated the cache
+    conn = get_read_connection(use_replica=False)
+    conn.set_authorizer(_table_recorder(tables, READ_ACTIONS))
+    result = _run_read(conn, read)
+    query_cache.put(key, result, tables, started, name)
+    if shared_cache is not None:
+        shared_cache.put(key, result, tables, started[1])
+    return result
+
+def _run_read(conn, read):
+    """
+    Run a read on a connection and close it.
+    """
+    try:
+        return read(conn.cursor())
+    finally:
+        conn.close()
+
+def get_query_cache_stats() -> dict:
+    """
+    Report how well the query cache is doing.
+    Returns:
+        dict: The number of cached results and the memory they use, and the hits, misses and hit ratio
+        overall and for each kind of query, the same for the shared cache (None if it is off), and how
+        many reads were shared by concurrent callers (see get_single_flight_stats).
+    """
+    stats = query_cache.stats()
+    stats["shared"] = shared_cache.stats() if shared_cache is not None else None
+    stats["single_flight"] = get_single_flight_stats()
+    return stats
+
+def get_single_flight_stats() -> dict:
+    """
+    Report how many reads were shared by concurrent identical calls.
+    Returns:
+        dict: Overall and for each kind of read: the calls that missed the query cache, how many of them
+        read the database and how many waited for another call's read instead (coalesced), and the most
+        callers that shared one read. None if single flight is off.
+    """
+    if not SINGLE_FLIGHT:
+        return None
+    return single_flight.stats()
+
+# The column behind each model field. Read functions take an optional list of fields and only SELECT
+#  the columns for those (plus the ID), so narrow clients don't pay to load columns they throw away.
+USER_COLUMNS = {"id": "user_id", "username": "username", "email": "email", "date_joined": "date_joined"}
+MOVIE_COLUMNS = {field: field for field in Movie.FIELDS}
+RATING_COLUMNS = {field: field for field in Rating.FIELDS}
+
+# The fields that are loaded when the caller doesn't ask for specific ones
+DEFAULT_USER_FIELDS = ("id", "username", "email")
+
+def select_list(columns: dict, fields=None, id_field: str = None, default_fields=None) -> str:
+    """
+    Build the column list for a SELECT from a list of model fields.
+    Args:
+        columns (dict): The column behind each field, e.g. USER_COLUMNS.
+        fields (list of str, optional): The fields to load. Defaults to default_fields.
+        id_field (str, optional): A field that is always loaded, e.g. the ID that rows are looked up by.
+        default_fields (list of str, optional): The fields to load if none are given. Defaults to all of them.
+    Returns:
+        str: The columns separated by commas, e.g. "user_id,username".
+    Raises:
+        ValueError: If one of the fields isn't recognised.
+    """
+    if fields is None:
+        fields = default_fields or list(columns)
+    unknown_fields = [field for field in fields if field not in columns]
+    if unknown_fields:
+        raise ValueError(f"Unknown fields: {', '.join(unknown_fields)}")
+    if id_field is not None and id_field not in fields:
+        fields = [id_field] + list(fields)
+    return ",".join(columns[field] for field in fields)
+
+def row_value(row, column: str):
+    """
+    Get a column from a row, or None if the query didn't select that column.
+    """
+    return row[column] if column in row.keys() else None
+
+# Batch lookups by ID use "IN (?, ?, ...)" in chunks small enough to stay well under SQLite's limit on
+#  the number of parameters in one statement. Past TEMP_TABLE_ID_THRESHOLD IDs it is cheaper to load
+#  them all into a temporary table and join against it in a single statement.
+ID_CHUNK_SIZE = 500
+TEMP_TABLE_ID_THRESHOLD = 5000
+
+def fetch_rows_by_ids(cursor, query: str, id_column: str, ids) -> dict:
+    """
+    Run a query for a list of IDs on an existing cursor, however long the list is.
+    Args:
+        cursor (sqlite3.Cursor): The cursor to run the queries on.
+        query (str): A SELECT with no WHERE clause, e.g. "SELECT user_id, username, email FROM users".
+        id_column (str): The column that holds the IDs.
+        ids (list of int): The IDs to look up, without duplicates.
+    Returns:
+        dict: The rows that were found, keyed by ID.
+    """
+    rows = []
+    if len(ids) > TEMP_TABLE_ID_THRESHOLD:
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS requested_ids (id INTEGER PRIMARY KEY)")
+        cursor.execute("DELETE FROM requested_ids")
+        cursor.executemany("INSERT INTO requested_ids (id) VALUES (?)", ((id,) for id in ids))
+        cursor.execute(f"{query} WHERE {id_column} IN (SELECT id FROM requested_ids)")
+        rows = cursor.fetchall()
+        cursor.execute("DELETE FROM requested_ids")
     else:
-        cursor.execute(query)
-    results = cursor.fetchall()
-    conn.close()
-    return results
+        for start in range(0, len(ids), ID_CHUNK_SIZE):
+            chunk = ids[start:start + ID_CHUNK_SIZE]
+            placeholders = ", ".join("?" for _ in chunk)
+            cursor.execute(f"{query} WHERE {id_column} IN ({placeholders})", chunk)
+            rows.extend(cursor.fetchall())
+    return {row[id_column]: row for row in rows}
 
 # ---------------------------------------------------------
 # Users
@@ -57,26 +980,30 @@ def convert_rows_to_user_list(users):
     # If nothing was passed in, return an empty list
     if users is None:
         return all_users
-    for user in users:
-        user = User(user["user_id"], user["username"], user["email"])
+    for row in users:
+        # Any column that wasn't selected is left as None
+        user = User(row_value(row, "user_id"), row_value(row, "username"), row_value(row, "email"))
+        user.date_joined = row_value(row, "date_joined")
         all_users.append(user)
     return all_users
 
 
-def get_all_users() -> List[User]:
+def get_all_users(fields=None) -> List[User]:
     """
     Retrieve all users from the database.
     This function establishes a connection to the database, executes a query to
     fetch all users, and converts the result into a list of User objects.
+    Args:
+        fields (list of str, optional): Only load these fields of each user. Defaults to all of them.
     Returns:
         List[User]: A list of User objects representing all users in the database.
     """
     # We need to start by getting the connection to the database
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     
     # Query the database for all users
-    query = "SELECT user_id,username,email  FROM users"
+    query = f"SELECT {select_list(USER_COLUMNS, fields, 'id', DEFAULT_USER_FIELDS)} FROM users"
     cursor.execute(query)
     
     users = cursor.fetchall()
@@ -86,28 +1013,27 @@ def get_all_users() -> List[User]:
     return convert_rows_to_user_list(users)
 
 
-def get_user_by_id(user_id: int) -> User:
+def get_user_by_id(user_id: int, fields=None) -> User:
     """
     Retrieve a user from the database by their user ID.
     Args:
         user_id (int): The ID of the user to retrieve.
+        fields (list of str, optional): Only load these fields of the user. Defaults to all of them.
     Returns:
         User: The User object corresponding to the given user ID.
     Raises:
         Exception: If there is an issue with the database connection or query execution.
     """
-    # We need to start by getting the connection to the database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Query the database for all users
-    query = "SELECT user_id,username,email FROM users WHERE user_id = ?"
-    # We need to pass the user_id as a tuple to be the parameters of the query
-    cursor.execute(query, (user_id,))
-    
-    users = cursor.fetchall()
-    conn.close()
-    
+    query = f"SELECT {select_list(USER_COLUMNS, fields, 'id', DEFAULT_USER_FIELDS)} FROM users WHERE user_id = ?"
+
+    def read(cursor):
+        # We need to pass the user_id as a tuple to be the parameters of the query
+        cursor.execute(query, (user_id,))
+        return tuple(cursor.fetchall())
+
+    # Single users are cached like the list queries, so the most viewed profiles are shared by every worker
+    users = _cached_read("get_user_by_id", make_key(query, (user_id,)), read)
+
     # Convert this list of users into a list of User objects, but only take the first object
     #  realy there should only ever be one or zero, but we will take the first one in case there are more
     user_list = convert_rows_to_user_list(users)
@@ -115,7 +1041,28 @@ def get_user_by_id(user_id: int) -> User:
         return None
     return user_list[0]
 
-def get_users_by_name(username: str, starts_with: bool =True) -> List[User]:
+def get_users_by_ids(user_ids, fields=None):
+    """
+    Retrieve any number of users by their IDs, using one connection for all of them.
+    Args:
+        user_ids (list of int): The IDs of the users to retrieve. Duplicates are only looked up once.
+        fields (list of str, optional): Only load these fields of each user. Defaults to all of them.
+    Returns:
+        tuple: A list of the User objects that were found, in the order their IDs were given,
+               and a list of the IDs that weren't found.
+    """
+    user_ids = list(dict.fromkeys(user_ids))  # Remove duplicates but keep the order
+    conn = get_read_connection()
+    cursor = conn.cursor()
+    query = f"SELECT {select_list(USER_COLUMNS, fields, 'id', DEFAULT_USER_FIELDS)} FROM users"
+    rows = fetch_rows_by_ids(cursor, query, "user_id", user_ids)
+    conn.close()
+
+    users = convert_rows_to_user_list([rows[user_id] for user_id in user_ids if user_id in rows])
+    missing_ids = [user_id for user_id in user_ids if user_id not in rows]
+    return users, missing_ids
+
+def get_users_by_name(username: str, starts_with: bool =True, fields=None) -> List[User]:
     """
     Retrieve a list of users from the database whose usernames match the given pattern.
     Args:
@@ -123,15 +1070,16 @@ def get_users_by_name(username: str, starts_with: bool =True) -> List[User]:
         starts_with (bool, optional): If True, search for usernames that start with the given user_name.
                                         If False, search for usernames that contain the given user_name.
                                         Defaults to True.
+        fields (list of str, optional): Only load these fields of each user. Defaults to all of them.
     Returns:
         List[User]: A list of User objects that match the search criteria.
     """
     # We need to start by getting the connection to the database
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     
     # Query the database for all users
-    query = "SELECT user_id,username,email FROM users WHERE username like ?"
+    query = f"SELECT {select_list(USER_COLUMNS, fields, 'id', DEFAULT_USER_FIELDS)} FROM users WHERE username like ?"
     
     # We use the % symbol as a wildcard to match any characters before or after the user_name
     params = f'{username}%' if starts_with else f'%{username}%'
@@ -152,16 +1100,12 @@ def create_user(user: User) -> int:
     Returns:
         int: The ID of the newly created user.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    query = "INSERT INTO users (username, email) VALUES (?, ?)"
-    cursor.execute(query, (user.username, user.email))
-    # Get the ID of the newly created user
-    user_id = cursor.lastrowid
-    
-    conn.commit()
-    conn.close()
+    with write_transaction() as cursor:
+        query = "INSERT INTO users (username, email) VALUES (?, ?)"
+        cursor.execute(query, (user.username, user.email))
+        # Get the ID of the newly created user
+        user_id = cursor.lastrowid
+        _log_change(cursor, "user", user_id, "create", {"id": user_id, "username": user.username, "email": user.email})
     return user_id
 
 # Update a user in the database
@@ -176,14 +1120,11 @@ def update_user(user: User):
     Returns:
         None
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    query = "UPDATE users SET username = ?, email = ? WHERE user_id = ?"
-    cursor.execute(query, (user.username, user.email, user.id))
-    
-    conn.commit()
-    conn.close()
+    with write_transaction() as cursor:
+        query = "UPDATE users SET username = ?, email = ? WHERE user_id = ?"
+        cursor.execute(query, (user.username, user.email, user.id))
+        if cursor.rowcount > 0:
+            _log_change(cursor, "user", user.id, "update", {"id": user.id, "username": user.username, "email": user.email})
 
 # Delete a user from the database
 def delete_user(user_id: int):
@@ -194,14 +1135,14 @@ def delete_user(user_id: int):
     Returns:
         None
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    query = "DELETE FROM users WHERE user_id = ?"
-    cursor.execute(query, (user_id,))
-
-    conn.commit()
-    conn.close()
+    with write_transaction() as cursor:
+        # The user's ratings go first, so they can be taken out of the derived tables
+        _delete_ratings(cursor, "r.user_id = ?", (user_id,))
+        query = "DELETE FROM users WHERE user_id = ?"
+        cursor.execute(query, (user_id,))
+        if cursor.rowcount > 0:
+            _log_change(cursor, "user", user_id, "delete")
+        cursor.execute("DELETE FROM user_rating_stats WHERE user_id = ?", (user_id,))
 
 
 # ---------------------------------------------------------
@@ -224,12 +1165,13 @@ def convert_rows_to_movie_list(movies):
         return all_movies
 
     for movie in movies:
+        # Any column that wasn't selected is left as None
         movie = Movie(
-            movie["movie_id"],
-            movie["title"],
-            movie["genre"],
-            movie["release_year"],
-            movie["director"],
+            row_value(movie, "movie_id"),
+            row_value(movie, "title"),
+            row_value(movie, "genre"),
+            row_value(movie, "release_year"),
+            row_value(movie, "director"),
         )
         all_movies.append(movie)
     return all_movies
@@ -242,15 +1184,12 @@ def create_movie(movie: Movie) -> int:
     Returns:
         int: The ID of the newly created movie.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    query = "INSERT INTO movies (title, genre, release_year, director) VALUES (?, ?, ?, ?)"
-    cursor.execute(query, (movie.title, movie.genre, movie.release_year, movie.director))
-    movie_id = cursor.lastrowid
-
-    conn.commit()
-    conn.close()
+    with write_transaction() as cursor:
+        query = "INSERT INTO movies (title, genre, release_year, director) VALUES (?, ?, ?, ?)"
+        cursor.execute(query, (movie.title, movie.genre, movie.release_year, movie.director))
+        movie_id = cursor.lastrowid
+        _index_movie_names(cursor, movie_id, movie.genre, movie.director)
+        _log_change(cursor, "movie", movie_id, "create", {**movie.to_dict(), "movie_id": movie_id})
 
     return movie_id
 
@@ -263,17 +1202,21 @@ def update_movie(movie: Movie):
     Returns:
         None
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    query = "UPDATE movies SET title = ?, genre = ?, release_year = ?, director = ? WHERE movie_id = ?"
-    cursor.execute(
-        query,
-        (movie.title, movie.genre, movie.release_year, movie.director, movie.movie_id),
-    )
-
-    conn.commit()
-    conn.close()
+    with write_transaction() as cursor:
+        query = "UPDATE movies SET title = ?, genre = ?, release_year = ?, director = ? WHERE movie_id = ?"
+        cursor.execute(
+            query,
+            (movie.title, movie.genre, movie.release_year, movie.director, movie.movie_id),
+        )
+        # A movie that doesn't exist mustn't get genres or directors
+        if cursor.rowcount == 0:
+            return
+        _log_change(cursor, "movie", movie.movie_id, "update", movie.to_dict(Movie.FIELDS))
+        # Move the movie's ratings in its raters' stats from its old genres and directors to the new ones
+        _adjust_user_stats(cursor, -1, "r.movie_id = ?", (movie.movie_id,), kinds=MOVIE_NAME_STAT_KINDS)
+        _unindex_movie_names(cursor, movie.movie_id)
+        _index_movie_names(cursor, movie.movie_id, movie.genre, movie.director)
+        _adjust_user_stats(cursor, 1, "r.movie_id = ?", (movie.movie_id,), kinds=MOVIE_NAME_STAT_KINDS)
 
 
 def delete_movie(movie_id: int):
@@ -284,62 +1227,78 @@ def delete_movie(movie_id: int):
     Returns:
         None
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    query = "DELETE FROM movies WHERE movie_id = ?"
-    cursor.execute(query, (movie_id,))
-    
-    conn.commit()
-    conn.close()
-
-def get_all_movies() -> List[Movie]:
+    with write_transaction() as cursor:
+        # The movie's ratings go first, while its genres and directors are still linked to it, so they can
+        #  be taken out of the derived tables
+        _delete_ratings(cursor, "r.movie_id = ?", (movie_id,))
+        query = "DELETE FROM movies WHERE movie_id = ?"
+        cursor.execute(query, (movie_id,))
+        if cursor.rowcount > 0:
+            _log_change(cursor, "movie", movie_id, "delete")
+        cursor.execute("DELETE FROM movie_scores WHERE movie_id = ?", (movie_id,))
+        _unindex_movie_names(cursor, movie_id)
+
+def get_all_movies(fields=None) -> List[Movie]:
     """
     Retrieve all movies from the database.
+    Args:
+        fields (list of str, optional): Only load these fields of each movie. Defaults to all of them.
     Returns:
         List[Movie]: A list of Movie objects representing all movies in the database.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    query = "SELECT movie_id,title,genre,release_year,director FROM movies"
-    cursor.execute(query)
+    query = f"SELECT {select_list(MOVIE_COLUMNS, fields, 'movie_id')} FROM movies"
 
-    movies = cursor.fetchall()
-    conn.close()
+    def read(cursor):
+        cursor.execute(query)
+        return tuple(cursor.fetchall())
 
+    movies = _cached_read("get_all_movies", make_key(query), read)
     return convert_rows_to_movie_list(movies)
 
 
-def get_movie_by_id(movie_id: int) -> Movie:
+def get_movie_by_id(movie_id: int, fields=None) -> Movie:
     """
     Retrieve a movie from the database by its ID.
     Args:
         movie_id (int): The ID of the movie to retrieve.
+        fields (list of str, optional): Only load these fields of the movie. Defaults to all of them.
     Returns:
         Movie: A Movie object representing the movie with the given ID.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    query = "SELECT movie_id,title,genre,release_year,director FROM movies WHERE movie_id = ?"
-    cursor.execute(query, (movie_id,))
+    query = f"SELECT {select_list(MOVIE_COLUMNS, fields, 'movie_id')} FROM movies WHERE movie_id = ?"
 
-    movie = cursor.fetchone()
-    conn.close()
+    def read(cursor):
+        cursor.execute(query, (movie_id,))
+        return tuple(cursor.fetchall())
 
-    if movie is None:
+    movies = _cached_read("get_movie_by_id", make_key(query, (movie_id,)), read)
+    if not movies:
         return None
 
-    return Movie(
-        movie["movie_id"],
-        movie["title"],
-        movie["genre"],
-        movie["release_year"],
-        movie["director"],
-    )
+    return convert_rows_to_movie_list(movies)[0]
 
-def get_movies_by_name(title: str, starts_with: bool = True) -> List[Movie]:
+def get_movies_by_ids(movie_ids, fields=None):
+    """
+    Retrieve any number of movies by their IDs, using one connection for all of them.
+    Args:
+        movie_ids (list of int): The IDs of the movies to retrieve. Duplicates are only looked up once.
+        fields (list of str, optional): Only load these fields of each movie. Defaults to all of them.
+    Returns:
+        tuple: A list of the Movie objects that were found, in the order their IDs were given,
+               and a list of the IDs that weren't found.
+    """
+    movie_ids = list(dict.fromkeys(movie_ids))  # Remove duplicates but keep the order
+    conn = get_read_connection()
+    cursor = conn.cursor()
+    query = f"SELECT {select_list(MOVIE_COLUMNS, fields, 'movie_id')} FROM movies"
+    rows = fetch_rows_by_ids(cursor, query, "movie_id", movie_ids)
+    conn.close()
+
+    movies = convert_rows_to_movie_list([rows[movie_id] for movie_id in movie_ids if movie_id in rows])
+    missing_ids = [movie_id for movie_id in movie_ids if movie_id not in rows]
+    return movies, missing_ids
+
+def get_movies_by_name(title: str, starts_with: bool = True, fields=None) -> List[Movie]:
     """
     Retrieve a list of movies from the database whose titles match the given pattern.
     Args:
@@ -347,53 +1306,227 @@ def get_movies_by_name(title: str, starts_with: bool = True) -> List[Movie]:
         starts_with (bool, optional): If True, search for movie titles that start with the given title.
                                       If False, search for movie titles that contain the given title.
                                       Defaults to True.
+        fields (list of str, optional): Only load these fields of each movie. Defaults to all of them.
     Returns:
         List[Movie]: A list of Movie objects that match the search criteria.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    query = "SELECT movie_id,title,genre,release_year,director FROM movies WHERE title like ?"
+    query = f"SELECT {select_list(MOVIE_COLUMNS, fields, 'movie_id')} FROM movies WHERE title like ?"
 
     # If the starts_with value is True then we will search for movies that start with the title like (title%), 
     # otherwise we will search for movies that contain the title (%title%)
     params = f'{title}%' if starts_with else f'%{title}%'
-    cursor.execute(query, (params,))
 
-    movies = cursor.fetchall()
-    conn.close()
+    def read(cursor):
+        cursor.execute(query, (params,))
+        return tuple(cursor.fetchall())
 
+    movies = _cached_read("get_movies_by_name", make_key(query, (params,)), read)
     return convert_rows_to_movie_list(movies)
 
-def get_movies_matching_criteria(genre: str ="", director: str ="", year: int=0) -> List[Movie]:
+def get_movies_matching_criteria(genre="", director="", year: int=0) -> List[Movie]:
     """
     Retrieve a list of movies from the database that match the given criteria.
+    Genres and directors are matched exactly (ignoring case) against the genre and director lookup
+    tables, so a movie directed by "Anthony Russo, Joe Russo" is found by director="Joe Russo".
     Args:
-        genre (str, optional): The genre of the movie to search for. Defaults to an empty string.
-        director (str, optional): The director of the movie to search for. Defaults to an empty string.
+        genre (str or list, optional): The genre(s) of the movie to search for, either a list or a comma
+                                       separated string. A movie matches if it has any of them.
+                                       Defaults to an empty string.
+        director (str or list, optional): The director(s) of the movie to search for, in the same form
+                                          as genre. Defaults to an empty string.
         year (int, optional): The release year of the movie to search for. Defaults to 0.
         
     Returns:
 
         List[Movie]: A list of Movie objects that match the search criteria.
     """
-    query = "SELECT movie_id,title,genre,release_year,director FROM movies WHERE "
-    where_clauses = [] # A list to store the WHERE clauses for the query
-    params = []
-    if genre:
-        where_clauses.append("genre like ?")
-        params.append(f"%{genre}%")
-    if director:
-        where_clauses.append("director like ?")
-        params.append(f"%{director}%")
+    query = MovieQuery().with_genres(genre).with_directors(director)
     if year > 0:
-        where_clauses.append("release_year = ?")
-        params.append(year)
+        query.released_between(year, year)
+    return search_movies(query).movies
 
-    where_clause = " AND ".join(where_clauses) # Join the WHERE clauses with an AND statement
-    query += where_clause
-    movies = run_query(query, params=params)
-    return convert_rows_to_movie_list(movies)
+def search_movies(query: MovieQuery, facets=()) -> MovieSearchResult:
+    """
+    Run a movie search, returning a page of matching movies and, optionally, counts of all the matches
+    grouped by genre, decade and/or director.
+    Args:
+        query (MovieQuery): The filters, sort order and paging for the search.
+        facets (list of str, optional): Which of "genre", "decade" and "director" to count by. Defaults to none.
+    Returns:
+        MovieSearchResult: The page of movies, the cursor for the next page (if there is one) and the facet counts.
+    Raises:
+        ValueError: If one of the facets isn't recognised.
+    """
+    sql, params = query.compile()
+    facet_sql, facet_params = query.compile_facets(facets) if facets else (None, None)
+
+    # Both statements run on one connection so that the facets count the same data as the page
+    def read(cursor):
+        cursor.execute(sql, params)
+        rows = tuple(cursor.fetchall())
+        facet_rows = ()
+        if facet_sql:
+            cursor.execute(facet_sql, facet_params)
+            facet_rows = tuple(cursor.fetchall())
+        return rows, facet_rows
+
+    key = make_key(sql, params) + (make_key(facet_sql, facet_params) if facet_sql else None,)
+    rows, facet_rows = _cached_read("search_movies", key, read)
+    facet_counts = {facet: {} for facet in facets}
+    for facet, value, count in facet_rows:
+        facet_counts[facet][value] = count
+
+    next_cursor = None
+    if query.page_size is not None and len(rows) > query.page_size:
+        rows = rows[:query.page_size]
+        next_cursor = query.next_cursor(rows[-1])
+    return MovieSearchResult(convert_rows_to_movie_list(rows), next_cursor, facet_counts)
+
+# Indexes on the base tables for the sort orders and range filters that movie searches and rating
+#  date ranges use
+BASE_TABLE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_movies_release_year ON movies (release_year, movie_id)",
+    "CREATE INDEX IF NOT EXISTS idx_movies_title ON movies (title, movie_id)",
+    "CREATE INDEX IF NOT EXISTS idx_ratings_movie_date ON ratings (movie_id, date)",
+    "CREATE INDEX IF NOT EXISTS idx_ratings_date ON ratings (date)",
+    # Finds a user's ratings, including for the ON DELETE CASCADE when a user is deleted
+    "CREATE INDEX IF NOT EXISTS idx_ratings_user ON ratings (user_id)",
+]
+
+# ---------------------------------------------------------
+# Referential integrity
+# ---------------------------------------------------------
+# Every rating belongs to a user and a movie. The ratings table declares both as foreign keys with
+#  ON DELETE CASCADE, and every connection turns on PRAGMA foreign_keys, so a rating can't be added for a
+#  user or movie that doesn't exist, and deleting a user or movie can't leave its ratings behind.
+# delete_user and delete_movie still delete the ratings themselves first (see _delete_ratings), because the
+#  derived tables and the change log have to be told about them. The cascade is the safety net for anything
+#  that deletes users or movies without going through this module.
+# A cascade finds the ratings by user_id or movie_id, which are both indexed (idx_ratings_user, and
+#  idx_ratings_movie_date which starts with movie_id), so deleting a user or movie doesn't scan every rating.
+# A database created before the foreign keys existed is migrated once by ensure_schema: its orphaned
+#  ratings are removed and the ratings table is rebuilt with the foreign keys.
+RATINGS_TABLE_DDL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        rating_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER REFERENCES users (user_id) ON DELETE CASCADE,
+        movie_id INTEGER REFERENCES movies (movie_id) ON DELETE CASCADE,
+        rating INTEGER,
+        review TEXT,
+        date DATE
+    )
+"""
+
+# Ratings whose user or movie no longer exists
+ORPHANED_RATINGS_SQL = (
+    "r.user_id NOT IN (SELECT user_id FROM users) OR r.movie_id NOT IN (SELECT movie_id FROM movies)"
+)
+
+def _add_rating_foreign_keys(cursor):
+    """
+    Rebuild the ratings table with its foreign keys, removing any orphaned ratings first.
+    SQLite can't add a constraint to an existing table, so the rows are copied to a new table that replaces it.
+    This has to run with PRAGMA foreign_keys off, as it is while ensure_schema runs.
+    """
+    _delete_ratings(cursor, ORPHANED_RATINGS_SQL)
+    # Keep the AUTOINCREMENT counter, so the IDs of deleted ratings are never used again
+    sequence = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'ratings'").fetchone()
+    cursor.execute(RATINGS_TABLE_DDL.format(table="ratings_with_keys"))
+    cursor.execute(
+        """INSERT INTO ratings_with_keys (rating_id, user_id, movie_id, rating, review, date)
+           SELECT rating_id, user_id, movie_id, rating, review, date FROM ratings"""
+    )
+    cursor.execute("DROP TABLE ratings")
+    cursor.execute("ALTER TABLE ratings_with_keys RENAME TO ratings")
+    if sequence is not None:
+        cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'ratings'", (sequence[0],))
+    # The indexes went with the old table
+    for statement in BASE_TABLE_INDEXES:
+        cursor.execute(statement)
+
+def remove_orphaned_ratings() -> int:
+    """
+    Delete the ratings whose user or movie no longer exists.
+    With the foreign keys in place there shouldn't be any, unless the ratings table has been written to
+    without PRAGMA foreign_keys (e.g. by a bulk load).
+    Returns:
+        int: The number of ratings deleted.
+    """
+    with write_transaction() as cursor:
+        return _delete_ratings(cursor, ORPHANED_RATINGS_SQL)
+
+# ---------------------------------------------------------
+# Genre and director lookup tables
+# ---------------------------------------------------------
+# The genre and director columns on the movies table are free text (e.g. "Anthony Russo, Joe Russo"),
+#  which can only be searched with a LIKE scan. We split them into lookup tables of unique names plus
+#  junction tables linking names to movies. The movies table stays the source of truth; the write
+#  functions above keep these tables in step with it.
+MOVIE_NAME_INDEX_DDL = []
+for _lookup_table, _junction_table, _id_column in (
+    ("genres", "movie_genres", "genre_id"),
+    ("directors", "movie_directors", "director_id"),
+):
+    MOVIE_NAME_INDEX_DDL += [
+        f"""
+        CREATE TABLE IF NOT EXISTS {_lookup_table} (
+            {_id_column} INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE COLLATE NOCASE
+        )
+        """,
+        # The primary key doubles as the index for "which movies have this name"
+        f"""
+        CREATE TABLE IF NOT EXISTS {_junction_table} (
+            {_id_column} INTEGER NOT NULL,
+            movie_id INTEGER NOT NULL,
+            PRIMARY KEY ({_id_column}, movie_id)
+        ) WITHOUT ROWID
+        """,
+        f"CREATE INDEX IF NOT EXISTS idx_{_junction_table}_movie ON {_junction_table} (movie_id)",
+    ]
+
+def _index_movie_names(cursor, movie_id: int, genre: str, director: str):
+    """
+    Link a movie to its genres and directors, adding any names that aren't in the lookup tables yet.
+    Args:
+        cursor (sqlite3.Cursor): A cursor on the connection that is writing the movie.
+        movie_id (int): The movie to link.
+        genre (str): The movie's genre column.
+        director (str): The movie's director column.
+    """
+    for values, junction_table, lookup_table, id_column in (
+        (genre, "movie_genres", "genres", "genre_id"),
+        (director, "movie_directors", "directors", "director_id"),
+    ):
+        for name in split_names(values):
+            cursor.execute(f"INSERT OR IGNORE INTO {lookup_table} (name) VALUES (?)", (name,))
+            cursor.execute(
+                f"INSERT OR IGNORE INTO {junction_table} ({id_column}, movie_id) "
+                f"SELECT {id_column}, ? FROM {lookup_table} WHERE name = ?",
+                (movie_id, name),
+            )
+
+def _unindex_movie_names(cursor, movie_id: int):
+    """
+    Remove all of a movie's genre and director links.
+    Args:
+        cursor (sqlite3.Cursor): A cursor on the connection that is writing the movie.
+        movie_id (int): The movie to unlink.
+    """
+    cursor.execute("DELETE FROM movie_genres WHERE movie_id = ?", (movie_id,))
+    cursor.execute("DELETE FROM movie_directors WHERE movie_id = ?", (movie_id,))
+
+def _rebuild_movie_name_index(cursor):
+    """
+    Fill the genre and director lookup tables from the movies table, replacing anything already in them.
+    Args:
+        cursor (sqlite3.Cursor): A cursor on the connection doing the rebuild.
+    """
+    for table_name in ("movie_genres", "movie_directors", "genres", "directors"):
+        cursor.execute(f"DELETE FROM {table_name}")
+    movies = cursor.execute("SELECT movie_id, genre, director FROM movies").fetchall()
+    for movie in movies:
+        _index_movie_names(cursor, movie[0], movie[1], movie[2])
 
 # ---------------------------------------------------------
 # Ratings
@@ -416,13 +1549,14 @@ def convert_rows_to_rating_list(ratings):
     if ratings is None:
         return None
     for rating in ratings:
+        # Any column that wasn't selected is left as None
         rating = Rating(
-            rating_id=rating["rating_id"],
-            user_id=rating["user_id"],
-            movie_id=rating["movie_id"],
-            rating=rating["rating"],
-            review=rating["review"],
-            date=rating["date"],
+            rating_id=row_value(rating, "rating_id"),
+            user_id=row_value(rating, "user_id"),
+            movie_id=row_value(rating, "movie_id"),
+            rating=row_value(rating, "rating"),
+            review=row_value(rating, "review"),
+            date=row_value(rating, "date"),
         )
         all_ratings.append(rating)
     return all_ratings
@@ -434,17 +1568,35 @@ def create_rating(rating: Rating) -> int:
         rating (Rating): A Rating object representing the rating to be added.
     Returns:
         int: The ID of the newly created rating.
+    Raises:
+        ValueError: If the rating's date isn't a date, or its user or movie doesn't exist.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    rating.date = normalize_date(rating.date)
+    try:
+        with write_transaction() as cursor:
+            rating_id = insert_rating(cursor, rating)
+    except sqlite3.IntegrityError as error:
+        raise ValueError("The rating's user and movie must both exist") from error
 
+    return rating_id
+
+def insert_rating(cursor, rating: Rating) -> int:
+    """
+    Add a new rating on an existing cursor without committing, along with everything that is derived from it.
+    This lets a caller (like the write-behind writer in api/write_behind.py) put many ratings in one transaction.
+    Args:
+        cursor (sqlite3.Cursor): A cursor on a connection to the main database.
+        rating (Rating): A Rating object representing the rating to be added.
+    Returns:
+        int: The ID of the newly created rating.
+    """
+    rating.date = normalize_date(rating.date)
     query = "INSERT INTO ratings (user_id, movie_id, rating, review, date) VALUES (?, ?, ?, ?, ?)"
     cursor.execute(query, (rating.user_id, rating.movie_id, rating.rating, rating.review, rating.date))
     rating_id = cursor.lastrowid
-
-    conn.commit()
-    conn.close()
-
+    _adjust_movie_score(cursor, rating.movie_id, 1, rating.rating)
+    _adjust_rating_aggregates(cursor, 1, rating_id)
+    _log_change(cursor, "rating", rating_id, "create", {**rating.to_dict(), "rating_id": rating_id})
     return rating_id
 
 def update_rating(rating: Rating):
@@ -454,31 +1606,46 @@ def update_rating(rating: Rating):
         rating (Rating): A Rating object containing the updated rating information.
     Returns:
         None
+    Raises:
+        ValueError: If the rating's date isn't a date, or its user or movie doesn't exist.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    query = "UPDATE ratings SET user_id = ?, movie_id = ?, rating = ?, review = ?, date = ? WHERE rating_id = ?"
-    cursor.execute(
-        query,
-        (rating.user_id, rating.movie_id, rating.rating, rating.review, rating.date, rating.rating_id),
-    )
-
-    conn.commit()
-    conn.close()
+    rating.date = normalize_date(rating.date)
+    try:
+        _update_rating(rating)
+    except sqlite3.IntegrityError as error:
+        raise ValueError("The rating's user and movie must both exist") from error
+
+def _update_rating(rating: Rating):
+    with write_transaction() as cursor:
+        # We need the old values so that the leaderboard can take them back out
+        cursor.execute("SELECT movie_id, rating FROM ratings WHERE rating_id = ?", (rating.rating_id,))
+        old_rating = cursor.fetchone()
+        _adjust_rating_aggregates(cursor, -1, rating.rating_id)
+
+        query = "UPDATE ratings SET user_id = ?, movie_id = ?, rating = ?, review = ?, date = ? WHERE rating_id = ?"
+        cursor.execute(
+            query,
+            (rating.user_id, rating.movie_id, rating.rating, rating.review, rating.date, rating.rating_id),
+        )
+        if old_rating is not None:
+            _adjust_movie_score(cursor, old_rating["movie_id"], -1, -old_rating["rating"])
+            _adjust_movie_score(cursor, rating.movie_id, 1, rating.rating)
+            _log_change(cursor, "rating", rating.rating_id, "update", rating.to_dict())
+        _adjust_rating_aggregates(cursor, 1, rating.rating_id)
 
-def get_rating_by_id(rating_id: int) -> Rating:
+def get_rating_by_id(rating_id: int, fields=None) -> Rating:
     """
     Retrieve a rating from the database by its ID.
     Args:
         rating_id (int): The ID of the rating to retrieve.
+        fields (list of str, optional): Only load these fields of the rating. Defaults to all of them.
     Returns:
         Rating: A Rating object representing the rating with the given ID.
     """
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
 
-    query = "SELECT rating_id,user_id,movie_id,rating,review,date FROM ratings WHERE rating_id = ?"
+    query = f"SELECT {select_list(RATING_COLUMNS, fields, 'rating_id')} FROM ratings WHERE rating_id = ?"
     cursor.execute(query, (rating_id,))
 
     ratings = cursor.fetchall()
@@ -498,49 +1665,798 @@ def delete_rating(rating_id: int):
     Returns:
         None
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    query = "DELETE FROM ratings WHERE rating_id = ?"
-    cursor.execute(query, (rating_id,))
-
-    conn.commit()
-    conn.close()
-
-def get_movie_ratings(movie_id: int) -> List[Rating]:
+    with write_transaction() as cursor:
+        cursor.execute("SELECT movie_id, rating FROM ratings WHERE rating_id = ?", (rating_id,))
+        old_rating = cursor.fetchone()
+        _adjust_rating_aggregates(cursor, -1, rating_id)
+
+        query = "DELETE FROM ratings WHERE rating_id = ?"
+        cursor.execute(query, (rating_id,))
+        if old_rating is not None:
+            _adjust_movie_score(cursor, old_rating["movie_id"], -1, -old_rating["rating"])
+            _log_change(cursor, "rating", rating_id, "delete")
+
+def delete_ratings(movie_id: int = None, user_id: int = None) -> int:
+    """
+    Delete all of a movie's ratings, all of a user's ratings, or a user's ratings of a movie.
+    The ratings are deleted (and taken out of the derived tables) with a handful of set-based statements,
+    however many there are.
+    Args:
+        movie_id (int, optional): Delete the ratings of this movie.
+        user_id (int, optional): Delete the ratings by this user.
+    Returns:
+        int: The number of ratings deleted.
+    Raises:
+        ValueError: If neither a movie nor a user is given.
+    """
+    conditions, params = [], []
+    if movie_id is not None:
+        conditions.append("r.movie_id = ?")
+        params.append(movie_id)
+    if user_id is not None:
+        conditions.append("r.user_id = ?")
+        params.append(user_id)
+    if not conditions:
+        raise ValueError("Give a movie_id or a user_id (or both) to delete ratings")
+    with write_transaction() as cursor:
+        return _delete_ratings(cursor, " AND ".join(conditions), tuple(params))
+
+def _delete_ratings(cursor, where: str, params=()) -> int:
+    """
+    Delete a set of ratings, taking them out of every derived table and logging each one.
+    Args:
+        cursor (sqlite3.Cursor): A cursor on the connection making the change.
+        where (str): An SQL condition on the ratings table (as "r") that picks the ratings.
+        params (tuple, optional): The parameters for the condition.
+    Returns:
+        int: The number of ratings deleted.
+    """
+    where = f"({where})"
+    _adjust_user_stats(cursor, -1, where, params)
+    _adjust_rating_buckets(cursor, -1, where, params)
+    _adjust_movie_scores(cursor, -1, where, params)
+    _log_changes(cursor, "rating", "delete", f"SELECT r.rating_id AS id FROM ratings r WHERE {where}", params)
+    cursor.execute(f"DELETE FROM ratings AS r WHERE {where}", params)
+    return cursor.rowcount
+
+def get_movie_ratings(movie_id: int, fields=None) -> List[Rating]:
     """
     Retrieve all ratings for a specific movie by movie ID.
     Args:
         movie_id (int): The unique identifier of the movie.
+        fields (list of str, optional): Only load these fields of each rating. Defaults to all of them.
     Returns:
         List[Rating]: A list of Rating objects representing the ratings for the movie.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    query = f"SELECT {select_list(RATING_COLUMNS, fields, 'rating_id')} FROM ratings WHERE movie_id = ?"
 
-    query = "SELECT rating_id, user_id, movie_id, rating,review,date FROM ratings WHERE movie_id = ?"
-    cursor.execute(query, (movie_id,))
+    def read(cursor):
+        cursor.execute(query, (movie_id,))
+        return tuple(cursor.fetchall())
 
-    ratings = cursor.fetchall()
-    conn.close()
+    ratings = _cached_read("get_movie_ratings", make_key(query, (movie_id,)), read)
 
     return convert_rows_to_rating_list(ratings)
 
-def get_user_ratings(user_id: int) -> List[Rating]:
+def get_user_ratings(user_id: int, fields=None) -> List[Rating]:
     """
     Retrieve all ratings by a specific user.
     Args:
         user_id (int): The unique identifier of the user.
+        fields (list of str, optional): Only load these fields of each rating. Defaults to all of them.
     Returns:
         List[Rating]: A list of Rating objects representing the ratings by the user.
     """
-    conn = get_db_connection()
+    query = f"SELECT {select_list(RATING_COLUMNS, fields, 'rating_id')} FROM ratings WHERE user_id = ?"
+
+    def read(cursor):
+        cursor.execute(query, (user_id,))
+        return tuple(cursor.fetchall())
+
+    ratings = _cached_read("get_user_ratings", make_key(query, (user_id,)), read)
+
+    return convert_rows_to_rating_list(ratings)
+
+# ---------------------------------------------------------
+# Rating dates
+# ---------------------------------------------------------
+# Rating dates are always stored as ISO dates (YYYY-MM-DD), whatever format they were given in, so that
+#  they sort and compare correctly as text and a date range is a range scan on the date indexes.
+# For charts of rating activity, the rating_daily_buckets table keeps a running count and sum of the
+#  ratings given each day for each movie. Daily and weekly rollups add up those buckets instead of reading
+#  every rating in the range.
+RATING_DATE_FORMATS = ("%Y-%m-%d", "%m/%d/%Y", "%Y/%m/%d")
+
+# The most ratings that can be listed in one page
+MAX_RATINGS_PAGE = 1000
+
+# Each rollup period and the SQL expression for the first day of the period a bucket's day falls in
+#  (weeks start on Monday)
+ROLLUP_PERIODS = {
+    "day": "day",
+    "week": "date(day, '-6 days', 'weekday 1')",
+}
+
+RATING_DAILY_BUCKETS_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS rating_daily_buckets (
+        day TEXT NOT NULL,
+        movie_id INTEGER NOT NULL,
+        rating_count INTEGER NOT NULL DEFAULT 0,
+        rating_sum REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, movie_id)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_rating_daily_buckets_movie ON rating_daily_buckets (movie_id, day)",
+    "CREATE INDEX IF NOT EXISTS idx_rating_daily_buckets_empty ON rating_daily_buckets (rating_count) WHERE rating_count <= 0",
+]
+
+def normalize_date(value) -> str:
+    """
+    Convert a date to the YYYY-MM-DD format that rating dates are stored in.
+    Args:
+        value (str, date or datetime): e.g. "2023-01-31", "1/31/2023" or "2023-01-31T12:00:00".
+    Returns:
+        str: The date as YYYY-MM-DD, or None if no date was given.
+    Raises:
+        ValueError: If the value isn't a date in one of the known formats.
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    text = str(value).strip()
+    # A timestamp only needs its date part
+    for separator in ("T", " "):
+        if separator in text:
+            text = text.split(separator, 1)[0]
+    for date_format in RATING_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date().isoformat()
+        except ValueError:
+            pass
+    raise ValueError(f"'{value}' is not a date, use YYYY-MM-DD")
+
+def _normalize_date_or_keep(value):
+    # Used from SQL, where a date we can't read is left as it is rather than failing the whole update
+    try:
+        return normalize_date(value)
+    except ValueError:
+        return value
+
+def _normalize_rating_dates(cursor):
+    """
+    Convert any rating dates that aren't already YYYY-MM-DD (e.g. "1/31/2023" from ratings.csv).
+    """
+    cursor.connection.create_function("normalize_date", 1, _normalize_date_or_keep, deterministic=True)
+    cursor.execute("UPDATE ratings SET date = normalize_date(date) WHERE date NOT LIKE '____-__-__'")
+
+def _adjust_rating_aggregates(cursor, sign: int, rating_id: int):
+    """
+    Add a rating to every table that is aggregated from individual ratings, or take it out again.
+    Call this with -1 before a rating is changed or deleted and with 1 after it has been added or changed.
+    """
+    _adjust_user_stats(cursor, sign, "r.rating_id = ?", (rating_id,))
+    _adjust_rating_buckets(cursor, sign, "r.rating_id = ?", (rating_id,))
+
+def _adjust_rating_buckets(cursor, sign: int, where: str, params=()):
+    """
+    Add a set of ratings to their daily buckets, or take them out again.
+
+    Args:
+        cursor (sqlite3.Cursor): A cursor on the connection making the rating change.
+        sign (int): 1 to add the ratings, -1 to take them out.
+        where (str): An SQL condition on the ratings table (as "r") that picks the ratings.
+        params (tuple, optional): The parameters for the condition.
+    """
+    cursor.execute(
+        f"""INSERT INTO rating_daily_buckets (day, movie_id, rating_count, rating_sum)
+            SELECT r.date, r.movie_id, ? * COUNT(*), ? * SUM(r.rating)
+            FROM ratings r
+            WHERE ({where}) AND r.date IS NOT NULL AND r.movie_id IS NOT NULL AND r.rating IS NOT NULL
+            GROUP BY r.date, r.movie_id
+            ON CONFLICT (day, movie_id) DO UPDATE SET
+                rating_count = rating_count + excluded.rating_count,
+                rating_sum = rating_sum + excluded.rating_sum""",
+        (sign, sign, *params),
+    )
+    if sign < 0:
+        cursor.execute("DELETE FROM rating_daily_buckets WHERE rating_count <= 0")
+
+def _rebuild_rating_daily_buckets(cursor):
+    """
+    Fill the rating_daily_buckets table from the ratings table, replacing anything already in it.
+
+    Args:
+        cursor (sqlite3.Cursor): A cursor on the connection doing the rebuild.
+    """
+    cursor.execute("DELETE FROM rating_daily_buckets")
+    _adjust_rating_buckets(cursor, 1, "1 = 1")
+
+def get_ratings(date_from=None, date_to=None, movie_id: int = None, limit: int = 100, cursor: str = None, fields=None):
+    """
+    Retrieve the ratings given within a range of dates, oldest first, a page at a time.
+    Args:
+        date_from (str, optional): The first date to include. Defaults to the earliest rating.
+        date_to (str, optional): The last date to include. Defaults to the latest rating.
+        movie_id (int, optional): Only include ratings of this movie.
+        limit (int, optional): The most ratings to return. Defaults to 100.
+        cursor (str, optional): The next_cursor from the previous page.
+        fields (list of str, optional): Only load these fields of each rating. Defaults to all of them.
+    Returns:
+        tuple: The list of Rating objects, and the cursor for the next page (None if this is the last page).
+    Raises:
+        ValueError: If a date, the limit or the cursor isn't valid.
+    """
+    if limit < 1 or limit > MAX_RATINGS_PAGE:
+        raise ValueError(f"The limit must be between 1 and {MAX_RATINGS_PAGE}")
+    columns = select_list(RATING_COLUMNS, fields, "rating_id")
+    if fields is not None and "date" not in fields:
+        # The cursor for the next page needs the date
+        columns += ",date"
+
+    # With a movie ID this is a range scan on (movie_id, date), without one on (date)
+    clauses = []
+    params = []
+    if movie_id is not None:
+        clauses.append("movie_id = ?")
+        params.append(movie_id)
+    if date_from:
+        clauses.append("date >= ?")
+        params.append(normalize_date(date_from))
+    if date_to:
+        clauses.append("date <= ?")
+        params.append(normalize_date(date_to))
+    if cursor:
+        after_date, after_rating_id = decode_cursor(cursor)
+        # Rating dates are always strings, so anything else didn't come from a page of ratings
+        if not isinstance(after_date, str):
+            raise ValueError("The cursor is not valid")
+        clauses.append("(date, rating_id) > (?, ?)")
+        params.extend((after_date, after_rating_id))
+    query = f"SELECT {columns} FROM ratings"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY date, rating_id LIMIT ?"
+    # Fetch one extra row so that we know whether there is another page
+    params.append(limit + 1)
+
+    conn = get_read_connection()
+    rows = conn.execute(query, params).fetchall()
+    conn.close()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1]["date"], rows[-1]["rating_id"]])
+    return convert_rows_to_rating_list(rows), next_cursor
+
+def get_rating_rollup(period: str = "day", date_from=None, date_to=None, movie_id: int = None) -> List[RatingBucket]:
+    """
+    Count and average the ratings given in each day or week, from the daily buckets.
+    Args:
+        period (str, optional): "day" or "week" (weeks start on Monday). Defaults to "day".
+        date_from (str, optional): The first date to include.
+        date_to (str, optional): The last date to include.
+        movie_id (int, optional): Only include ratings of this movie.
+    Returns:
+        List[RatingBucket]: One entry for each period that has any ratings, oldest first.
+    Raises:
+        ValueError: If the period or a date isn't valid.
+    """
+    if period not in ROLLUP_PERIODS:
+        raise ValueError(f"The period must be one of {', '.join(ROLLUP_PERIODS)}")
+    clauses = []
+    params = []
+    if movie_id is not None:
+        clauses.append("movie_id = ?")
+        params.append(movie_id)
+    if date_from:
+        clauses.append("day >= ?")
+        params.append(normalize_date(date_from))
+    if date_to:
+        clauses.append("day <= ?")
+        params.append(normalize_date(date_to))
+    query = (
+        f"SELECT {ROLLUP_PERIODS[period]} AS period_start, SUM(rating_count) AS rating_count, "
+        "SUM(rating_sum) AS rating_sum FROM rating_daily_buckets"
+    )
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " GROUP BY period_start ORDER BY period_start"
+
+    conn = get_read_connection()
+    rows = conn.execute(query, params).fetchall()
+    conn.close()
+    return [RatingBucket(period, row["period_start"], row["rating_count"], row["rating_sum"]) for row in rows]
+
+# ---------------------------------------------------------
+# Leaderboard
+# ---------------------------------------------------------
+# Movies are ranked by a Bayesian average rather than a plain average, which pulls movies with only a
+#  handful of ratings toward a prior mean so that a single 5 star review can't top the list:
+#       score = (PRIOR_WEIGHT * PRIOR_MEAN + sum of ratings) / (PRIOR_WEIGHT + number of ratings)
+# Each movie's count, sum and score live in the movie_scores table, which the rating write functions
+#  update as they go. Reading the leaderboard is then a walk down the score index rather than an
+#  aggregate over the whole ratings table.
+LEADERBOARD_PRIOR_MEAN = 3.0
+LEADERBOARD_PRIOR_WEIGHT = 5
+
+MOVIE_SCORES_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS movie_scores (
+        movie_id INTEGER PRIMARY KEY,
+        rating_count INTEGER NOT NULL DEFAULT 0,
+        rating_sum REAL NOT NULL DEFAULT 0,
+        score REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_movie_scores_score ON movie_scores (score DESC)",
+    # The genre leaderboards go through the genre lookup tables (see get_top_movies). Databases built
+    #  before then had a genre column with its own index, which would otherwise still be kept up to date.
+    "DROP INDEX IF EXISTS idx_movie_scores_genre_score",
+]
+
+def _rebuild_movie_scores(cursor):
+    """
+    Fill the movie_scores table from the ratings table, replacing anything already in it.
+
+    Args:
+        cursor (sqlite3.Cursor): A cursor on the connection doing the rebuild.
+    """
+    cursor.execute("DELETE FROM movie_scores")
+    query = """
+        INSERT INTO movie_scores (movie_id, rating_count, rating_sum, score)
+        SELECT m.movie_id, COUNT(r.rating), COALESCE(SUM(r.rating), 0),
+               (? * ? + COALESCE(SUM(r.rating), 0)) / (? + COUNT(r.rating))
+        FROM movies m JOIN ratings r ON r.movie_id = m.movie_id
+        GROUP BY m.movie_id
+    """
+    cursor.execute(
+        query,
+        (LEADERBOARD_PRIOR_WEIGHT, LEADERBOARD_PRIOR_MEAN, LEADERBOARD_PRIOR_WEIGHT),
+    )
+
+def _adjust_movie_score(cursor, movie_id: int, count_delta: int, sum_delta: float):
+    """
+    Apply a change in a movie's ratings to its leaderboard entry.
+
+    Args:
+        cursor (sqlite3.Cursor): A cursor on the connection making the rating change, so the
+                                 leaderboard is committed together with the rating itself.
+        movie_id (int): The movie whose ratings changed.
+        count_delta (int): How many ratings were added (or removed, if negative).
+        sum_delta (float): How much the sum of the movie's ratings changed by.
+    """
+    if sum_delta is None:
+        sum_delta = 0
+    cursor.execute(
+        """INSERT INTO movie_scores (movie_id, rating_count, rating_sum, score)
+           SELECT movie_id, 0, 0, ? FROM movies WHERE movie_id = ?
+           ON CONFLICT (movie_id) DO NOTHING""",
+        (LEADERBOARD_PRIOR_MEAN, movie_id),
+    )
+    # In an UPDATE every expression sees the row as it was before the update, so the new score is
+    #  calculated from the old count and sum plus the deltas
+    cursor.execute(
+        """UPDATE movie_scores
+           SET rating_count = rating_count + ?,
+               rating_sum = rating_sum + ?,
+               score = (? * ? + rating_sum + ?) / (? + rating_count + ?)
+           WHERE movie_id = ?""",
+        (
+            count_delta, sum_delta,
+            LEADERBOARD_PRIOR_WEIGHT, LEADERBOARD_PRIOR_MEAN, sum_delta,
+            LEADERBOARD_PRIOR_WEIGHT, count_delta,
+            movie_id,
+        ),
+    )
+
+def _adjust_movie_scores(cursor, sign: int, where: str, params=()):
+    """
+    Add a set of ratings to their movies' leaderboard entries, or take them out again.
+
+    Args:
+        cursor (sqlite3.Cursor): A cursor on the connection making the rating change.
+        sign (int): 1 to add the ratings, -1 to take them out.
+        where (str): An SQL condition on the ratings table (as "r") that picks the ratings.
+        params (tuple, optional): The parameters for the condition.
+    """
+    if sign > 0:
+        cursor.execute(
+            f"""INSERT INTO movie_scores (movie_id, rating_count, rating_sum, score)
+                SELECT m.movie_id, 0, 0, ? FROM movies m
+                WHERE m.movie_id IN (SELECT r.movie_id FROM ratings r WHERE {where})
+                ON CONFLICT (movie_id) DO NOTHING""",
+            (LEADERBOARD_PRIOR_MEAN, *params),
+        )
+    # The same calculation as _adjust_movie_score, with each movie's deltas summed over the set
+    cursor.execute(
+        f"""UPDATE movie_scores
+            SET rating_count = rating_count + changed.count_delta,
+                rating_sum = rating_sum + changed.sum_delta,
+                score = (? * ? + rating_sum + changed.sum_delta) / (? + rating_count + changed.count_delta)
+            FROM (SELECT r.movie_id, ? * COUNT(*) AS count_delta, ? * COALESCE(SUM(r.rating), 0) AS sum_delta
+                  FROM ratings r WHERE {where} GROUP BY r.movie_id) AS changed
+            WHERE movie_scores.movie_id = changed.movie_id""",
+        (
+            LEADERBOARD_PRIOR_WEIGHT, LEADERBOARD_PRIOR_MEAN, LEADERBOARD_PRIOR_WEIGHT,
+            sign, sign, *params,
+        ),
+    )
+
+def rebuild_leaderboard():
+    """
+    Recalculate every movie's leaderboard entry from the ratings table.
+    The write functions keep the leaderboard up to date on their own, this is only needed if the
+    ratings table has been changed outside of this module.
+    """
+    with write_transaction() as cursor:
+        _rebuild_movie_scores(cursor)
+
+def get_top_movies(genre: str = "", min_ratings: int = 1, limit: int = 10) -> List[MovieScore]:
+    """
+    Retrieve the highest ranked movies, optionally within a single genre.
+    Args:
+        genre (str, optional): Only rank movies in this genre. Defaults to all genres.
+        min_ratings (int, optional): Leave out movies with fewer ratings than this. Defaults to 1.
+        limit (int, optional): The number of movies to return. Defaults to 10.
+    Returns:
+        List[MovieScore]: The movies in rank order, along with their scores.
+    """
+    conn = get_read_connection()
     cursor = conn.cursor()
 
-    query = "SELECT rating_id, user_id, movie_id, rating,review,date FROM ratings WHERE user_id = ?"
-    cursor.execute(query, (user_id,))
+    query = """
+        SELECT m.movie_id, m.title, m.genre, m.release_year, m.director,
+               s.score, s.rating_count, s.rating_sum
+        FROM movie_scores s JOIN movies m ON m.movie_id = s.movie_id
+        WHERE s.rating_count >= ?
+    """
+    params = [max(min_ratings, 1)]
+    if genre:
+        # Through the genre lookup tables, so a movie in "Action, Adventure" is ranked under either one
+        query += """
+            AND EXISTS (
+                SELECT 1 FROM movie_genres mg JOIN genres g ON g.genre_id = mg.genre_id
+                WHERE mg.movie_id = s.movie_id AND g.name = ?
+            )
+        """
+        params.append(genre)
+    query += " ORDER BY s.score DESC LIMIT ?"
+    params.append(limit)
+    cursor.execute(query, params)
+
+    rows = cursor.fetchall()
+    conn.close()
 
-    ratings = cursor.fetchall()
+    movies = convert_rows_to_movie_list(rows)
+    return [
+        MovieScore(movie, row["score"], row["rating_count"], row["rating_sum"])
+        for movie, row in zip(movies, rows)
+    ]
+
+
+# ---------------------------------------------------------
+# User statistics
+# ---------------------------------------------------------
+# A user's profile shows how many ratings they have given, their rating histogram, their favourite genres
+#  and directors and how active they have been month by month. Working that out from the ratings table
+#  means reading every rating the user has ever given, so instead the user_rating_stats table keeps a
+#  running count and sum of each user's ratings per "bucket":
+#   kind       bucket
+#   total      ''              (all of the user's ratings)
+#   rating     '4'             (the histogram)
+#   genre      'Drama'         (through the genre lookup tables, so a movie can count for several genres)
+#   director   'Joe Russo'
+#   month      '2023-01'
+# The rating write functions add each rating to (or take it out of) its buckets in the same transaction,
+#  so reading a profile is a single range scan on the user's rows.
+USER_RATING_STATS_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS user_rating_stats (
+        user_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        rating_count INTEGER NOT NULL DEFAULT 0,
+        rating_sum REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, kind, bucket)
+    ) WITHOUT ROWID
+    """,
+    # Only buckets that have just been emptied are in this index, which keeps clearing them out cheap
+    "CREATE INDEX IF NOT EXISTS idx_user_rating_stats_empty ON user_rating_stats (rating_count) WHERE rating_count <= 0",
+]
+
+# The month a rating was given in, as YYYY-MM (rating dates are always stored as YYYY-MM-DD)
+RATING_MONTH_SQL = "substr(r.date, 1, 7)"
+
+# The bucket expression for each kind of statistic, and any joins it needs
+USER_STAT_BUCKETS = {
+    "total": ("''", ""),
+    "rating": ("CAST(r.rating AS TEXT)", ""),
+    "month": (RATING_MONTH_SQL, ""),
+    "genre": (
+        "g.name",
+        "JOIN movie_genres mg ON mg.movie_id = r.movie_id JOIN genres g ON g.genre_id = mg.genre_id",
+    ),
+    "director": (
+        "d.name",
+        "JOIN movie_directors md ON md.movie_id = r.movie_id JOIN directors d ON d.director_id = md.director_id",
+    ),
+}
+
+# The kinds that depend on a movie's genres and directors rather than on the rating itself
+MOVIE_NAME_STAT_KINDS = ("genre", "director")
+
+# A user's favourite genres and directors are ranked like the leaderboard, with each average pulled toward
+#  the user's overall average, so a single 5 star rating doesn't make a favourite
+USER_FAVORITE_PRIOR_WEIGHT = 2
+USER_FAVORITE_LIMIT = 5
+
+def _adjust_user_stats(cursor, sign: int, where: str, params=(), kinds=tuple(USER_STAT_BUCKETS)):
+    """
+    Add a set of ratings to their users' statistics, or take them out again.
+
+    Args:
+        cursor (sqlite3.Cursor): A cursor on the connection making the rating change.
+        sign (int): 1 to add the ratings, -1 to take them out.
+        where (str): An SQL condition on the ratings table (as "r") that picks the ratings, e.g. "r.rating_id = ?".
+        params (tuple, optional): The parameters for the condition.
+        kinds (tuple of str, optional): Which kinds of statistic to change. Defaults to all of them.
+    """
+    for kind in kinds:
+        bucket, joins = USER_STAT_BUCKETS[kind]
+        cursor.execute(
+            f"""INSERT INTO user_rating_stats (user_id, kind, bucket, rating_count, rating_sum)
+                SELECT r.user_id, '{kind}', {bucket}, ? * COUNT(*), ? * SUM(r.rating)
+                FROM ratings r {joins}
+                WHERE ({where}) AND r.user_id IS NOT NULL AND r.rating IS NOT NULL AND {bucket} IS NOT NULL
+                GROUP BY r.user_id, {bucket}
+                ON CONFLICT (user_id, kind, bucket) DO UPDATE SET
+                    rating_count = rating_count + excluded.rating_count,
+                    rating_sum = rating_sum + excluded.rating_sum""",
+            (sign, sign, *params),
+        )
+    if sign < 0:
+        cursor.execute("DELETE FROM user_rating_stats WHERE rating_count <= 0")
+
+def _rebuild_user_rating_stats(cursor):
+    """
+    Fill the user_rating_stats table from the ratings table, replacing anything already in it.
+
+    Args:
+        cursor (sqlite3.Cursor): A cursor on the connection doing the rebuild.
+    """
+    cursor.execute("DELETE FROM user_rating_stats")
+    _adjust_user_stats(cursor, 1, "1 = 1")
+
+def rebuild_user_stats():
+    """
+    Recalculate every user's statistics from the ratings table.
+    The write functions keep the statistics up to date on their own, this is only needed if the
+    ratings table has been changed outside of this module.
+    """
+    with write_transaction() as cursor:
+        _rebuild_user_rating_stats(cursor)
+
+def get_user_stats(user_id: int) -> UserStats:
+    """
+    Retrieve a user's rating statistics.
+    Args:
+        user_id (int): The ID of the user.
+    Returns:
+        UserStats: The user's statistics, or None if there is no such user.
+    """
+    conn = get_read_connection()
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
+    if cursor.fetchone() is None:
+        conn.close()
+        return None
+    cursor.execute(
+        "SELECT kind, bucket, rating_count, rating_sum FROM user_rating_stats WHERE user_id = ?",
+        (user_id,),
+    )
+    rows = cursor.fetchall()
     conn.close()
 
-    return convert_rows_to_rating_list(ratings)
+    buckets = {kind: {} for kind in USER_STAT_BUCKETS}
+    for row in rows:
+        buckets[row["kind"]][row["bucket"]] = (row["rating_count"], row["rating_sum"])
+    rating_count, rating_sum = buckets["total"].get("", (0, 0))
+    average = rating_sum / rating_count if rating_count else None
+
+    def favorites(kind):
+        # Rank by average rating, pulled toward the user's own average
+        ranked = sorted(
+            buckets[kind].items(),
+            key=lambda item: (
+                (USER_FAVORITE_PRIOR_WEIGHT * average + item[1][1]) / (USER_FAVORITE_PRIOR_WEIGHT + item[1][0]),
+                item[1][0],
+            ),
+            reverse=True,
+        )
+        return [(name, count, total / count) for name, (count, total) in ranked[:USER_FAVORITE_LIMIT]]
+
+    return UserStats(
+        user_id=user_id,
+        rating_count=rating_count,
+        rating_sum=rating_sum,
+        histogram={bucket: count for bucket, (count, _) in sorted(buckets["rating"].items(), key=lambda item: float(item[0]))},
+        favorite_genres=favorites("genre"),
+        favorite_directors=favorites("director"),
+        activity=[(month, count, total / count) for month, (count, total) in sorted(buckets["month"].items())],
+    )
+
+
+# ---------------------------------------------------------
+# Change log
+# ---------------------------------------------------------
+# Every create, update and delete made through this module is also written to the change_log table, in the
+#  same transaction, so the log can never disagree with the data. Each entry has a sequence number that
+#  only ever goes up, so a consumer that keeps the last number it has seen can ask for just the changes
+#  since then (GET /api/changes?since=...) instead of pulling everything again.
+# The log is compacted from time to time: once an entry is older than CHANGE_LOG_RETENTION seconds and a
+#  newer entry exists for the same record, the older one is removed. A consumer that falls behind skips the
+#  in between states, but always ends up with the latest state (or the delete) of every record.
+# Writes made with run_query() are not logged. A "reset" entry means the data was reloaded, so consumers
+#  have to sync from scratch.
+CHANGE_LOG_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        entity TEXT NOT NULL,
+        entity_id INTEGER,
+        op TEXT NOT NULL,
+        data TEXT,
+        changed_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_change_log_entity ON change_log (entity, entity_id, seq)",
+]
+
+CHANGE_LOG_RETENTION = float(os.environ.get("MOVIE_DB_CHANGE_LOG_RETENTION", str(24 * 60 * 60)))
+# Compact the log after this many changes have been logged by a process
+CHANGE_LOG_COMPACT_EVERY = 1000
+MAX_CHANGES_PAGE = 1000
+
+_changes_since_compaction = 0
+
+def _log_changes(cursor, entity: str, op: str, id_query: str, params=()):
+    """
+    Add the same change for every record an ID query selects, as one statement.
+
+    Args:
+        cursor (sqlite3.Cursor): A cursor on the connection making the change.
+        entity (str): "user", "movie" or "rating".
+        op (str): The change, e.g. "delete".
+        id_query (str): A SELECT of the IDs of the records that changed, as a column named "id".
+        params (tuple, optional): The parameters for the query.
+    """
+    global _changes_since_compaction
+    cursor.execute(
+        f"INSERT INTO change_log (entity, entity_id, op) SELECT ?, changed.id, ? FROM ({id_query}) AS changed",
+        (entity, op, *params),
+    )
+    _changes_since_compaction += cursor.rowcount
+
+def _log_change(cursor, entity: str, entity_id: int, op: str, data: dict = None):
+    """
+    Add an entry to the change log as part of the caller's transaction.
+
+    Args:
+        cursor (sqlite3.Cursor): A cursor on the connection making the change.
+        entity (str): "user", "movie" or "rating".
+        entity_id (int): The ID of the record that changed.
+        op (str): "create", "update" or "delete".
+        data (dict, optional): The record's new values, for creates and updates.
+    """
+    global _changes_since_compaction
+    cursor.execute(
+        "INSERT INTO change_log (entity, entity_id, op, data) VALUES (?, ?, ?, ?)",
+        (entity, entity_id, op, json.dumps(data) if data is not None else None),
+    )
+    _changes_since_compaction += 1
+    if _changes_since_compaction >= CHANGE_LOG_COMPACT_EVERY:
+        _changes_since_compaction = 0
+        _compact_change_log(cursor, CHANGE_LOG_RETENTION)
+
+def _compact_change_log(cursor, retention: float) -> int:
+    cursor.execute(
+        """DELETE FROM change_log
+           WHERE changed_at < strftime('%Y-%m-%dT%H:%M:%fZ', 'now', ?)
+             AND entity_id IS NOT NULL
+             AND EXISTS (
+                 SELECT 1 FROM change_log newer
+                 WHERE newer.entity = change_log.entity AND newer.entity_id = change_log.entity_id
+                   AND newer.seq > change_log.seq
+             )""",
+        (f"-{retention} seconds",),
+    )
+    return cursor.rowcount
+
+def compact_change_log(retention: float = None) -> int:
+    """
+    Remove change log entries that are older than the retention period and have been superseded by a newer
+    entry for the same record.
+    Args:
+        retention (float, optional): How many seconds of full history to keep. Defaults to CHANGE_LOG_RETENTION.
+    Returns:
+        int: The number of entries removed.
+    """
+    with write_transaction() as cursor:
+        return _compact_change_log(cursor, CHANGE_LOG_RETENTION if retention is None else retention)
+
+def get_changes(since: int = 0, limit: int = 100, entity: str = None, fresh: bool = False) -> List[Change]:
+    """
+    Retrieve the changes made after a sequence number, in the order they were made.
+    Args:
+        since (int, optional): The sequence number of the last change already seen. Defaults to 0 (everything).
+        limit (int, optional): The most changes to return. Defaults to 100.
+        entity (str, optional): Only return changes to "user", "movie" or "rating" records (and resets).
+        fresh (bool, optional): Read the main database instead of a read replica, so that changes show up
+            as soon as they are committed. Defaults to False.
+    Returns:
+        List[Change]: The changes, oldest first.
+    Raises:
+        ValueError: If the limit isn't valid.
+    """
+    if limit < 1 or limit > MAX_CHANGES_PAGE:
+        raise ValueError(f"The limit must be between 1 and {MAX_CHANGES_PAGE}")
+    return _read_changes(since, limit, entity, fresh)
+
+def get_changes_page(since: int = 0, limit: int = 100, entity: str = None):
+    """
+    Retrieve a page of the changes made after a sequence number, like get_changes().
+    Returns:
+        tuple: The changes, oldest first, and whether there are more changes after them.
+    Raises:
+        ValueError: If the limit isn't valid.
+    """
+    if limit < 1 or limit > MAX_CHANGES_PAGE:
+        raise ValueError(f"The limit must be between 1 and {MAX_CHANGES_PAGE}")
+    # Fetch one extra change so that we know whether there is another page
+    changes = _read_changes(since, limit + 1, entity)
+    return changes[:limit], len(changes) > limit
+
+def _read_changes(since: int, limit: int, entity: str = None, fresh: bool = False) -> List[Change]:
+    query = "SELECT seq, entity, entity_id, op, data, changed_at FROM change_log WHERE seq > ?"
+    params = [since]
+    if entity:
+        query += " AND entity IN (?, '*')"
+        params.append(entity)
+    query += " ORDER BY seq LIMIT ?"
+    params.append(limit)
+
+    conn = get_read_connection(use_replica=not fresh)
+    rows = conn.execute(query, params).fetchall()
+    conn.close()
+    return [
+        Change(row["seq"], row["entity"], row["entity_id"], row["op"],
+               json.loads(row["data"]) if row["data"] is not None else None, row["changed_at"])
+        for row in rows
+    ]
+
+def get_latest_change_seq() -> int:
+    """
+    Returns:
+        int: The sequence number of the most recent change, or 0 if nothing has changed yet.
+    """
+    conn = get_read_connection()
+    row = conn.execute("SELECT MAX(seq) FROM change_log").fetchone()
+    conn.close()
+    return row[0] or 0
+
+
+# Every group of derived tables with the statements that create them and the function that fills them
+#  from the base tables
+DERIVED_TABLES = [
+    (("movie_scores",), MOVIE_SCORES_DDL, _rebuild_movie_scores),
+    (("genres", "movie_genres", "directors", "movie_directors"), MOVIE_NAME_INDEX_DDL, _rebuild_movie_name_index),
+    # The user statistics use the genre and director lookup tables, so they have to be built after them
+    (("user_rating_stats",), USER_RATING_STATS_DDL, _rebuild_user_rating_stats),
+    (("rating_daily_buckets",), RATING_DAILY_BUCKETS_DDL, _rebuild_rating_daily_buckets),
+]
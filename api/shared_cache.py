@@ -0,0 +1,300 @@
+# In this file, we keep cached query results in memory that every gunicorn worker shares.
+# Each worker's query cache (api/query_cache.py) is its own, so with four workers every result is cached
+#  four times, and after a deploy each worker has to fill its cache from scratch. The shared cache is a file
+#  that every worker maps into memory with mmap, so a result cached by one worker is there for all of them,
+#  and the operating system holds it once in its page cache.
+#
+# Layout of the file:
+#   header       - "MVCACHE1", the number of slots and their size, then the epoch and the clock (see below)
+#   generations  - GENERATION_SLOTS counters, one for each group of tables
+#   slots        - SLOT_COUNT slots of SLOT_SIZE bytes. A result goes in the slot picked by a hash of its key,
+#                  replacing whatever was there, with: a sequence number, the key's hash, the clock when the
+#                  result was read, a bitmask of the tables it read, the length and the serialized result.
+#
+# Invalidation uses generations instead of deleting anything. The clock counts writes. When a write commits,
+#  the clock is moved on and each table it wrote gets the new clock value as its generation (tables are
+#  hashed into GENERATION_SLOTS groups, so a write occasionally invalidates a few results it didn't need to).
+#  A result is only used if none of the tables it read has a generation newer than the clock value taken
+#  before it was read, so as soon as a write commits in any worker, every worker stops using what it changed.
+#  Writes that change the schema move the epoch instead, which invalidates everything.
+#
+# Reading takes no lock: a slot's sequence number is odd while it is being written, and a reader that sees
+#  an odd number, or a different number after copying the slot, treats it as a miss (a "seqlock").
+#  Writers lock just the slot they write with fcntl.lockf (and skip storing if another worker is writing
+#  it), and lock the header to move the clock.
+import hashlib
+import marshal
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the shared cache isn't available
+    fcntl = None
+
+MAGIC = b"MVCACHE1"
+# magic, slot count, slot size, epoch, clock
+HEADER = struct.Struct("<8sIIQQ")
+EPOCH_OFFSET = 16
+CLOCK_OFFSET = 24
+GENERATION_SLOTS = 64
+GENERATIONS_OFFSET = 64
+SLOTS_OFFSET = GENERATIONS_OFFSET + GENERATION_SLOTS * 8
+# sequence number, key hash, clock when read, table bitmask, length
+SLOT_HEADER = struct.Struct("<QQQQI")
+COUNTER = struct.Struct("<Q")
+
+# Means "every table", the same as api.query_cache.ALL_TABLES
+ALL_TABLES = "*"
+
+
+def table_bit(table: str) -> int:
+    # crc32 rather than hash(), which is different in every process
+    return 1 << (zlib.crc32(table.encode()) % GENERATION_SLOTS)
+
+
+def table_mask(tables) -> int:
+    mask = 0
+    for table in tables:
+        mask |= table_bit(table)
+    return mask
+
+
+class CachedRow(tuple):
+    """
+    A row read back from the shared cache. Like sqlite3.Row, its columns can be looked up by name or
+    position, and keys() lists the column names.
+    """
+
+    def __new__(cls, values, columns):
+        row = super().__new__(cls, values)
+        row._columns = columns
+        return row
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            item = self._columns.index(item)
+        return super().__getitem__(item)
+
+    def keys(self):
+        return list(self._columns)
+
+
+def encode_value(value):
+    """
+    Turn a result into something marshal can write: tuples of rows become (column names, row values).
+    """
+    if isinstance(value, tuple):
+        if value and all(isinstance(item, (sqlite3.Row, CachedRow)) for item in value):
+            columns = tuple(value[0].keys())
+            if all(tuple(item.keys()) == columns for item in value):
+                return ("rows", columns, [tuple(item) for item in value])
+        return ("tuple", [encode_value(item) for item in value])
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, tuple):
+        if value[0] == "rows":
+            columns = value[1]
+            return tuple(CachedRow(values, columns) for values in value[2])
+        return tuple(decode_value(item) for item in value[1])
+    return value
+
+
+class SharedCache:
+    """
+    A cache of query results in a memory-mapped file, shared by every process that opens the same file.
+    """
+
+    def __init__(self, path, slot_count: int = 2048, slot_size: int = 8192):
+        self.path = path
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.file_size = SLOTS_OFFSET + slot_count * slot_size
+        self._fd = None
+        self._map = None
+        # lockf locks belong to the process, so the threads of one process take turns with this as well
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "stored": 0, "not_stored": 0, "invalidations": 0}
+
+    def _open(self):
+        if self._map is not None:
+            return self._map
+        with self._lock:
+            if self._map is None:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                # Only one process sets the file up
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    header = os.pread(fd, HEADER.size, 0)
+                    expected = (MAGIC, self.slot_count, self.slot_size)
+                    if (os.fstat(fd).st_size != self.file_size or len(header) < HEADER.size
+                            or HEADER.unpack(header)[:3] != expected):
+                        os.ftruncate(fd, 0)
+                        os.ftruncate(fd, self.file_size)
+                        os.pwrite(fd, HEADER.pack(MAGIC, self.slot_count, self.slot_size, 0, 0), 0)
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                self._fd = fd
+                self._map = mmap.mmap(fd, self.file_size)
+        return self._map
+
+    def current(self) -> int:
+        """
+        Returns:
+            int: The clock, to take before reading a result that will be stored with put().
+        """
+        return COUNTER.unpack_from(self._open(), CLOCK_OFFSET)[0]
+
+    def changed_since(self, tables, clock: int) -> bool:
+        """
+        Check whether any of these tables has been written to since the clock showed this value.
+        """
+        shared = self._open()
+        if COUNTER.unpack_from(shared, EPOCH_OFFSET)[0] > clock:
+            return True
+        mask = table_mask(tables)
+        for slot in range(GENERATION_SLOTS):
+            if mask & (1 << slot) and COUNTER.unpack_from(shared, GENERATIONS_OFFSET + slot * 8)[0] > clock:
+                return True
+        return False
+
+    def invalidate(self, tables):
+        """
+        Move the generation of these tables on, so no process uses a result that read them any more.
+        Args:
+            tables (iterable of str): The tables that were written to, or ALL_TABLES.
+        """
+        tables = set(tables)
+        if not tables:
+            return
+        shared = self._open()
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, SLOTS_OFFSET, 0)
+            try:
+                clock = COUNTER.unpack_from(shared, CLOCK_OFFSET)[0] + 1
+                COUNTER.pack_into(shared, CLOCK_OFFSET, clock)
+                if ALL_TABLES in tables:
+                    COUNTER.pack_into(shared, EPOCH_OFFSET, clock)
+                else:
+                    mask = table_mask(tables)
+                    for slot in range(GENERATION_SLOTS):
+                        if mask & (1 << slot):
+                            COUNTER.pack_into(shared, GENERATIONS_OFFSET + slot * 8, clock)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, SLOTS_OFFSET, 0)
+            self._stats["invalidations"] += 1
+
+    def get(self, key):
+        """
+        Returns:
+            tuple: The tables the result read and the result, or None if it isn't cached or is out of date.
+        """
+        shared = self._open()
+        key_bytes = marshal.dumps(key)
+        key_hash = self._hash(key_bytes)
+        offset = self._slot_offset(key_hash)
+        sequence, stored_hash, clock, mask, length = SLOT_HEADER.unpack_from(shared, offset)
+        if sequence % 2 or stored_hash != key_hash or length == 0:
+            self._count("misses")
+            return None
+        payload = shared[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + length]
+        if SLOT_HEADER.unpack_from(shared, offset)[0] != sequence:
+            # Another process wrote the slot while we were copying it
+            self._count("misses")
+            return None
+        try:
+            stored_key, tables, value = marshal.loads(payload)
+        except (EOFError, ValueError, TypeError):
+            # Left half written by a process that died while writing it
+            self._count("misses")
+            return None
+        if stored_key != key_bytes:
+            self._count("misses")
+            return None
+        if self.changed_since(tables, clock):
+            self._count("stale")
+            return None
+        self._count("hits")
+        return tables, decode_value(value)
+
+    def put(self, key, value, tables, clock: int) -> bool:
+        """
+        Store a result, replacing whatever was in its slot.
+        Args:
+            key: The result's key (anything marshal can write).
+            value: The result: tuples of rows and values.
+            tables (set of str): The tables the result read.
+            clock (int): The value of current() from before the result was read.
+        Returns:
+            bool: Whether the result was stored. It isn't if it is too big for a slot, if one of its tables
+            was written to while it was being read, or if another process is writing the same slot.
+        """
+        shared = self._open()
+        key_bytes = marshal.dumps(key)
+        payload = marshal.dumps((key_bytes, tuple(sorted(tables)), encode_value(value)))
+        if not tables or len(payload) > self.slot_size - SLOT_HEADER.size or self.changed_since(tables, clock):
+            self._count("not_stored")
+            return False
+        key_hash = self._hash(key_bytes)
+        offset = self._slot_offset(key_hash)
+        with self._lock:
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, self.slot_size, offset)
+            except OSError:
+                self._stats["not_stored"] += 1
+                return False
+            try:
+                sequence = SLOT_HEADER.unpack_from(shared, offset)[0]
+                # Odd while the slot is being written, so readers know to skip it
+                COUNTER.pack_into(shared, offset, sequence + 1)
+                shared[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + len(payload)] = payload
+                SLOT_HEADER.pack_into(shared, offset, sequence + 1, key_hash, clock, table_mask(tables), len(payload))
+                COUNTER.pack_into(shared, offset, sequence + 2)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.slot_size, offset)
+            self._stats["stored"] += 1
+        return True
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: This process's hits, misses, out of date results and stores, and the hit ratio.
+        """
+        stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"] + stats["stale"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else None
+        stats["slots"] = self.slot_count
+        stats["slot_size"] = self.slot_size
+        return stats
+
+    def reset(self):
+        """
+        Give a newly forked worker its own lock and statistics. The mapping itself is shared on purpose.
+        """
+        self._lock = threading.Lock()
+        for name in self._stats:
+            self._stats[name] = 0
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            os.close(self._fd)
+            self._map = None
+            self._fd = None
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _hash(self, key_bytes: bytes) -> int:
+        # Never 0, which marks a slot that has never been written
+        return int.from_bytes(hashlib.blake2b(key_bytes, digest_size=8).digest(), "little") or 1
+
+    def _slot_offset(self, key_hash: int) -> int:
+        return SLOTS_OFFSET + (key_hash % self.slot_count) * self.slot_size
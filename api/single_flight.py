@@ -0,0 +1,124 @@
+# In this file, we make concurrent identical reads share one trip to the database ("single flight").
+# When a popular movie is linked somewhere, hundreds of requests for the same page arrive at once. Right
+#  after a write has invalidated the cached results (see api/query_cache.py), none of them finds the result
+#  in the cache, so every thread would run the same queries in parallel. With single flight, the first
+#  thread runs the read and the others wait for it and get the same result (or the same exception).
+#
+# Only reads that are already running are shared: once the first thread has its result, the next call runs
+#  the read again (or, usually, finds it in the query cache). forget() makes later calls start a new read
+#  instead of waiting on one that started before a write committed, so they see the write.
+import threading
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Runs each call once at a time per key, giving its result to every caller that asked while it ran.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._stats = {}
+
+    def do(self, key, call, name: str = "call"):
+        """
+        Run call(), or wait for the call already running with the same key and return its result.
+        Args:
+            key: What identifies identical calls (anything hashable).
+            call (callable): Takes no arguments and returns the result, which is shared by every caller
+                that waited for it, so it mustn't be changed.
+            name (str, optional): What the call is for, to report the statistics by.
+        Returns:
+            The result of call().
+        Raises:
+            Whatever call() raised, in the caller that ran it and in every caller that waited for it.
+        """
+        with self._lock:
+            stats = self._stats_for(name)
+            stats["calls"] += 1
+            flight = self._flights.get(key)
+            waiting = flight is not None
+            if waiting:
+                flight.waiters += 1
+                stats["coalesced"] += 1
+            else:
+                flight = self._flights[key] = _Flight()
+                stats["executions"] += 1
+        if waiting:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = call()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                if flight.error is not None:
+                    stats["errors"] += 1
+                stats["max_waiters"] = max(stats["max_waiters"], flight.waiters)
+            flight.done.set()
+        return flight.result
+
+    def forget(self):
+        """
+        Make calls from now on run again rather than wait for a call that is already running (e.g. because
+        a write has committed since it started). The callers already waiting still get its result.
+        """
+        with self._lock:
+            self._flights.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Overall (total) and for each kind of call (calls): how many calls there were, how many of
+            them ran and how many waited for another one instead, the share that waited, the most callers
+            that waited for one call and how many calls failed.
+        """
+        with self._lock:
+            by_name = {name: dict(stats) for name, stats in self._stats.items()}
+            in_flight = len(self._flights)
+        totals = {}
+        for stats in by_name.values():
+            for counter, value in stats.items():
+                if counter == "max_waiters":
+                    totals[counter] = max(totals.get(counter, 0), value)
+                else:
+                    totals[counter] = totals.get(counter, 0) + value
+            stats["coalesced_ratio"] = _coalesced_ratio(stats)
+        totals["coalesced_ratio"] = _coalesced_ratio(totals)
+        return {"in_flight": in_flight, "total": totals, "calls": by_name}
+
+    def reset(self):
+        """
+        Forget the calls and statistics, and replace the lock (for a newly forked worker).
+        """
+        self._lock = threading.Lock()
+        self._flights.clear()
+        self._stats.clear()
+
+    def _stats_for(self, name: str) -> dict:
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = self._stats[name] = {"calls": 0, "executions": 0, "coalesced": 0, "max_waiters": 0, "errors": 0}
+        return stats
+
+
+def _coalesced_ratio(stats: dict):
+    calls = stats.get("calls", 0)
+    return stats.get("coalesced", 0) / calls if calls else None
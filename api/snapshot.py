@@ -0,0 +1,206 @@
+# In this file, we write the analytics arrays (see analytics.py) to disk so that every worker can share them.
+# Without this each gunicorn worker loads its own copy of the ratings into memory, so adding workers adds
+#  memory. A snapshot is a folder with one .npy file per array. Workers open the files with np.load(...,
+#  mmap_mode="r"), which maps them into memory instead of reading them: the pages live in the operating
+#  system's page cache once, however many workers map them, and nothing is copied.
+#
+# Layout of SNAPSHOT_DIRECTORY:
+#   CURRENT                          - the name of the newest complete snapshot
+#   v000000001234-1700000000000000/  - one snapshot: the last change it includes, then when it was built
+#       manifest.json                - the format version, the change sequence number, the genre names and titles
+#       rating_id.npy, by_movie.npy, movie_indptr.npy, ...
+#
+# Publishing a new version never disturbs a worker reading the old one:
+#   1. The snapshot is written to a hidden temporary folder, and each file is flushed to disk.
+#   2. The folder is renamed to its version name, which is atomic, so a version folder is always complete.
+#   3. CURRENT is replaced (write a temporary file, then os.replace) to point at the new version.
+#   4. All but the newest KEEP_VERSIONS versions are deleted. A worker that still has an old one mapped keeps
+#      reading it (the files only really disappear once nobody has them open).
+# Readers check CURRENT every time the analytics engine refreshes and map the new version when it changes,
+#  so workers pick up new snapshots without being restarted.
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+import numpy as np
+from api import analytics, services
+
+try:
+    import fcntl
+except ImportError:  # Windows, where only one builder at a time can't be guaranteed
+    fcntl = None
+
+SNAPSHOT_DIRECTORY = Path(os.environ.get("MOVIE_API_SNAPSHOT_DIR", services.DATABASE_FILE.parent / "snapshots"))
+# Increased whenever the files in a snapshot change, so old snapshots aren't misread
+FORMAT_VERSION = 1
+# How many versions to keep on disk
+KEEP_VERSIONS = 3
+
+# The arrays in a snapshot: the rating columns, the indexes over them, then the movie columns
+RATING_ARRAYS = ("rating_id", "user_id", "movie_id", "rating", "days")
+MOVIE_ARRAYS = ("year_by_id", "genre_index", "genre_movie_id")
+
+
+def build_snapshot(directory: Path = None, wait: bool = True):
+    """
+    Read the ratings from the database and publish them as a new snapshot.
+    Only one process builds at a time. If the newest published snapshot already includes every change by
+    the time this one gets its turn, nothing is built.
+    Args:
+        directory (Path, optional): Where the snapshots are kept. Defaults to SNAPSHOT_DIRECTORY.
+        wait (bool, optional): Wait for another process that is building one to finish. Defaults to True.
+    Returns:
+        Path: The newest snapshot, or None if wait is False and another process is building one.
+    """
+    directory = Path(directory or SNAPSHOT_DIRECTORY)
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / ".build.lock", "a") as lock_file:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+            except BlockingIOError:
+                return None
+        try:
+            conn = services.get_read_connection(use_replica=False)
+            try:
+                # One read transaction, so the change sequence number and the rows agree with each other
+                conn.execute("BEGIN")
+                latest_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+                current = read_current(directory)
+                if current is not None and read_manifest(directory / current)["change_seq"] == latest_seq:
+                    return directory / current
+                columns = analytics.RatingColumns(
+                    *analytics.read_ratings(conn), movies=analytics.read_movies(conn), change_seq=latest_seq
+                )
+            finally:
+                conn.close()
+            return write_snapshot(columns, directory)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_snapshot(columns, directory: Path = None) -> Path:
+    """
+    Write a set of analytics arrays to disk and make them the newest snapshot.
+    Args:
+        columns (analytics.RatingColumns): The arrays to write.
+        directory (Path, optional): Where the snapshots are kept. Defaults to SNAPSHOT_DIRECTORY.
+    Returns:
+        Path: The new snapshot's folder.
+    """
+    directory = Path(directory or SNAPSHOT_DIRECTORY)
+    created_at = time.time()
+    version = f"v{columns.change_seq:012d}-{time.time_ns() // 1000}"
+    temporary_folder = directory / f".{version}.{os.getpid()}.tmp"
+    temporary_folder.mkdir(parents=True)
+
+    arrays = {name: getattr(columns, name) for name in RATING_ARRAYS + analytics.RatingColumns.INDEX_ARRAYS}
+    arrays.update({name: getattr(columns.movies, name) for name in MOVIE_ARRAYS})
+    for name, array in arrays.items():
+        with open(temporary_folder / f"{name}.npy", "wb") as file:
+            np.save(file, np.ascontiguousarray(array))
+            file.flush()
+            os.fsync(file.fileno())
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "change_seq": columns.change_seq,
+        "created_at": created_at,
+        "ratings": len(columns),
+        "genre_names": columns.movies.genre_names,
+        "titles": [[movie_id, title] for movie_id, title in columns.movies.titles.items()],
+    }
+    with open(temporary_folder / "manifest.json", "w") as file:
+        json.dump(manifest, file)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.rename(temporary_folder, directory / version)
+    temporary_pointer = directory / f"CURRENT.{os.getpid()}.tmp"
+    temporary_pointer.write_text(version)
+    os.replace(temporary_pointer, directory / "CURRENT")
+    remove_old_versions(directory)
+    return directory / version
+
+
+def remove_old_versions(directory: Path, keep: int = None):
+    keep = KEEP_VERSIONS if keep is None else keep
+    current = read_current(directory)
+    # Version names sort in the order they were built
+    versions = sorted(path.name for path in directory.glob("v*") if path.is_dir())
+    for name in versions[:-keep] if keep > 0 else versions:
+        if name != current:
+            shutil.rmtree(directory / name, ignore_errors=True)
+
+
+def read_current(directory: Path):
+    """
+    Returns:
+        str: The name of the newest snapshot, or None if none has been published.
+    """
+    try:
+        return (Path(directory) / "CURRENT").read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def read_manifest(folder: Path) -> dict:
+    with open(Path(folder) / "manifest.json", "r") as file:
+        return json.load(file)
+
+
+def open_snapshot(folder: Path):
+    """
+    Map a snapshot's arrays into memory.
+    Returns:
+        tuple: The analytics.RatingColumns and the snapshot's manifest.
+    Raises:
+        ValueError: If the snapshot was written in a different format.
+    """
+    folder = Path(folder)
+    manifest = read_manifest(folder)
+    if manifest["format_version"] != FORMAT_VERSION:
+        raise ValueError(f"Snapshot {folder.name} has format {manifest['format_version']}, expected {FORMAT_VERSION}")
+    arrays = {
+        name: np.load(folder / f"{name}.npy", mmap_mode="r")
+        for name in RATING_ARRAYS + analytics.RatingColumns.INDEX_ARRAYS + MOVIE_ARRAYS
+    }
+    movies = analytics.MovieColumns(
+        year_by_id=arrays["year_by_id"],
+        titles={movie_id: title for movie_id, title in manifest["titles"]},
+        genre_names=manifest["genre_names"],
+        genre_index=arrays["genre_index"],
+        genre_movie_id=arrays["genre_movie_id"],
+    )
+    columns = analytics.RatingColumns(
+        *(arrays[name] for name in RATING_ARRAYS),
+        movies=movies,
+        change_seq=manifest["change_seq"],
+        **{name: arrays[name] for name in analytics.RatingColumns.INDEX_ARRAYS},
+    )
+    return columns, manifest
+
+
+class SnapshotReader:
+    """
+    Keeps the newest published snapshot mapped, switching to a newer one when it is published.
+    """
+
+    def __init__(self, directory: Path = None):
+        self.directory = Path(directory or SNAPSHOT_DIRECTORY)
+        self.version = None
+        self.columns = None
+        self.created_at = None
+
+    def load(self):
+        """
+        Returns:
+            analytics.RatingColumns: The newest snapshot's arrays, or None if none has been published.
+        """
+        version = read_current(self.directory)
+        if version is not None and version != self.version:
+            self.columns, manifest = open_snapshot(self.directory / version)
+            self.created_at = manifest["created_at"]
+            self.version = version
+        return self.columns
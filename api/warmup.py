@@ -0,0 +1,57 @@
+# In this file, we warm up a newly started worker before it serves real traffic.
+# A fresh worker process starts cold: the first requests it handles pay for checking the derived tables,
+#  reading the database pages from disk, compiling the search SQL (see movie_query.py) and compressing the
+#  responses (see compression.py). Straight after a deploy every worker is cold at once, so those first
+#  requests are noticeably slow.
+# warm_up() sends the app a request for each of the busiest endpoints through Flask's test client, which goes
+#  through exactly the same code as a real request, so every one of those caches is filled before the worker
+#  accepts its first connection. The paths can be changed with WARM_UP_PATHS in the app config.
+import time
+from api import services
+
+WARM_UP_PATHS = (
+    "/api/movies/top",
+    "/api/movies/top?min_ratings=3",
+    "/api/movies",
+    "/api/movies/search?sort=-rating",
+    "/api/movies/search?sort=title",
+    "/api/movies/search?sort=-year&facets=genre,decade,director",
+    "/api/users",
+)
+
+
+def prepare_database():
+    """
+    Build any missing derived tables and indexes (see services.ensure_schema).
+    Run this in the server's main process before the workers are forked, so the workers don't all start
+    by queueing for the write lock to check the same tables.
+    """
+    services.get_db_connection().close()
+
+
+def warm_up(app, paths=None) -> dict:
+    """
+    Request each of the warm-up paths once, with gzip accepted as most clients do.
+    Args:
+        app (Flask): The application to warm up.
+        paths (list of str, optional): The paths to request. Defaults to WARM_UP_PATHS from the app config.
+    Returns:
+        dict: The status code and the time in seconds of each request, keyed by path.
+    """
+    if paths is None:
+        paths = app.config.get("WARM_UP_PATHS", WARM_UP_PATHS)
+    timings = {}
+    started = time.perf_counter()
+    with app.test_client() as client:
+        for path in paths:
+            request_started = time.perf_counter()
+            response = client.get(path, headers={"Accept-Encoding": "gzip"})
+            timings[path] = {
+                "status": response.status_code,
+                "seconds": round(time.perf_counter() - request_started, 4),
+            }
+    failed = [path for path, timing in timings.items() if timing["status"] >= 400]
+    app.logger.info("Warmed up %d paths in %.3fs", len(timings), time.perf_counter() - started)
+    if failed:
+        app.logger.warning("Warm-up requests failed for: %s", ", ".join(failed))
+    return timings
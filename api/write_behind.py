@@ -0,0 +1,209 @@
+# In this file, we define the write-behind writer for new ratings.
+# Normally every POST /api/ratings opens a connection, inserts one row and commits, and every commit waits
+#  for the data to be flushed to disk. Under a burst of ratings the requests end up queueing for SQLite's
+#  write lock one at a time.
+# With write-behind turned on (RATING_WRITE_BEHIND in the app config, or MOVIE_API_WRITE_BEHIND=1), the
+#  route hands the rating to a single writer thread instead. The writer collects whatever arrives within a
+#  few milliseconds and saves it all in one transaction, so many ratings share one commit ("group commit").
+# The route can either reply straight away with a tracking ID (202 Accepted) or wait until the rating has
+#  been committed. If the queue is full the route replies 503 so that clients back off.
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from api import services
+from api.models import Rating
+
+PENDING = "pending"
+COMMITTED = "committed"
+FAILED = "failed"
+
+
+class WriteTicket:
+    """
+    Tracks a rating from the moment it is queued until it has been committed (or has failed).
+    """
+
+    def __init__(self, rating: Rating):
+        self.tracking_id = uuid.uuid4().hex
+        self.rating = rating
+        self.status = PENDING
+        self.error = None
+        self.queued_at = time.time()
+        self._done = threading.Event()
+
+    def __repr__(self):
+        return f'<WriteTicket {self.tracking_id} - {self.status}>'
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Wait for the rating to be committed or to fail.
+        Returns:
+            bool: True if the write finished, False if the timeout ran out first.
+        """
+        return self._done.wait(timeout)
+
+    def finish(self, status: str, error: str = None):
+        self.status = status
+        self.error = error
+        self._done.set()
+
+    def to_dict(self):
+        ticket_dict = {
+            'tracking_id': self.tracking_id,
+            'status': self.status,
+            'rating': self.rating.to_dict(),
+        }
+        if self.error:
+            ticket_dict['error'] = self.error
+        return ticket_dict
+
+
+class RatingWriter:
+    """
+    A single background thread that saves queued ratings in batches.
+
+    Args:
+        max_queue (int): How many ratings can be waiting before submit() refuses more.
+        batch_interval (float): How many seconds to keep collecting ratings after the first one arrives.
+        max_batch (int): The most ratings to save in one transaction.
+        max_tickets (int): How many finished tickets to remember for status lookups.
+    """
+
+    def __init__(self, max_queue: int = 1000, batch_interval: float = 0.005, max_batch: int = 200, max_tickets: int = 10000):
+        self.batch_interval = batch_interval
+        self.max_batch = max_batch
+        self.max_tickets = max_tickets
+        self.batches = 0
+        self.committed = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._tickets = OrderedDict()
+        self._tickets_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def __repr__(self):
+        return f'<RatingWriter {self._queue.qsize()} queued>'
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="rating-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Stop the writer once everything already queued has been saved.
+        """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, rating: Rating) -> WriteTicket:
+        """
+        Queue a rating to be saved.
+        Returns:
+            WriteTicket: The ticket to follow the write with.
+        Raises:
+            queue.Full: If too many ratings are already waiting.
+        """
+        ticket = WriteTicket(rating)
+        self._queue.put_nowait(ticket)
+        with self._tickets_lock:
+            self._tickets[ticket.tracking_id] = ticket
+            # Forget the oldest tickets once we are tracking too many
+            while len(self._tickets) > self.max_tickets:
+                self._tickets.popitem(last=False)
+        return ticket
+
+    def get_ticket(self, tracking_id: str) -> WriteTicket:
+        with self._tickets_lock:
+            return self._tickets.get(tracking_id)
+
+    def stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize(),
+            'batches': self.batches,
+            'committed': self.committed,
+            'failed': self.failed,
+            'average_batch_size': self.committed / self.batches if self.batches else None,
+        }
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            try:
+                first = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            batch = [first]
+            deadline = time.monotonic() + self.batch_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        """
+        Save a batch of ratings in one transaction.  Each rating gets its own savepoint, so one bad rating
+        fails on its own rather than taking the rest of the batch with it.
+        Any error fails the ratings it affects rather than the writer thread: a dead writer would leave
+        every ticket after it waiting forever.
+        """
+        results = []
+        try:
+            with services.write_transaction() as cursor:
+                for ticket in batch:
+                    cursor.execute("SAVEPOINT rating_write")
+                    try:
+                        ticket.rating.rating_id = services.insert_rating(cursor, ticket.rating)
+                        results.append((ticket, None))
+                    except Exception as error:
+                        cursor.execute("ROLLBACK TO SAVEPOINT rating_write")
+                        results.append((ticket, str(error)))
+                    cursor.execute("RELEASE SAVEPOINT rating_write")
+        except Exception as error:
+            # The transaction as a whole failed, so nothing in the batch was saved
+            results = [(ticket, str(error)) for ticket in batch]
+
+        self.batches += 1
+        for ticket, error in results:
+            if error is None:
+                self.committed += 1
+                ticket.finish(COMMITTED)
+            else:
+                self.failed += 1
+                ticket.rating.rating_id = None
+                ticket.finish(FAILED, error)
+
+
+# Each process has its own writer, created the first time it is needed
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def write_behind_enabled_by_default() -> bool:
+    return os.environ.get("MOVIE_API_WRITE_BEHIND", "0") == "1"
+
+
+def get_writer() -> RatingWriter:
+    """
+    Get this process's rating writer, starting it if needed.
+    A forked worker process doesn't inherit the parent's writer thread, so it gets a writer of its own.
+    """
+    global _writer, _writer_pid
+    with _writer_lock:
+        if _writer is None or _writer_pid != os.getpid():
+            _writer = RatingWriter()
+            _writer_pid = os.getpid()
+        _writer.start()
+        return _writer
@@ -0,0 +1,70 @@
+# The gunicorn settings for running the API in production.
+# gunicorn reads this file automatically when it is started from the project folder, e.g.
+#   gunicorn "run:create_app()"
+# Options can be passed to the app factory in the same string (see create_app in run.py), e.g.
+#   gunicorn "run:create_app(RATING_WRITE_BEHIND=True)"
+#
+# How it works:
+#   - preload_app creates the app once in the main process, before the workers are forked. The imports and
+#     the database preparation happen once, and the workers share the loaded code instead of each loading it.
+#   - Each forked worker then replaces the locks and caches it inherited and requests the busiest endpoints
+#     once (post_worker_init), so the first requests after a deploy aren't slow.
+#   - The workers are "gthread" workers, which handle several requests at once on a pool of threads. Requests
+#     spend much of their time waiting on SQLite, so threads let a worker keep busy in the meantime.
+#     An open /api/ratings/stream holds one of those threads for as long as it is open (up to 5 minutes). For
+#     more than a handful of live viewers per worker, use more threads or GUNICORN_WORKER_CLASS=gevent.
+#
+# The main settings can be changed with environment variables:
+#   GUNICORN_BIND         - the address to listen on (default 0.0.0.0:8000)
+#   WEB_CONCURRENCY       - the number of worker processes (default 4)
+#   GUNICORN_WORKER_CLASS - the worker type, e.g. "sync" for one request at a time per worker (default gthread)
+#   GUNICORN_THREADS      - the number of threads in each gthread worker (default 4). Admission control reads
+#                           it too, to leave point lookups a thread however many list requests arrive
+#                           (see api/admission.py), so set the threads here rather than with --threads.
+#   GUNICORN_TIMEOUT      - seconds a worker can be silent before it is restarted (default 30)
+#   GUNICORN_WARM_UP      - set to 0 to skip warming up the workers (default 1)
+#
+# The workers share one cache of query results (see api/shared_cache.py), unless MOVIE_DB_SHARED_CACHE=0.
+#
+# Rate limiting each client is off unless MOVIE_API_RATE_LIMIT is set (requests a second per client). Behind
+#  a proxy or load balancer every request comes from the proxy's address, so also set
+#  MOVIE_API_TRUST_FORWARDED=1 to tell the clients apart by the X-Forwarded-For header the proxy sets
+#  (only if the proxy replaces any X-Forwarded-For the client sent, since clients can set it to anything).
+import os
+
+# Set before the app is loaded, since api.services reads it on import
+os.environ.setdefault("MOVIE_DB_SHARED_CACHE", "1")
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "4"))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "30"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+preload_app = True
+wsgi_app = "run:create_app()"
+
+# Restart each worker after a while (at a slightly different time for each) to keep memory use in check
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "5000"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", "500"))
+
+accesslog = "-"
+errorlog = "-"
+
+warm_up_workers = os.environ.get("GUNICORN_WARM_UP", "1") == "1"
+
+
+def when_ready(server):
+    # Runs in the main process once the app has been loaded, before any workers are forked
+    from api.warmup import prepare_database
+    prepare_database()
+    if os.environ.get("MOVIE_API_ANALYTICS_SNAPSHOTS", "0") == "1":
+        # The workers share the analytics arrays through a snapshot on disk, so have one ready for them
+        from api.snapshot import build_snapshot
+        build_snapshot()
+
+
+def post_worker_init(worker):
+    # Runs in each worker after it has been forked, before it accepts any connections
+    from run import init_worker
+    init_worker(worker.wsgi, warm=warm_up_workers)
@@ -1,8 +1,13 @@
+import os
 from flask import Flask
 from flask_cors import CORS
-from flasgger import Swagger # Only required if you want to use Swagger UI
-import yaml
+from api.apidocs import LazySwagger # Only required if you want to use Swagger UI
 from api.routes import api_bp
+from api.compression import Compress
+from api.admission import AdmissionControl
+from api.write_behind import write_behind_enabled_by_default
+from api.warmup import warm_up
+from api import services
 from pathlib import Path
 
 # Using Blueprints to organize routes in a Flask application
@@ -16,21 +21,30 @@ from pathlib import Path
 #  be prefixed with "/api".  For example, a route defined in the blueprint as
 #  "/users" will be accessible at "/api/users" in the application.
 
+OPENAPI_FILE = Path(__file__).parent / "docs" / "openapi.yaml"
+
 
 def create_app(*args, **kwargs):
+    # Any keyword arguments are added to the app config, so the server can pass options in its app string, e.g.
+    #  gunicorn -c gunicorn.conf.py "run:create_app(RATING_WRITE_BEHIND=True, COMPRESS_LEVEL=4)"
     app = Flask(__name__)
+    # Queue new ratings for a background writer that commits them in batches (see api/write_behind.py)
+    app.config["RATING_WRITE_BEHIND"] = write_behind_enabled_by_default()
+    app.config["SWAGGER_ENABLED"] = os.environ.get("MOVIE_API_SWAGGER", "1") == "1"
+    app.config.from_mapping(kwargs)
     CORS(app)
+    # Turn requests away early when a client sends too many or the server is overloaded (see api/admission.py)
+    AdmissionControl(app)
+    # Compress responses for clients that accept gzip or deflate (see api/compression.py for the settings)
+    Compress(app)
 
-    # If you have provided an openapi.yaml file in the docs folder, load it
+    # If you have provided an openapi.yaml file in the docs folder, serve it with Swagger UI
     # This will allow you to use Swagger UI to view and test your API endpoints
     #  Run the app and go to http://localhost:5000/apidocs to view the Swagger UI
-    # Load OpenAPI specification from YAML file
-    if Path.exists(Path("docs/openapi.yaml")):
-        with open("docs/openapi.yaml", "r") as file:
-            openapi_spec = yaml.safe_load(file)
-
-        # Initialize Swagger with the OpenAPI spec
-        swagger = Swagger(app, template=openapi_spec)
+    # Swagger is only set up the first time /apidocs is requested, so it doesn't slow down start up
+    #  (see api/apidocs.py). Set SWAGGER_ENABLED to False, or MOVIE_API_SWAGGER=0, to turn it off in production.
+    if app.config["SWAGGER_ENABLED"] and OPENAPI_FILE.exists():
+        LazySwagger(app, OPENAPI_FILE)
 
     # Register Blueprints
     app.register_blueprint(api_bp, url_prefix="/api")
@@ -42,6 +56,7 @@ def create_app(*args, **kwargs):
 # If you do not want to use Swagger, you can use this version of the create_app function
 def create_app_no_swagger():
     app = Flask(__name__)
+    Compress(app)
 
     # Register Blueprints
     # Don't like the prefix?  You can remove it or change it to something else.
@@ -50,6 +65,26 @@ def create_app_no_swagger():
     return app
 
 
+# A production server like gunicorn can create the app once in its main process and then fork the workers
+#  from it (see gunicorn.conf.py). Each worker calls this before it starts handling requests.
+def init_worker(app, warm: bool = True):
+    """
+    Get a worker that was forked from a preloaded app ready to serve.
+    The worker starts with copies of the main process's locks and caches, so those are replaced with its
+    own, and then the busiest endpoints are requested once so the first real requests aren't slow.
+    Args:
+        app (Flask): The application the worker will serve.
+        warm (bool, optional): Whether to warm up the caches. Defaults to True.
+    """
+    services.reset_after_fork()
+    for name in ("compress", "admission"):
+        extension = app.extensions.get(name)
+        if extension is not None:
+            extension.reset()
+    if warm and app.config.get("WARM_UP", True):
+        warm_up(app)
+
+
 if __name__ == "__main__":
     app = create_app()
     app.run(debug=True, host="0.0.0.0", port=5000)
@@ -0,0 +1,147 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from flask import Blueprint, Flask, Response, jsonify
+from run import create_app
+from api.admission import AdmissionControl, ConcurrencyLimiter, TokenBucket, list_limits
+
+# These tests use a small Flask app of their own, with a "list" endpoint that waits until it is told to finish
+
+
+def make_app(**config):
+    release = threading.Event()
+    started = threading.Semaphore(0)
+    api = Blueprint("api", __name__)
+
+    @api.route("/movies")
+    def get_movies():
+        started.release()
+        release.wait(5)
+        return jsonify([])
+
+    @api.route("/movies/<int:movie_id>")
+    def lookup_movie_by_id(movie_id):
+        return jsonify({"movie_id": movie_id})
+
+    @api.route("/export/movies")
+    def export_table():
+        return Response(iter(["movie_id\n", "1\n"]), mimetype="text/csv")
+
+    app = Flask(__name__)
+    app.config.update(ADMISSION_RATE=0, **config)
+    admission = AdmissionControl(app)
+    app.register_blueprint(api, url_prefix="/api")
+    return app, admission, release, started
+
+
+@pytest.fixture
+def admitted():
+    return make_app(ADMISSION_LIMITS={"list": 1}, ADMISSION_QUEUE_SIZES={"list": 1}, ADMISSION_MAX_QUEUE_TIME=0.05)
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=2, now=0.0)
+    assert bucket.take(0.0) == 0 and bucket.take(0.0) == 0
+    assert bucket.take(0.0) == pytest.approx(0.1)
+    # A tenth of a second later there is a token again
+    assert bucket.take(0.1) == 0
+
+
+def test_concurrency_limiter_queues_then_turns_away():
+    limiter = ConcurrencyLimiter(limit=1, queue_size=0)
+    assert limiter.acquire(0.01) is not None
+    assert limiter.acquire(0.01) is None
+    limiter.release()
+    assert limiter.acquire(0.01) is not None
+    stats = limiter.stats()
+    assert stats["admitted"] == 2 and stats["rejected"] == 1 and stats["active"] == 1
+
+
+@pytest.mark.parametrize("threads", [1, 2, 4, 8, 32])
+def test_list_requests_leave_a_thread_free(threads):
+    limit, queue_size = list_limits(threads)
+    assert limit >= 1 and queue_size >= 0
+    assert limit + queue_size < threads or threads == 1
+
+
+def test_clients_over_their_rate_get_429():
+    app = create_app(ADMISSION_RATE=1, ADMISSION_BURST=2)
+    client = app.test_client()
+    statuses = [client.get("/api/movies/1").status_code for _ in range(3)]
+    assert statuses == [200, 200, 429]
+    response = client.get("/api/movies/1")
+    assert int(response.headers["Retry-After"]) >= 1
+    # Another client has its own bucket, and the status endpoints aren't limited
+    assert client.get("/api/movies/1", environ_base={"REMOTE_ADDR": "10.0.0.2"}).status_code == 200
+    status = client.get("/api/admission/status").get_json()
+    assert status["rate_limited"] == 2
+    assert status["classes"]["point"]["admitted"] == 3
+
+
+def test_rate_limit_is_off_by_default():
+    app = create_app()
+    assert app.config["ADMISSION_RATE"] == 0
+    client = app.test_client()
+    assert all(client.get("/api/").status_code == 200 for _ in range(5))
+    assert client.get("/api/admission/status").get_json()["rate_limited"] == 0
+
+
+def test_busy_list_requests_dont_hold_up_point_lookups(admitted):
+    app, admission, release, started = admitted
+    responses = []
+
+    def list_movies():
+        responses.append(app.test_client().get("/api/movies"))
+
+    running = threading.Thread(target=list_movies)
+    running.start()
+    assert started.acquire(timeout=5)
+    queued = threading.Thread(target=list_movies)
+    queued.start()
+
+    client = app.test_client()
+    # With one list request running and one waiting, the next is turned away straight away...
+    response = client.get("/api/movies")
+    assert response.status_code == 503 and response.headers["Retry-After"] == "1"
+    # ...but point lookups still run
+    response = client.get("/api/movies/1")
+    assert response.status_code == 200 and response.headers["Server-Timing"].startswith("queue;dur=")
+
+    queued.join()
+    release.set()
+    running.join()
+    # The waiting request gave up after ADMISSION_MAX_QUEUE_TIME
+    assert sorted(response.status_code for response in responses) == [200, 503]
+    stats = admission.stats()["classes"]["list"]
+    assert stats["rejected"] == 1 and stats["timed_out"] == 1 and stats["active"] == 0
+    assert client.get("/api/movies").status_code == 200
+
+
+def test_point_lookups_get_a_thread_in_a_busy_worker():
+    # Like a gunicorn gthread worker: a fixed pool of threads, and requests wait for a free one
+    threads = 4
+    app, admission, release, started = make_app(ADMISSION_THREADS=threads, ADMISSION_MAX_QUEUE_TIME=5)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        lists = [pool.submit(lambda: app.test_client().get("/api/movies").status_code) for _ in range(2 * threads)]
+        limit, queue_size = list_limits(threads)
+        for _ in range(limit):
+            assert started.acquire(timeout=5)
+        lookup = pool.submit(lambda: app.test_client().get("/api/movies/1").status_code)
+        # Answered while the list requests are all still running or waiting
+        assert lookup.result(timeout=2) == 200
+        assert not release.is_set()
+        release.set()
+        statuses = [future.result(timeout=10) for future in lists]
+    assert statuses.count(200) >= limit + queue_size
+    assert admission.stats()["classes"]["list"]["active"] == 0
+
+
+def test_streamed_responses_keep_their_turn_until_sent(admitted):
+    app, admission, release, started = admitted
+    response = app.test_client().get("/api/export/movies")
+    assert response.status_code == 200
+    # The body hasn't been sent yet, so the export is still running
+    assert admission.stats()["classes"]["list"]["active"] == 1
+    assert response.get_data(as_text=True) == "movie_id\n1\n"
+    response.close()
+    assert admission.stats()["classes"]["list"]["active"] == 0
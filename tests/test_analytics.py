@@ -0,0 +1,104 @@
+import pytest
+from run import create_app
+from api import services
+from api.models import Movie, Rating, User
+from api.analytics import AnalyticsEngine
+
+
+@pytest.fixture
+def engine():
+    # Refreshing on every query makes the engine see each change straight away
+    return AnalyticsEngine(refresh_interval=0)
+
+
+@pytest.fixture
+def rated_movies():
+    users = [services.create_user(User(None, f"analytics_user_{n}", f"analytics{n}@example.com")) for n in range(3)]
+    movies = [
+        Movie(None, "analytics_movie_one", "analytics_genre_a", release_year=1901, director="Test Director"),
+        Movie(None, "analytics_movie_two", "analytics_genre_a, analytics_genre_b", release_year=1901, director="Test Director"),
+        Movie(None, "analytics_movie_three", "analytics_genre_b", release_year=1902, director="Test Director"),
+    ]
+    for movie in movies:
+        movie.movie_id = services.create_movie(movie)
+    rating_ids = []
+    for user_index, movie_index, score in ((0, 0, 5), (1, 0, 4), (2, 0, 4.5), (0, 1, 2), (1, 1, 3), (0, 2, 1)):
+        rating = Rating(user_id=users[user_index], movie_id=movies[movie_index].movie_id, rating=score,
+                        review="Analytics review", date="2024-03-01")
+        rating_ids.append(services.create_rating(rating))
+    yield users, movies
+    for rating_id in rating_ids:
+        services.delete_rating(rating_id)
+    for movie in movies:
+        services.delete_movie(movie.movie_id)
+    for user_id in users:
+        services.delete_user(user_id)
+
+
+def test_movie_averages_match_the_database(engine):
+    averages = {movie["movie_id"]: movie for movie in engine.movie_averages(limit=1000)}
+    rows = services.run_query("SELECT movie_id, COUNT(*) AS total, AVG(rating) AS average FROM ratings GROUP BY movie_id")
+    assert len(averages) == len(rows)
+    for row in rows:
+        assert averages[row["movie_id"]]["rating_count"] == row["total"]
+        assert averages[row["movie_id"]]["average_rating"] == pytest.approx(row["average"], abs=1e-4)
+    listed = list(averages.values())
+    assert [movie["average_rating"] for movie in listed] == sorted((m["average_rating"] for m in listed), reverse=True)
+
+
+def test_group_by_queries(engine, rated_movies):
+    users, movies = rated_movies
+    genres = {genre["genre"]: genre for genre in engine.genre_averages()}
+    # A movie in two genres counts towards both
+    assert genres["analytics_genre_a"]["rating_count"] == 5
+    assert genres["analytics_genre_a"]["average_rating"] == pytest.approx((5 + 4 + 4.5 + 2 + 3) / 5)
+    assert genres["analytics_genre_b"]["rating_count"] == 3
+
+    years = {year["release_year"]: year for year in engine.year_averages()}
+    assert years[1901]["rating_count"] == 5
+    assert years[1902] == {"release_year": 1902, "rating_count": 1, "average_rating": 1}
+
+    assert engine.distribution(movie_id=movies[0].movie_id) == {"4": 1, "4.5": 1, "5": 1}
+    assert engine.distribution(user_id=users[0]) == {"1": 1, "2": 1, "5": 1}
+    assert engine.distribution(movie_id=movies[1].movie_id, user_id=users[1]) == {"3": 1}
+
+    co_ratings = engine.co_ratings(movies[0].movie_id)
+    assert co_ratings["rater_count"] == 3
+    assert [(movie["movie_id"], movie["co_rating_count"]) for movie in co_ratings["co_rated"]] == [
+        (movies[1].movie_id, 2), (movies[2].movie_id, 1)
+    ]
+
+
+def test_new_ratings_are_appended(engine, rated_movies):
+    users, movies = rated_movies
+    engine.get_columns()
+    loads = engine.loads
+    rating_id = services.create_rating(Rating(user_id=users[2], movie_id=movies[2].movie_id, rating=5,
+                                              review="Appended", date="2024-03-02"))
+    assert engine.distribution(movie_id=movies[2].movie_id) == {"1": 1, "5": 1}
+    assert engine.loads == loads and engine.appends >= 1
+
+    # A deleted rating can't be appended, so everything is read again
+    services.delete_rating(rating_id)
+    assert engine.distribution(movie_id=movies[2].movie_id) == {"1": 1}
+    assert engine.loads == loads + 1
+
+
+def test_analytics_routes(rated_movies):
+    users, movies = rated_movies
+    client = create_app().test_client()
+    response = client.get("/api/analytics/movies?min_ratings=3&limit=1000")
+    assert response.status_code == 200
+    assert all(movie["rating_count"] >= 3 for movie in response.get_json())
+    assert client.get("/api/analytics/genres").status_code == 200
+    assert client.get("/api/analytics/years").status_code == 200
+
+    response = client.get(f"/api/analytics/distribution?movie_id={movies[1].movie_id}")
+    assert response.get_json() == {"2": 1, "3": 1}
+    response = client.get(f"/api/analytics/movies/{movies[1].movie_id}/co-ratings?limit=1")
+    assert response.get_json()["co_rated"] == [
+        {"movie_id": movies[0].movie_id, "title": "analytics_movie_one", "co_rating_count": 2}
+    ]
+    assert client.get("/api/analytics/movies/999999/co-ratings").status_code == 404
+    assert client.get("/api/analytics/movies?limit=0").status_code == 400
+    assert client.get("/api/analytics/status").get_json()["ratings"] > 0
@@ -8,7 +8,8 @@ from flask import json
 @pytest.fixture(scope="module")
 def test_client():
     # Set up Flask test client
-    flask_app = create_app()
+    # Every request comes from the same test address, so don't rate limit it
+    flask_app = create_app(ADMISSION_RATE=0)
     flask_app.config["TESTING"] = True
     with flask_app.test_client() as testing_client:
         yield testing_client
@@ -99,6 +100,13 @@ class TestUserRoutes:
         assert user["id"] == test_user.id, "User ID does not match"
         assert user["username"] == test_user.username, "Username does not match"
 
+    def test_get_users_by_ids(self, test_client, test_user):
+        response = test_client.get(f"/api/users?ids={test_user.id},-1")
+        assert response.status_code == 200, "Response code is not 200"
+        data = response.get_json()
+        assert [user["id"] for user in data["users"]] == [test_user.id], "Users do not match"
+        assert data["missing_ids"] == [-1], "Missing IDs do not match"
+
     def test_get_users_by_starts_with_name(self, test_client, test_user):
         partial_name = test_user.username[:3]
         response = test_client.get(f"/api/users?starts_with={partial_name}")
@@ -123,6 +131,17 @@ class TestUserRoutes:
         for user in users:
             assert partial_name in user["username"].lower() , "Partial name not found in username"
 
+    def test_get_user_ratings_with_fields(self, test_client, test_user, test_ratings):
+        response = test_client.get(f"/api/users/{test_user.id}/ratings?fields=movie_id,rating")
+        assert response.status_code == 200, "Response code is not 200"
+        ratings = response.get_json()["ratings"]
+        assert len(ratings) == len(test_ratings), "Number of ratings does not match"
+        for rating in ratings:
+            assert set(rating) == {"movie_id", "rating"}, "Unexpected fields returned"
+
+        response = test_client.get(f"/api/users/{test_user.id}/ratings?fields=movie_id,colour")
+        assert response.status_code == 400, "Response code is not 400"
+
     def test_create_user(self, test_client):
         user_data = {"username": "test_user", "email": "testuser@example.com"}
         response = test_client.post("/api/users", json=user_data)
@@ -158,6 +177,26 @@ class TestUserRoutes:
         response = test_client.get(f"/api/users/{test_user.id}")
         assert response.status_code == 404, "Response code is not 404"
 
+    def test_get_user_stats(self, test_client, test_user, test_ratings):
+        response = test_client.get(f"/api/users/{test_user.id}/stats")
+        assert response.status_code == 200, "Response code is not 200"
+        stats = response.get_json()
+        assert stats["rating_count"] == len(test_ratings)
+        assert stats["histogram"] == {"3": 1, "4.5": 1, "5": 1}
+        assert stats["favorite_genres"][0]["name"] == "test_genre"
+        assert [month["month"] for month in stats["activity"]] == ["2024-03", "2024-04", "2024-08"]
+
+        response = test_client.get("/api/users/-1/stats")
+        assert response.status_code == 404, "Response code is not 404"
+
+    def test_create_user_when_database_busy(self, test_client, monkeypatch):
+        def busy(user):
+            raise services.DatabaseBusyError("The database is busy")
+        monkeypatch.setattr(services, "create_user", busy)
+        response = test_client.post("/api/users", json={"username": "busy_user", "email": "busy@example.com"})
+        assert response.status_code == 503, "Response code is not 503"
+        assert response.headers["Retry-After"] == "1"
+
 
 class TestMovieRoutes:
     def test_get_all_movies(self, test_client):
@@ -173,7 +212,54 @@ class TestMovieRoutes:
         assert movie is not None, "Movie not found"
         assert movie["movie_id"] == test_movie.movie_id, "Movie ID does not match"
         assert movie["title"] == test_movie.title, "Title does not match"
+
+    def test_get_movies_by_ids(self, test_client, test_movie):
+        response = test_client.get(f"/api/movies?ids={test_movie.movie_id},1,-1")
+        assert response.status_code == 200, "Response code is not 200"
+        data = response.get_json()
+        assert [movie["movie_id"] for movie in data["movies"]] == [test_movie.movie_id, 1], "Movies do not match"
+        assert data["missing_ids"] == [-1], "Missing IDs do not match"
+
+        response = test_client.get("/api/movies?ids=1,two")
+        assert response.status_code == 400, "Response code is not 400"
+
+    def test_get_top_movies(self, test_client, test_movie, test_ratings):
+        response = test_client.get(f"/api/movies/top?genre={test_movie.genre}&min_ratings=3")
+        assert response.status_code == 200, "Response code is not 200"
+        movies = response.get_json()
+        assert len(movies) == 1, "Test movie not on the leaderboard"
+        assert movies[0]["movie_id"] == test_movie.movie_id, "Movie ID does not match"
+        assert movies[0]["rating_count"] == len(test_ratings), "Rating count does not match"
+
+        # Asking for more ratings than the movie has should leave it off the leaderboard
+        response = test_client.get(f"/api/movies/top?genre={test_movie.genre}&min_ratings=4")
+        assert len(response.get_json()) == 0, "Movie found with too few ratings"
+
+        # A negative limit would mean "no limit" to SQLite
+        response = test_client.get("/api/movies/top?limit=-1")
+        assert response.status_code == 400, "Response code is not 400"
         
+    def test_search_movies(self, test_client, test_movie):
+        response = test_client.get(f"/api/movies/search?genre={test_movie.genre}&year_from=2020&facets=genre,decade")
+        assert response.status_code == 200, "Response code is not 200"
+        data = response.get_json()
+        assert test_movie.movie_id in [movie["movie_id"] for movie in data["movies"]], "Test movie not found"
+        assert data["facets"]["decade"]["2020"] == len(data["movies"]), "Decade count does not match"
+
+        response = test_client.get("/api/movies/search?sort=-year&limit=1")
+        data = response.get_json()
+        assert len(data["movies"]) == 1, "Limit not applied"
+        assert data["next_cursor"] is not None, "No cursor for the next page"
+
+    def test_search_movies_bad_parameters(self, test_client):
+        response = test_client.get("/api/movies/search?sort=colour")
+        assert response.status_code == 400, "Response code is not 400"
+        response = test_client.get("/api/movies/search?cursor=not-a-cursor")
+        assert response.status_code == 400, "Response code is not 400"
+        # Valid base64 and JSON, but not a cursor: [{}, 1]
+        response = test_client.get("/api/movies/search?cursor=W3t9LDFd")
+        assert response.status_code == 400, "Response code is not 400"
+
     def test_create_movie(self, test_client):
         movie_data = {
             "title": "test_movie",
@@ -253,6 +339,50 @@ class TestReviewRoutes:
         assert rating["rating"] == known_rating.rating, "Rating does not match"
 
 
+    def test_get_ratings_by_date_range(self, test_client, test_movie, test_ratings):
+        response = test_client.get(f"/api/ratings?from=2024-04-01&to=2024-12-31&movie_id={test_movie.movie_id}")
+        assert response.status_code == 200, "Response code is not 200"
+        data = response.get_json()
+        assert [rating["date"] for rating in data["ratings"]] == ["2024-04-30", "2024-08-13"]
+        assert data["next_cursor"] is None
+
+        response = test_client.get("/api/ratings?from=30/30/2024")
+        assert response.status_code == 400, "Response code is not 400"
+        # Cursors that aren't [date, rating ID]: [{}, 1] and [1, 2]
+        for cursor in ("W3t9LDFd", "WzEsIDJd"):
+            response = test_client.get(f"/api/ratings?cursor={cursor}")
+            assert response.status_code == 400, "Response code is not 400"
+
+    def test_get_rating_rollup(self, test_client, test_movie, test_ratings):
+        response = test_client.get(f"/api/ratings/rollup?period=week&movie_id={test_movie.movie_id}")
+        assert response.status_code == 200, "Response code is not 200"
+        weeks = response.get_json()
+        assert [week["period_start"] for week in weeks] == ["2024-02-26", "2024-04-29", "2024-08-12"]
+
+        response = test_client.get("/api/ratings/rollup?period=year")
+        assert response.status_code == 400, "Response code is not 400"
+
+    def test_create_rating_with_bad_date(self, test_client, test_user, test_movie):
+        rating_data = {"user_id": test_user.id, "movie_id": test_movie.movie_id, "rating": 4, "review": "", "date": "someday"}
+        response = test_client.post("/api/ratings", json=rating_data)
+        assert response.status_code == 400, "Response code is not 400"
+
+    def test_create_rating_for_missing_movie(self, test_client, test_user):
+        rating_data = {"user_id": test_user.id, "movie_id": 999999, "rating": 4, "review": "", "date": "2024-01-01"}
+        response = test_client.post("/api/ratings", json=rating_data)
+        assert response.status_code == 400, "Response code is not 400"
+
+    def test_delete_ratings_in_bulk(self, test_client, test_user, test_movie):
+        for score in (2, 4):
+            rating_data = {"user_id": test_user.id, "movie_id": test_movie.movie_id, "rating": score, "review": "", "date": "2024-01-01"}
+            test_client.post("/api/ratings", json=rating_data)
+        response = test_client.delete(f"/api/ratings?movie_id={test_movie.movie_id}&user_id={test_user.id}")
+        assert response.status_code == 200, "Response code is not 200"
+        assert response.get_json()["deleted"] == 2, "Number of deleted ratings does not match"
+        response = test_client.get(f"/api/movies/{test_movie.movie_id}/ratings")
+        assert response.get_json().get("ratings", []) == [], "Ratings were not deleted"
+        assert test_client.delete("/api/ratings").status_code == 400, "Response code is not 400"
+
     def test_get_ratings_by_movie(self, test_client, test_movie, test_ratings):
         """Test getting ratings for a specific movie by its ID."""
         response = test_client.get(f"/api/movies/{test_movie.movie_id}/ratings")
@@ -264,3 +394,33 @@ class TestReviewRoutes:
         for rating, rating_data in zip(test_ratings, ratings):
             assert rating_data["rating"] == rating.rating, "Rating does not match"
             assert rating_data["review"] == rating.review, "Review does not match"
+
+
+class TestChangeRoutes:
+    def test_get_changes(self, test_client):
+        since = services.get_latest_change_seq()
+        response = test_client.post("/api/users", json={"username": "feed_user", "email": "feed@example.com"})
+        user_id = response.get_json()["user"]["id"]
+        test_client.delete(f"/api/users/{user_id}")
+
+        response = test_client.get(f"/api/changes?since={since}&entity=user")
+        assert response.status_code == 200, "Response code is not 200"
+        data = response.get_json()
+        assert [(change["id"], change["op"]) for change in data["changes"]] == [(user_id, "create"), (user_id, "delete")]
+        assert data["changes"][0]["data"]["username"] == "feed_user"
+        assert data["next_since"] == data["changes"][-1]["seq"]
+        assert data["has_more"] is False
+
+        # A page that ends exactly at the last change has nothing more after it
+        response = test_client.get(f"/api/changes?since={since}&entity=user&limit=2")
+        assert response.get_json()["has_more"] is False
+        response = test_client.get(f"/api/changes?since={since}&entity=user&limit=1")
+        assert response.get_json()["has_more"] is True
+
+        # Nothing new since the last change
+        response = test_client.get(f"/api/changes?since={data['next_since']}&entity=user")
+        assert response.get_json()["changes"] == []
+
+    def test_get_changes_bad_parameters(self, test_client):
+        assert test_client.get("/api/changes?entity=planet").status_code == 400
+        assert test_client.get("/api/changes?limit=0").status_code == 400
@@ -0,0 +1,60 @@
+import pytest
+from run import create_app
+from api import services
+
+
+@pytest.fixture
+def client():
+    return create_app().test_client()
+
+
+def test_batch_creates_records_that_refer_to_each_other(client):
+    services.reset_write_stats()
+    operations = [
+        {"op": "create", "entity": "movie", "data": {"title": "batch_movie", "genre": "batch_genre", "release_year": 2024, "director": "Batch Director"}},
+        {"op": "create", "entity": "user", "data": {"username": "batch_user", "email": "batch@example.com"}},
+    ] + [
+        {"op": "create", "entity": "rating", "data": {"user_id": "$1", "movie_id": "$0", "rating": score, "review": "", "date": "5/1/2024"}}
+        for score in (2, 3, 4)
+    ] + [
+        {"op": "update", "entity": "rating", "id": "$2", "data": {"user_id": "$1", "movie_id": "$0", "rating": 5, "review": "Changed", "date": "2024-05-02"}},
+        {"op": "delete", "entity": "rating", "id": "$3"},
+    ]
+    response = client.post("/api/batch", json={"operations": operations})
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert [(result["op"], result["entity"]) for result in results] == [(op["op"], op["entity"]) for op in operations]
+    # Everything was saved with one commit
+    assert services.get_write_stats()["transactions"] == 1
+
+    movie_id, user_id = results[0]["id"], results[1]["id"]
+    ratings = services.get_movie_ratings(movie_id)
+    assert sorted((rating.rating, rating.date) for rating in ratings) == [(4, "2024-05-01"), (5, "2024-05-02")]
+    services.delete_movie(movie_id)
+    services.delete_user(user_id)
+
+
+def test_failed_batch_saves_nothing(client):
+    operations = [
+        {"op": "create", "entity": "user", "data": {"username": "batch_rolled_back", "email": "rolled@example.com"}},
+        {"op": "create", "entity": "rating", "data": {"user_id": "$0", "movie_id": 999999, "rating": 4, "review": "", "date": "2024-05-01"}},
+    ]
+    response = client.post("/api/batch", json={"operations": operations})
+    assert response.status_code == 400
+    assert response.get_json()["index"] == 1
+    assert services.get_users_by_name("batch_rolled_back") == []
+
+
+@pytest.mark.parametrize("body, index", [
+    ({}, None),
+    ({"operations": []}, None),
+    ({"operations": [{"op": "merge", "entity": "user", "data": {}}]}, 0),
+    ({"operations": [{"op": "create", "entity": "user", "data": {"username": "missing_email"}}]}, 0),
+    ({"operations": [{"op": "delete", "entity": "rating", "id": "$0"}]}, 0),
+    ({"operations": [{"op": "create", "entity": "user", "data": ["batch_user", "batch@example.com"]}]}, 0),
+    ({"operations": [{"op": "delete", "entity": "movie", "id": 1}, {"op": "update", "entity": "movie", "id": 1, "data": "x"}]}, 1),
+])
+def test_invalid_batches(client, body, index):
+    response = client.post("/api/batch", json=body)
+    assert response.status_code == 400
+    assert response.get_json()["index"] == index
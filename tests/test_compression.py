@@ -0,0 +1,88 @@
+import gzip
+import zlib
+import pytest
+from flask import Flask, Response, jsonify
+from api.compression import Compress
+
+# These tests use a small Flask app of their own so that we can control exactly what the responses look like
+
+
+@pytest.fixture
+def compressed_app():
+    app = Flask(__name__)
+    app.config["COMPRESS_MIN_SIZE"] = 100
+    compress = Compress(app)
+
+    @app.route("/big")
+    def big():
+        return jsonify([{"movie_id": i, "title": "A movie title"} for i in range(100)])
+
+    @app.route("/small")
+    def small():
+        return jsonify({"message": "hi"})
+
+    @app.route("/private")
+    def private():
+        response = jsonify([{"movie_id": i} for i in range(100)])
+        response.cache_control.no_store = True
+        return response
+
+    @app.route("/stream")
+    def stream():
+        def generate():
+            for i in range(5):
+                yield f"data: {i}\n\n"
+        return Response(generate(), mimetype="text/event-stream")
+
+    app.compress = compress
+    return app
+
+
+def test_gzip_when_accepted(compressed_app):
+    client = compressed_app.test_client()
+    plain = client.get("/big")
+    response = client.get("/big", headers={"Accept-Encoding": "gzip, deflate"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert gzip.decompress(response.data) == plain.data
+    assert len(response.data) < len(plain.data)
+
+
+def test_deflate_when_preferred(compressed_app):
+    client = compressed_app.test_client()
+    response = client.get("/big", headers={"Accept-Encoding": "gzip;q=0.5, deflate"})
+    assert response.headers["Content-Encoding"] == "deflate"
+    assert zlib.decompress(response.data) == client.get("/big").data
+
+
+def test_not_compressed(compressed_app):
+    client = compressed_app.test_client()
+    # Nothing asked for
+    assert "Content-Encoding" not in client.get("/big").headers
+    # Too small to be worth it
+    assert "Content-Encoding" not in client.get("/small", headers={"Accept-Encoding": "gzip"}).headers
+    # An encoding we don't support
+    assert "Content-Encoding" not in client.get("/big", headers={"Accept-Encoding": "br"}).headers
+
+
+def test_compressed_bodies_are_reused(compressed_app):
+    client = compressed_app.test_client()
+    cache = compressed_app.compress.cache
+    first = client.get("/big", headers={"Accept-Encoding": "gzip"})
+    second = client.get("/big", headers={"Accept-Encoding": "gzip"})
+    assert first.data == second.data
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["hits"] == 1
+
+    # Responses that mustn't be stored are compressed every time
+    client.get("/private", headers={"Accept-Encoding": "gzip"})
+    assert cache.stats()["entries"] == 1
+
+
+def test_streamed_response(compressed_app):
+    client = compressed_app.test_client()
+    response = client.get("/stream", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in response.headers
+    body = gzip.decompress(response.data).decode()
+    assert body == "".join(f"data: {i}\n\n" for i in range(5))
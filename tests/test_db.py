@@ -1,6 +1,10 @@
 import pytest
+import sqlite3
+import threading
+import time
 import api.services as services
 from api.models import User, Rating, Movie
+from api.movie_query import MovieQuery
 
 # This set of tests will test the database connection and the services module
 # It is important to test the database connection and the services module to ensure that the database is set up correctly and that the services module is working as expected
@@ -35,7 +39,7 @@ def known_movie():
 @pytest.fixture
 def new_rating():
     rating = Rating(
-        user_id=101,
+        user_id=1,
         movie_id=1,
         rating=5,
         review="Great movie!",
@@ -52,10 +56,150 @@ def test_create_connection():
     conn.close()
 
 
+def test_read_connection_is_read_only():
+    conn = services.get_read_connection()
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("DELETE FROM users WHERE user_id = -1")
+    conn.close()
+
+def test_read_replicas(tmp_path, monkeypatch, known_movie):
+    monkeypatch.setattr(services, "READ_REPLICA_COUNT", 2)
+    monkeypatch.setattr(services, "READ_REPLICA_DIRECTORY", tmp_path)
+    monkeypatch.setattr(services, "READ_REPLICA_MAX_STALENESS", 60)
+
+    # Cached reads (like get_movie_by_id) always read the main database, so this uses one that isn't cached
+    def read_title():
+        return services.get_movies_by_ids([known_movie.movie_id])[0][0].title
+
+    # The first read creates the snapshot, so it sees the movie
+    assert read_title() == known_movie.title
+    assert len(list(tmp_path.glob("*.replica*.db"))) == 1
+
+    # Within the staleness bound a replica can be behind the main database...
+    known_movie.title = "updated_movie"
+    services.update_movie(known_movie)
+    titles = {read_title() for _ in range(2)}
+    assert "test_movie" in titles
+    assert services.get_movie_by_id(known_movie.movie_id).title == "updated_movie"
+
+    # ...but not once the snapshots are older than the bound
+    monkeypatch.setattr(services, "READ_REPLICA_MAX_STALENESS", 0)
+    assert read_title() == "updated_movie"
+
+def hold_write_lock(seconds):
+    # Another "worker" takes the write lock and gives it up after a while
+    conn = sqlite3.connect(services.DATABASE_FILE, check_same_thread=False)
+    conn.execute("BEGIN IMMEDIATE")
+    timer = threading.Timer(seconds, conn.rollback)
+    timer.start()
+    return conn, timer
+
+def test_write_waits_for_busy_database(monkeypatch):
+    monkeypatch.setattr(services, "WRITE_BUSY_TIMEOUT", 0.05)
+    monkeypatch.setattr(services, "WRITE_RETRY_ATTEMPTS", 20)
+    services.reset_write_stats()
+    conn, timer = hold_write_lock(0.3)
+
+    user_id = services.create_user(User(None, "busy_user", "busy@example.com"))
+    timer.join()
+    conn.close()
+
+    stats = services.get_write_stats()
+    assert stats["transactions"] == 1
+    assert stats["retries"] > 0
+    assert stats["max_lock_wait"] >= 0.2
+    assert services.get_user_by_id(user_id).username == "busy_user"
+    services.delete_user(user_id)
+
+def test_write_gives_up_when_database_stays_busy(monkeypatch):
+    monkeypatch.setattr(services, "WRITE_BUSY_TIMEOUT", 0.01)
+    monkeypatch.setattr(services, "WRITE_RETRY_ATTEMPTS", 3)
+    services.reset_write_stats()
+    conn, timer = hold_write_lock(2)
+    try:
+        with pytest.raises(services.DatabaseBusyError):
+            services.create_user(User(None, "never_saved", "never@example.com"))
+    finally:
+        timer.cancel()
+        conn.rollback()
+        conn.close()
+    assert services.get_write_stats()["busy_failures"] == 1
+    assert services.get_users_by_name("never_saved") == []
+
+def test_write_file_lock_serializes_writers(tmp_path, monkeypatch):
+    if services.fcntl is None:
+        pytest.skip("File locks need fcntl")
+    monkeypatch.setattr(services, "WRITE_FILE_LOCK", True)
+    monkeypatch.setattr(services, "WRITE_LOCK_FILE", tmp_path / "movie_data.db.lock")
+    monkeypatch.setattr(services, "WRITE_RETRY_ATTEMPTS", 20)
+    services.reset_write_stats()
+
+    # Hold the file lock as another process would, the write has to queue behind it
+    lock_file = open(services.WRITE_LOCK_FILE, "a")
+    services.fcntl.flock(lock_file, services.fcntl.LOCK_EX)
+    threading.Timer(0.3, lock_file.close).start()
+
+    user_id = services.create_user(User(None, "queued_user", "queued@example.com"))
+    assert services.get_write_stats()["max_lock_wait"] >= 0.2
+    services.delete_user(user_id)
+
+def test_retry_while_busy_only_retries_busy_errors():
+    with pytest.raises(sqlite3.OperationalError, match="no such table"):
+        services.retry_while_busy(lambda: services.run_query("DELETE FROM no_such_table"))
+    assert services.is_busy_error(sqlite3.OperationalError("database is locked"))
+    assert not services.is_busy_error(ValueError("locked"))
+
+def test_transaction_commits_once(known_movie):
+    services.reset_write_stats()
+    commits = []
+    services.add_commit_listener(lambda: commits.append(1))
+    try:
+        with services.transaction():
+            user_id = services.create_user(User(None, "unit_of_work_user", "uow@example.com"))
+            rating_ids = [
+                services.create_rating(Rating(user_id=user_id, movie_id=known_movie.movie_id, rating=score, review="", date="2024-06-01"))
+                for score in (3, 4, 5)
+            ]
+            # Reads inside the transaction see its writes before they are committed
+            assert services.get_user_by_id(user_id).username == "unit_of_work_user"
+            assert len(services.get_user_ratings(user_id)) == 3
+    finally:
+        services._commit_listeners.pop()
+    assert services.get_write_stats()["transactions"] == 1
+    assert commits == [1]
+    assert [rating.rating_id for rating in services.get_user_ratings(user_id)] == rating_ids
+    services.delete_user(user_id)
+
+def test_transaction_rolls_back_everything():
+    with pytest.raises(ValueError):
+        with services.transaction():
+            services.create_user(User(None, "rolled_back_user", "rolled@example.com"))
+            services.create_rating(Rating(user_id=1, movie_id=999999, rating=4, review="", date="2024-06-01"))
+    assert services.get_users_by_name("rolled_back_user") == []
+
+def test_failed_call_in_transaction_only_undoes_itself(known_movie):
+    with services.transaction():
+        user_id = services.create_user(User(None, "savepoint_user", "savepoint@example.com"))
+        with pytest.raises(ValueError):
+            services.create_rating(Rating(user_id=user_id, movie_id=999999, rating=4, review="", date="2024-06-01"))
+        services.create_rating(Rating(user_id=user_id, movie_id=known_movie.movie_id, rating=4, review="", date="2024-06-01"))
+    assert services.get_user_stats(user_id).rating_count == 1
+    services.delete_user(user_id)
+
 def test_run_query():
     results = services.run_query("SELECT * FROM users where username like '%%'")
     assert len(results) > 0
 
+def test_run_query_with_a_write_behind_a_with_clause():
+    assert services.is_read_only("WITH recent AS (SELECT 1) SELECT * FROM recent")
+    query = "WITH doomed AS (SELECT user_id FROM users WHERE username = ?) DELETE FROM users WHERE user_id IN doomed"
+    assert not services.is_read_only(query, ("with_delete_user",))
+    services.create_user(User(None, "with_delete_user", "with_delete@example.com"))
+    assert services.get_users_by_name("with_delete_user")
+    # It runs on the main database and is committed, rather than failing on a read-only connection
+    services.run_query(query, ("with_delete_user",))
+    assert not services.get_users_by_name("with_delete_user")
+
 
 def test_get_all_users():
     all_users = services.get_all_users()
@@ -95,6 +239,12 @@ def test_get_users_by_contains_name(known_user):
         assert "xyz" in user.username.lower()
 
 
+def test_get_users_by_ids(known_user):
+    users, missing_ids = services.get_users_by_ids([known_user.id, 1, -1, known_user.id])
+    # Users come back in the order they were asked for, once each
+    assert [user.id for user in users] == [known_user.id, 1]
+    assert missing_ids == [-1]
+
 def test_create_user():
     new_user = User(None, "test_user", "testuser@example.com")
     new_user.id = services.create_user(new_user)
@@ -154,6 +304,21 @@ def test_create_movie():
     services.delete_movie(movie.movie_id)
 
 
+def test_get_movies_by_ids(known_movie):
+    movies, missing_ids = services.get_movies_by_ids([2, known_movie.movie_id, -5, 1])
+    assert [movie.movie_id for movie in movies] == [2, known_movie.movie_id, 1]
+    assert missing_ids == [-5]
+
+@pytest.mark.parametrize("chunk_size, temp_table_threshold", [(2, 5000), (500, 2)])
+def test_get_movies_by_ids_large_lists(monkeypatch, chunk_size, temp_table_threshold):
+    # Shrink the limits so that a handful of IDs goes through the chunked and the temporary table paths
+    monkeypatch.setattr(services, "ID_CHUNK_SIZE", chunk_size)
+    monkeypatch.setattr(services, "TEMP_TABLE_ID_THRESHOLD", temp_table_threshold)
+    movie_ids = [5, 4, 3, 2, 1, -1]
+    movies, missing_ids = services.get_movies_by_ids(movie_ids)
+    assert [movie.movie_id for movie in movies] == [5, 4, 3, 2, 1]
+    assert missing_ids == [-1]
+
 def test_delete_movie(known_movie):
     # Delete the movie
     services.delete_movie(known_movie.movie_id)
@@ -227,6 +392,124 @@ def test_movie_by_criteria_multiple(known_movie):
     assert len(movies) > 0
     for movie in movies:
         assert movie.title == known_movie.title
+
+def test_movie_by_criteria_one_of_several_directors():
+    movie = Movie(None, "test_movie", "test_genre", release_year=2024, director="First Test Director, Second Test Director")
+    movie.movie_id = services.create_movie(movie)
+
+    # Either director on their own should find the movie, ignoring case
+    for director in ("First Test Director", "second test director"):
+        movies = services.get_movies_matching_criteria(director=director)
+        assert [m.movie_id for m in movies] == [movie.movie_id]
+
+    # Part of a name is not a match any more
+    assert len(services.get_movies_matching_criteria(director="Second Test")) == 0
+    services.delete_movie(movie.movie_id)
+    assert len(services.get_movies_matching_criteria(director="Second Test Director")) == 0
+
+def test_movie_by_criteria_multiple_genres(known_movie):
+    # A movie matches when it has any of the genres asked for
+    movies = services.get_movies_matching_criteria(genre=["test_genre2", known_movie.genre])
+    assert known_movie.movie_id in [m.movie_id for m in movies]
+    for movie in movies:
+        assert movie.genre == known_movie.genre
+    movies = services.get_movies_matching_criteria(genre="test_genre2, test_genre3")
+    assert len(movies) == 0
+
+def test_movie_by_criteria_follows_updates(known_movie):
+    known_movie.genre = "test_genre2"
+    services.update_movie(known_movie)
+    movies = services.get_movies_matching_criteria(genre="test_genre")
+    assert known_movie.movie_id not in [m.movie_id for m in movies]
+    movies = services.get_movies_matching_criteria(genre="test_genre2")
+    assert [m.movie_id for m in movies] == [known_movie.movie_id]
+
+def test_updating_a_missing_movie_indexes_nothing():
+    def name_rows():
+        return [
+            tuple(row) for table in ("genres", "movie_genres", "directors", "movie_directors", "movie_scores")
+            for row in services.run_query(f"SELECT * FROM {table}")
+        ]
+
+    before = name_rows()
+    services.update_movie(Movie(987654, "ghost_movie", "GhostGenre", release_year=2024, director="Ghost Director"))
+    assert name_rows() == before
+
+def test_split_names():
+    assert services.split_names("Anthony Russo, Joe Russo") == ["Anthony Russo", "Joe Russo"]
+    assert services.split_names(["Action", "action, Drama", ""]) == ["Action", "Drama"]
+    assert services.split_names("") == []
+
+
+def test_movie_by_criteria_none():
+    # No criteria at all should give back every movie rather than a broken query
+    movies = services.get_movies_matching_criteria()
+    assert len(movies) == len(services.get_all_movies())
+
+def test_search_movies_year_range_sorted():
+    query = MovieQuery().released_between(1990, 1999).sort_by("year", descending=True)
+    movies = services.search_movies(query).movies
+    assert len(movies) > 0
+    years = [movie.release_year for movie in movies]
+    assert all(1990 <= year <= 1999 for year in years)
+    assert years == sorted(years, reverse=True)
+
+def test_search_movies_paging():
+    all_movies = services.search_movies(MovieQuery().sort_by("rating", descending=True)).movies
+
+    # Walk through the same search two movies at a time
+    paged_movies = []
+    cursor = None
+    while True:
+        query = MovieQuery().sort_by("rating", descending=True).limit(2).after(cursor)
+        result = services.search_movies(query)
+        assert len(result.movies) <= 2
+        paged_movies += result.movies
+        cursor = result.next_cursor
+        if cursor is None:
+            break
+    assert [m.movie_id for m in paged_movies] == [m.movie_id for m in all_movies]
+
+@pytest.mark.parametrize("descending", [False, True])
+def test_search_movies_paging_past_missing_years(descending):
+    movie_ids = [
+        services.create_movie(Movie(None, "test_movie", "test_genre_paging", release_year=year, director="Test Director"))
+        for year in (None, 2001, None, 2002, None)
+    ]
+    search = lambda: MovieQuery().with_genres("test_genre_paging").sort_by("year", descending=descending)
+    all_movies = services.search_movies(search()).movies
+    assert len(all_movies) == 5
+
+    paged_movies = []
+    cursor = None
+    while True:
+        result = services.search_movies(search().limit(2).after(cursor))
+        paged_movies += result.movies
+        cursor = result.next_cursor
+        if cursor is None:
+            break
+    assert [m.movie_id for m in paged_movies] == [m.movie_id for m in all_movies]
+    for movie_id in movie_ids:
+        services.delete_movie(movie_id)
+
+# [{}, 1], [1, "a"], [1, true], not base64 at all and [1]
+@pytest.mark.parametrize("cursor", ["W3t9LDFd", "WzEsICJhIl0=", "WzEsIHRydWVd", "not a cursor", "WzFd"])
+def test_search_movies_malformed_cursor(cursor):
+    with pytest.raises(ValueError):
+        MovieQuery().after(cursor)
+
+def test_search_movies_facets():
+    query = MovieQuery().with_genres("Action, Sci-Fi")
+    result = services.search_movies(query, facets=["genre", "decade", "director"])
+    assert sum(result.facets["genre"].values()) == len(result.movies)
+    assert sum(result.facets["decade"].values()) == len(result.movies)
+    assert set(result.facets["genre"]) <= {"Action", "Sci-Fi"}
+    # Christopher Nolan directed Inception and Interstellar, which are both Sci-Fi
+    assert result.facets["director"]["Christopher Nolan"] >= 2
+
+    with pytest.raises(ValueError):
+        services.search_movies(query, facets=["colour"])
+
 # ---------------------------------------------------------
 # This set of tests will test the database connection and the services module for the RATINGS table
 # ---------------------------------------------------------
@@ -239,7 +522,7 @@ def test_get_rating_by_id(new_rating):
 def test_get_movie_ratings(known_movie):
     # Create a sample rating
     sample_rating = Rating(
-        user_id=101,
+        user_id=1,
         movie_id=known_movie.movie_id,
         rating=5,
         review="Great movie!",
@@ -249,7 +532,7 @@ def test_get_movie_ratings(known_movie):
 
     # Create a sample rating
     sample_rating2 = Rating(
-        user_id=101,
+        user_id=1,
         movie_id=known_movie.movie_id,
         rating=3,
         review="So so movie!",
@@ -275,6 +558,22 @@ def test_get_rating_by_user(new_rating):
         assert rating.user_id == new_rating.user_id
 
 
+def test_get_ratings_with_fields(new_rating):
+    # Only the requested columns (and the ID) are loaded, the rest are left as None
+    ratings = services.get_user_ratings(new_rating.user_id, fields=["movie_id", "rating"])
+    assert len(ratings) > 0
+    for rating in ratings:
+        assert rating.rating_id is not None
+        assert rating.rating is not None
+        assert rating.review is None
+
+    with pytest.raises(ValueError):
+        services.get_user_ratings(new_rating.user_id, fields=["colour"])
+
+def test_select_list():
+    assert services.select_list(services.USER_COLUMNS, ["username"], "id") == "user_id,username"
+    assert services.select_list(services.MOVIE_COLUMNS, None, "movie_id") == "movie_id,title,genre,release_year,director"
+
 def test_delete_rating(new_rating):
     # Delete the rating
     services.delete_rating(new_rating.rating_id)
@@ -290,7 +589,7 @@ def test_update_rating(new_rating):
 
 def test_create_rating():
     rating = Rating(
-        user_id=101,
+        user_id=1,
         movie_id=1,
         rating=5,
         review="Great movie!",
@@ -338,3 +637,340 @@ def test_get_user_ratings(known_user, known_movie):
     # Clean up
     services.delete_rating(sample_rating.rating_id)
     services.delete_rating(sample_rating2.rating_id)
+
+# ---------------------------------------------------------
+# This set of tests will test the movie leaderboard, which is kept up to date by the rating functions
+# ---------------------------------------------------------
+def test_top_movies_follow_rating_changes(known_movie):
+    rating = Rating(user_id=1, movie_id=known_movie.movie_id, rating=5, review="Great movie!", date="2024-01-01")
+    rating.rating_id = services.create_rating(rating)
+
+    top_movies = services.get_top_movies(genre=known_movie.genre)
+    assert len(top_movies) == 1
+    assert top_movies[0].movie.movie_id == known_movie.movie_id
+    assert top_movies[0].rating_count == 1
+    expected_score = (services.LEADERBOARD_PRIOR_WEIGHT * services.LEADERBOARD_PRIOR_MEAN + 5) / (services.LEADERBOARD_PRIOR_WEIGHT + 1)
+    assert top_movies[0].score == pytest.approx(expected_score)
+
+    # Changing the rating should move the score with it
+    rating.rating = 1
+    services.update_rating(rating)
+    top_movies = services.get_top_movies(genre=known_movie.genre)
+    assert top_movies[0].average_rating == 1
+    assert top_movies[0].score < services.LEADERBOARD_PRIOR_MEAN
+
+    # Once the rating is gone the movie has nothing to be ranked on
+    services.delete_rating(rating.rating_id)
+    assert len(services.get_top_movies(genre=known_movie.genre)) == 0
+
+def test_top_movies_min_ratings(known_movie):
+    rating = Rating(user_id=1, movie_id=known_movie.movie_id, rating=4, review="Good", date="2024-01-01")
+    rating.rating_id = services.create_rating(rating)
+
+    assert len(services.get_top_movies(genre=known_movie.genre, min_ratings=1)) == 1
+    assert len(services.get_top_movies(genre=known_movie.genre, min_ratings=2)) == 0
+    services.delete_rating(rating.rating_id)
+
+def test_top_movies_by_one_of_several_genres():
+    movie = Movie(None, "test_movie", "test_genre_a, test_genre_b", release_year=2024, director="Test Director")
+    movie.movie_id = services.create_movie(movie)
+    rating_id = services.create_rating(Rating(user_id=1, movie_id=movie.movie_id, rating=4, review="", date="2024-01-01"))
+
+    for genre in ("test_genre_a", "test_genre_b"):
+        assert [top.movie.movie_id for top in services.get_top_movies(genre=genre)] == [movie.movie_id]
+    assert services.get_top_movies(genre="test_genre") == []
+    services.delete_rating(rating_id)
+    services.delete_movie(movie.movie_id)
+
+def test_top_movies_ordered_by_score():
+    top_movies = services.get_top_movies(limit=5)
+    assert len(top_movies) <= 5
+    scores = [movie_score.score for movie_score in top_movies]
+    assert scores == sorted(scores, reverse=True)
+
+# ---------------------------------------------------------
+# This set of tests will test the user statistics, which are kept up to date by the rating functions
+# ---------------------------------------------------------
+def user_stat_rows(user_id):
+    rows = services.run_query(
+        "SELECT kind, bucket, rating_count, rating_sum FROM user_rating_stats WHERE user_id = ? ORDER BY kind, bucket",
+        (user_id,),
+    )
+    return [tuple(row) for row in rows]
+
+def test_user_stats_follow_rating_changes(known_user, known_movie):
+    ratings = [
+        Rating(user_id=known_user.id, movie_id=known_movie.movie_id, rating=4, review="Good", date="2024-01-05"),
+        Rating(user_id=known_user.id, movie_id=known_movie.movie_id, rating=2, review="Meh", date="2/10/2024"),
+    ]
+    for rating in ratings:
+        rating.rating_id = services.create_rating(rating)
+
+    stats = services.get_user_stats(known_user.id)
+    assert stats.rating_count == 2
+    assert stats.average_rating == 3
+    assert stats.histogram == {"2": 1, "4": 1}
+    assert stats.favorite_genres == [("test_genre", 2, 3)]
+    assert stats.favorite_directors == [("Test Director", 2, 3)]
+    assert [(month, count) for month, count, _ in stats.activity] == [("2024-01", 1), ("2024-02", 1)]
+
+    # Changing a rating moves it to its new buckets
+    ratings[1].rating = 5
+    ratings[1].date = "2024-01-20"
+    services.update_rating(ratings[1])
+    stats = services.get_user_stats(known_user.id)
+    assert stats.histogram == {"4": 1, "5": 1}
+    assert [(month, count) for month, count, _ in stats.activity] == [("2024-01", 2)]
+
+    # Changing the movie's genre moves all of its ratings to the new genre
+    known_movie.genre = "test_genre_2, test_genre_3"
+    services.update_movie(known_movie)
+    stats = services.get_user_stats(known_user.id)
+    assert sorted(name for name, _, _ in stats.favorite_genres) == ["test_genre_2", "test_genre_3"]
+
+    # What is kept up to date should be the same as building it from scratch
+    maintained = user_stat_rows(known_user.id)
+    services.rebuild_user_stats()
+    assert user_stat_rows(known_user.id) == maintained
+
+    for rating in ratings:
+        services.delete_rating(rating.rating_id)
+    assert user_stat_rows(known_user.id) == []
+    assert services.get_user_stats(known_user.id).rating_count == 0
+
+def test_user_stats_favorites_are_smoothed(known_user):
+    movies = [
+        Movie(None, "stats_movie_1", "stats_genre_a", release_year=2024, director="Stats Director"),
+        Movie(None, "stats_movie_2", "stats_genre_a", release_year=2024, director="Stats Director"),
+        Movie(None, "stats_movie_3", "stats_genre_b", release_year=2024, director="Stats Director"),
+    ]
+    for movie in movies:
+        movie.movie_id = services.create_movie(movie)
+    ratings = [
+        Rating(user_id=known_user.id, movie_id=movies[0].movie_id, rating=5, review="", date="2024-01-01"),
+        Rating(user_id=known_user.id, movie_id=movies[1].movie_id, rating=5, review="", date="2024-01-01"),
+        Rating(user_id=known_user.id, movie_id=movies[2].movie_id, rating=1, review="", date="2024-01-01"),
+    ]
+    for rating in ratings:
+        rating.rating_id = services.create_rating(rating)
+
+    stats = services.get_user_stats(known_user.id)
+    assert [name for name, _, _ in stats.favorite_genres] == ["stats_genre_a", "stats_genre_b"]
+
+    for rating in ratings:
+        services.delete_rating(rating.rating_id)
+    for movie in movies:
+        services.delete_movie(movie.movie_id)
+
+def test_user_stats_for_missing_user():
+    assert services.get_user_stats(-1) is None
+
+# ---------------------------------------------------------
+# This set of tests will test rating dates, date ranges and the daily buckets behind the rollups
+# ---------------------------------------------------------
+@pytest.mark.parametrize("value, expected", [
+    ("2023-01-31", "2023-01-31"),
+    ("1/31/2023", "2023-01-31"),
+    ("01/05/2023", "2023-01-05"),
+    ("2023-01-31T12:30:00", "2023-01-31"),
+    (None, None),
+])
+def test_normalize_date(value, expected):
+    assert services.normalize_date(value) == expected
+
+@pytest.mark.parametrize("value", ["31/01/2023", "yesterday", "2023-02-30"])
+def test_normalize_date_rejects_bad_dates(value):
+    with pytest.raises(ValueError):
+        services.normalize_date(value)
+
+def test_rating_dates_are_stored_as_iso(known_movie):
+    rating = Rating(user_id=1, movie_id=known_movie.movie_id, rating=4, review="", date="3/7/2024")
+    rating.rating_id = services.create_rating(rating)
+    assert rating.date == "2024-03-07"
+    assert services.get_rating_by_id(rating.rating_id).date == "2024-03-07"
+    services.delete_rating(rating.rating_id)
+
+@pytest.fixture
+def dated_ratings(known_movie):
+    ratings = [
+        Rating(user_id=1, movie_id=known_movie.movie_id, rating=rating, review="", date=date)
+        for rating, date in [(5, "2031-01-05"), (3, "2031-01-06"), (4, "2031-01-06"), (1, "2031-01-20")]
+    ]
+    for rating in ratings:
+        rating.rating_id = services.create_rating(rating)
+    yield ratings
+    for rating in ratings:
+        services.delete_rating(rating.rating_id)
+
+def test_get_ratings_by_date_range(known_movie, dated_ratings):
+    ratings, next_cursor = services.get_ratings(date_from="2031-01-06", date_to="2031-01-31", movie_id=known_movie.movie_id)
+    assert [rating.rating_id for rating in ratings] == [rating.rating_id for rating in dated_ratings[1:]]
+    assert next_cursor is None
+
+    # Page through them two at a time
+    first_page, next_cursor = services.get_ratings(date_from="2031-01-01", movie_id=known_movie.movie_id, limit=2, fields=["rating"])
+    second_page, last_cursor = services.get_ratings(date_from="2031-01-01", movie_id=known_movie.movie_id, limit=2, cursor=next_cursor)
+    assert [rating.rating for rating in first_page + second_page] == [5, 3, 4, 1]
+    assert last_cursor is None
+
+    with pytest.raises(ValueError):
+        services.get_ratings(date_from="not a date")
+
+def test_rating_rollups(known_movie, dated_ratings):
+    days = services.get_rating_rollup("day", movie_id=known_movie.movie_id)
+    assert [(day.period_start, day.rating_count, day.average_rating) for day in days] == [
+        ("2031-01-05", 1, 5), ("2031-01-06", 2, 3.5), ("2031-01-20", 1, 1),
+    ]
+    # 2031-01-05 is a Sunday, so it is in the week starting Monday the 30th of December
+    weeks = services.get_rating_rollup("week", date_from="2031-01-01", date_to="2031-01-19", movie_id=known_movie.movie_id)
+    assert [(week.period_start, week.rating_count) for week in weeks] == [("2030-12-30", 1), ("2031-01-06", 2)]
+
+    # The buckets follow changes to the ratings
+    dated_ratings[0].date = "2031-01-20"
+    services.update_rating(dated_ratings[0])
+    days = services.get_rating_rollup("day", movie_id=known_movie.movie_id)
+    assert [(day.period_start, day.rating_count) for day in days] == [("2031-01-06", 2), ("2031-01-20", 2)]
+
+    with pytest.raises(ValueError):
+        services.get_rating_rollup("month")
+
+# ---------------------------------------------------------
+# This set of tests will test the change log that the write functions keep
+# ---------------------------------------------------------
+def test_change_log_records_writes(known_movie):
+    since = services.get_latest_change_seq()
+    user = User(None, "change_user", "change@example.com")
+    user.id = services.create_user(user)
+    user.email = "changed@example.com"
+    services.update_user(user)
+    rating = Rating(user_id=user.id, movie_id=known_movie.movie_id, rating=4, review="", date="2024-01-01")
+    rating.rating_id = services.create_rating(rating)
+    services.delete_rating(rating.rating_id)
+    services.delete_user(user.id)
+    # Nothing happens to a user that doesn't exist, so nothing is logged
+    services.delete_user(user.id)
+
+    changes = services.get_changes(since=since)
+    assert [(change.entity, change.entity_id, change.op) for change in changes] == [
+        ("user", user.id, "create"),
+        ("user", user.id, "update"),
+        ("rating", rating.rating_id, "create"),
+        ("rating", rating.rating_id, "delete"),
+        ("user", user.id, "delete"),
+    ]
+    assert changes[1].data["email"] == "changed@example.com"
+    assert changes[2].data["date"] == "2024-01-01"
+    assert changes[4].data is None
+    assert [change.seq for change in changes] == sorted(change.seq for change in changes)
+
+    # Resume part way through, and filter by entity
+    assert [change.op for change in services.get_changes(since=changes[2].seq, entity="user")] == ["delete"]
+    assert len(services.get_changes(since=since, limit=2)) == 2
+
+def test_change_log_compaction(known_movie):
+    since = services.get_latest_change_seq()
+    for title in ("compacted_1", "compacted_2", "compacted_3"):
+        known_movie.title = title
+        services.update_movie(known_movie)
+
+    # Recent history is kept...
+    assert services.compact_change_log() == 0
+    # ...but once it is old enough only the latest change to each record is
+    time.sleep(0.01)
+    assert services.compact_change_log(retention=0) >= 2
+    changes = [change for change in services.get_changes(since=since) if change.entity == "movie"]
+    assert [(change.entity_id, change.data["title"]) for change in changes] == [(known_movie.movie_id, "compacted_3")]
+
+# ---------------------------------------------------------
+# This set of tests will test referential integrity between the ratings and the users and movies they belong to
+# ---------------------------------------------------------
+def derived_rows():
+    # Everything kept up to date from the ratings, to compare with building it all again from scratch
+    # (a movie whose ratings have all gone keeps an empty leaderboard entry until it is rebuilt)
+    return [
+        [tuple(row) for row in services.run_query(f"SELECT * FROM {table} WHERE rating_count > 0 ORDER BY 1, 2")]
+        for table in ("movie_scores", "user_rating_stats", "rating_daily_buckets")
+    ]
+
+def rebuild_rating_tables():
+    services.rebuild_leaderboard()
+    services.rebuild_user_stats()
+    with services.write_transaction() as cursor:
+        services._rebuild_rating_daily_buckets(cursor)
+
+def assert_derived_tables_match():
+    maintained = derived_rows()
+    rebuild_rating_tables()
+    assert derived_rows() == maintained
+
+def test_ratings_must_refer_to_existing_rows(known_movie):
+    with pytest.raises(ValueError):
+        services.create_rating(Rating(user_id=999999, movie_id=known_movie.movie_id, rating=4, review="", date="2024-01-01"))
+    with pytest.raises(ValueError):
+        services.create_rating(Rating(user_id=1, movie_id=999999, rating=4, review="", date="2024-01-01"))
+    # The database itself refuses them, not just the services module
+    conn = services.get_db_connection()
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("INSERT INTO ratings (user_id, movie_id, rating) VALUES (999999, ?, 4)", (known_movie.movie_id,))
+    conn.close()
+
+def test_deleting_a_movie_or_user_deletes_their_ratings(known_user, known_movie):
+    other_movie = Movie(None, "cascade_movie", "cascade_genre", release_year=2024, director="Cascade Director")
+    other_movie.movie_id = services.create_movie(other_movie)
+    rating_ids = [
+        services.create_rating(Rating(user_id=user_id, movie_id=movie_id, rating=score, review="", date="2024-02-01"))
+        for user_id, movie_id, score in (
+            (known_user.id, other_movie.movie_id, 5), (1, other_movie.movie_id, 3), (known_user.id, known_movie.movie_id, 4),
+        )
+    ]
+    since = services.get_latest_change_seq()
+
+    services.delete_movie(other_movie.movie_id)
+    assert services.get_rating_by_id(rating_ids[0]) is None
+    assert services.get_rating_by_id(rating_ids[1]) is None
+    assert services.get_user_stats(known_user.id).rating_count == 1
+    assert_derived_tables_match()
+
+    services.delete_user(known_user.id)
+    assert services.get_rating_by_id(rating_ids[2]) is None
+    assert_derived_tables_match()
+
+    deleted = [change.entity_id for change in services.get_changes(since=since, entity="rating")]
+    assert sorted(deleted) == rating_ids
+
+    # Deleting outside of the services module cascades too
+    rating_id = services.create_rating(Rating(user_id=1, movie_id=known_movie.movie_id, rating=2, review="", date="2024-02-01"))
+    conn = services.get_db_connection()
+    conn.execute("DELETE FROM movies WHERE movie_id = ?", (known_movie.movie_id,))
+    conn.commit()
+    conn.close()
+    assert services.get_rating_by_id(rating_id) is None
+    # The derived tables weren't told, so they are built again for the other tests
+    rebuild_rating_tables()
+
+def test_delete_ratings_in_bulk(known_user, known_movie):
+    for user_id in (known_user.id, known_user.id, 1):
+        services.create_rating(Rating(user_id=user_id, movie_id=known_movie.movie_id, rating=4, review="", date="2024-03-01"))
+
+    assert services.delete_ratings(movie_id=known_movie.movie_id, user_id=known_user.id) == 2
+    assert services.get_user_stats(known_user.id).rating_count == 0
+    assert services.delete_ratings(movie_id=known_movie.movie_id) == 1
+    assert services.get_top_movies(genre=known_movie.genre) == []
+    assert_derived_tables_match()
+    with pytest.raises(ValueError):
+        services.delete_ratings()
+
+def test_remove_orphaned_ratings(known_movie):
+    user = User(None, "orphan_user", "orphan@example.com")
+    user.id = services.create_user(user)
+    rating_id = services.create_rating(Rating(user_id=user.id, movie_id=known_movie.movie_id, rating=5, review="", date="2024-04-01"))
+    # A connection without PRAGMA foreign_keys can still leave ratings behind
+    conn = sqlite3.connect(services.DATABASE_FILE)
+    conn.execute("DELETE FROM users WHERE user_id = ?", (user.id,))
+    conn.commit()
+    conn.close()
+
+    assert services.remove_orphaned_ratings() == 1
+    assert services.get_rating_by_id(rating_id) is None
+    assert services.remove_orphaned_ratings() == 0
+    assert_derived_tables_match()
@@ -0,0 +1,92 @@
+import threading
+import time
+import pytest
+from run import create_app
+from api import services
+from api.single_flight import SingleFlight
+
+# Counts to a billion, which takes far longer than any deadline in these tests
+SLOW_QUERY = """
+    WITH RECURSIVE counter(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM counter)
+    SELECT COUNT(*) AS total FROM (SELECT x FROM counter LIMIT 1000000000)
+"""
+
+
+@pytest.fixture(autouse=True)
+def no_deadline():
+    services.reset_cancelled_queries()
+    yield
+    services.clear_deadline()
+
+
+def test_queries_past_the_deadline_are_cancelled():
+    services.set_deadline(0.05, "test")
+    with pytest.raises(services.QueryTimeoutError):
+        services.run_query(SLOW_QUERY)
+    cancelled = services.get_cancelled_queries()
+    assert cancelled["cancelled"] == 1
+    assert cancelled["recent"][0]["name"] == "test" and "RECURSIVE counter" in cancelled["recent"][0]["sql"]
+    assert cancelled["recent"][0]["elapsed"] >= 0.05
+
+    # Without a deadline, queries run as long as they need
+    services.clear_deadline()
+    assert services.run_query("SELECT COUNT(*) AS total FROM movies")[0]["total"] > 0
+
+
+def test_slow_requests_get_504(monkeypatch):
+    def slow_search(username, starts_with=True, fields=None):
+        conn = services.get_read_connection()
+        conn.execute(SLOW_QUERY).fetchall()
+
+    monkeypatch.setattr(services, "get_users_by_name", slow_search)
+    client = create_app(REQUEST_DEADLINE=0.05).test_client()
+    response = client.get("/api/users?contains=a")
+    assert response.status_code == 504
+    cancelled = client.get("/api/queries/cancelled").get_json()
+    assert cancelled["cancelled"] == 1 and cancelled["recent"][0]["name"] == "api.get_users"
+    # The deadline ends with the request
+    assert client.get("/api/users/1").status_code == 200
+    assert services.get_cancelled_queries()["cancelled"] == 1
+
+
+def test_other_database_errors_are_not_timeouts():
+    services.set_deadline(5, "test")
+    with pytest.raises(services.sqlite3.OperationalError) as raised:
+        services.get_read_connection().execute("SELECT * FROM no_such_table")
+    assert not isinstance(raised.value, services.QueryTimeoutError)
+
+
+def test_waiters_rerun_a_read_cancelled_by_another_deadline(monkeypatch):
+    monkeypatch.setattr(services, "single_flight", SingleFlight())
+    reads = []
+
+    def read(cursor):
+        # Only the first read is slow
+        reads.append(1)
+        query = SLOW_QUERY if len(reads) == 1 else "SELECT COUNT(*) AS total FROM movies"
+        return tuple(cursor.execute(query).fetchall())
+
+    key = ("test_waiters_rerun_a_read_cancelled_by_another_deadline", ())
+    results = {}
+
+    def run(name, seconds):
+        services.set_deadline(seconds, name)
+        try:
+            results[name] = services._cached_read("test", key, read)[0]["total"]
+        except services.QueryTimeoutError as error:
+            results[name] = error
+        finally:
+            services.clear_deadline()
+
+    leader = threading.Thread(target=run, args=("leader", 0.2))
+    leader.start()
+    while services.single_flight.stats()["in_flight"] == 0:
+        time.sleep(0.001)
+    waiter = threading.Thread(target=run, args=("waiter", 5))
+    waiter.start()
+    leader.join()
+    waiter.join()
+    # The leader's deadline passed, but the waiter had time left and got its own result
+    assert isinstance(results["leader"], services.QueryTimeoutError)
+    assert results["waiter"] > 0 and len(reads) == 2
+    assert [query["name"] for query in services.get_cancelled_queries()["recent"]] == ["leader"]
@@ -0,0 +1,108 @@
+import csv
+import io
+import json
+import pytest
+from run import create_app
+from api import export, services
+from api.models import Movie
+from api.export import ExportSnapshot, EXPORT_COLUMNS
+from pathlib import Path
+from utility.export_data import export_data
+
+RAW_DATA_PATH = Path(__file__).parents[1] / 'utility' / 'data'
+
+
+@pytest.fixture
+def client():
+    return create_app().test_client()
+
+
+def count_rows(table):
+    return services.run_query(f"SELECT COUNT(*) AS total FROM {table}")[0]["total"]
+
+
+def test_export_ndjson(client):
+    response = client.get("/api/export/movies")
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    assert response.headers["Content-Disposition"] == 'attachment; filename="movies.ndjson"'
+    assert int(response.headers["X-Export-Change-Seq"]) == services.get_latest_change_seq()
+
+    lines = response.get_data(as_text=True).splitlines()
+    assert len(lines) == count_rows("movies")
+    movie = json.loads(lines[0])
+    assert tuple(movie) == EXPORT_COLUMNS["movies"]
+    assert movie["title"] == services.get_movie_by_id(movie["movie_id"]).title
+
+
+def test_export_csv_matches_the_load_data_files(client):
+    response = client.get("/api/export/ratings?format=csv")
+    assert response.status_code == 200
+    assert response.mimetype == "text/csv"
+    rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+    with open(RAW_DATA_PATH / "ratings.csv", "r") as file:
+        assert rows[0] == next(csv.reader(file))
+    assert len(rows) - 1 == count_rows("ratings")
+
+
+def test_export_rejects_bad_requests(client):
+    assert client.get("/api/export/change_log").status_code == 404
+    assert client.get("/api/export/movies?format=xml").status_code == 400
+
+
+def test_snapshot_ignores_later_writes():
+    movie_id = None
+    with ExportSnapshot() as snapshot:
+        movie_id = services.create_movie(Movie(None, "export_snapshot_movie", "test_genre", 2024, "Test Director"))
+        # Reading a batch at a time gives the same rows as reading them all at once
+        chunks = list(snapshot.export("movies", "ndjson", fetch_size=2))
+        assert len(chunks) > 1
+        exported_ids = [json.loads(line)["movie_id"] for line in "".join(chunks).splitlines()]
+        assert movie_id not in exported_ids
+        assert snapshot.stats["movies"].rows == len(exported_ids)
+        assert snapshot.stats["movies"].to_dict()["rows_per_second"] > 0
+    services.delete_movie(movie_id)
+
+
+def test_snapshot_is_a_read_transaction_in_wal_mode():
+    with ExportSnapshot() as snapshot:
+        assert snapshot.connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        # Writers aren't held up while the export is read
+        movie_id = services.create_movie(Movie(None, "export_wal_movie", "test_genre", 2024, "Test Director"))
+    services.delete_movie(movie_id)
+
+
+def test_snapshot_without_wal_reads_a_replica(monkeypatch, tmp_path):
+    monkeypatch.setattr(services, "READ_REPLICA_DIRECTORY", tmp_path)
+    monkeypatch.setattr(services, "READ_REPLICA_COUNT", 0)
+    with ExportSnapshot() as snapshot:
+        snapshot.connection.close()
+        snapshot.connection = snapshot._open_replica()
+        assert sum(len(rows) for rows in snapshot.iter_rows("movies")) == count_rows("movies")
+    assert [path.name for path in tmp_path.iterdir()] == ["movie_data.replica0.db"]
+
+
+@pytest.mark.parametrize("method", ["HEAD", "GET"])
+def test_unread_exports_are_closed(monkeypatch, client, method):
+    snapshots = []
+
+    class RecordedSnapshot(ExportSnapshot):
+        def __init__(self):
+            super().__init__()
+            snapshots.append(self)
+
+    monkeypatch.setattr(export, "ExportSnapshot", RecordedSnapshot)
+    # The body is never read
+    response = client.open("/api/export/movies", method=method)
+    assert response.status_code == 200 and snapshots[0].connection is not None
+    response.close()
+    assert snapshots[0].connection is None
+
+
+def test_export_data_writes_every_table(tmp_path):
+    summary = export_data(tmp_path, "csv")
+    assert [result["table"] for result in summary["tables"]] == list(EXPORT_COLUMNS)
+    for table in EXPORT_COLUMNS:
+        with open(tmp_path / f"{table}.csv", "r") as file:
+            assert len(file.readlines()) == count_rows(table) + 1
+    assert summary["rows"] == sum(count_rows(table) for table in EXPORT_COLUMNS)
@@ -78,3 +78,12 @@ def test_movie_to_dict_with_ratings():
     assert movie_dict["movie_id"] == movie.movie_id
     for rating in movie.ratings:
         assert rating.to_dict() in movie_dict["ratings"]
+
+def test_to_dict_with_fields():
+    rating = Rating(user_id=101, movie_id=1, rating=5, review="Great movie!", date="2022-01-01", rating_id=100)
+    assert rating.to_dict(["rating_id", "rating"]) == {"rating_id": 100, "rating": 5}
+
+    movie = Movie(10000, title="test_movie", genre="test_genre", release_year=2024, director="Test Director")
+    movie.ratings = [rating]
+    movie_dict = movie.to_dict(["title"], rating_fields=["rating"])
+    assert movie_dict == {"title": "test_movie", "ratings": [{"rating": 5}]}
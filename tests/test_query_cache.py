@@ -0,0 +1,102 @@
+import pytest
+from run import create_app
+from api import services
+from api.models import Movie
+from api.query_cache import QueryCache, make_key, normalize_sql, is_cacheable
+
+
+@pytest.fixture
+def cache_stats():
+    services.query_cache.reset()
+    return lambda name: services.get_query_cache_stats()["queries"].get(name, {"hits": 0, "misses": 0})
+
+
+def test_normalize_sql_keeps_strings():
+    assert normalize_sql("SELECT *\n  FROM movies\tWHERE title = 'a  b'") == "SELECT * FROM movies WHERE title = 'a  b'"
+    assert make_key("SELECT 1", [2]) == make_key(" SELECT   1 ", (2,))
+    assert not is_cacheable("SELECT random() FROM movies")
+    assert not is_cacheable("SELECT date('now')")
+
+
+def test_evicts_least_recently_used_within_budget():
+    cache = QueryCache(max_bytes=2000)
+    for n in range(3):
+        assert cache.put(("q", (n,)), ("x" * 400,), {"movies"}, cache.start_read())
+    cache.get(("q", (0,)))
+    assert cache.put(("q", (3,)), ("x" * 400,), {"movies"}, cache.start_read())
+    # The first one was used most recently, so the second one made room
+    assert cache.get(("q", (0,))) is not None
+    assert cache.get(("q", (1,))) is None
+    assert cache.stats()["bytes"] <= 2000
+    assert cache.stats()["total"]["evictions"] >= 1
+    # A result bigger than the whole budget isn't stored at all
+    assert not cache.put(("big", ()), ("x" * 5000,), {"movies"}, cache.start_read())
+
+
+def test_invalidation_by_table():
+    cache = QueryCache(max_bytes=10000)
+    cache.put(("movies", ()), (1,), {"movies"}, cache.start_read())
+    cache.put(("join", ()), (2,), {"movies", "ratings"}, cache.start_read())
+    cache.put(("users", ()), (3,), {"users"}, cache.start_read())
+    assert cache.invalidate({"ratings"}) == 1
+    assert cache.get(("join", ())) is None
+    assert cache.get(("movies", ())) == (1,)
+
+    # A result read before a write to its table committed is out of date, so it isn't stored
+    started = cache.start_read()
+    cache.invalidate({"users"})
+    assert not cache.put(("users", ()), (4,), {"users"}, started)
+    assert cache.put(("movies", (1,)), (5,), {"movies"}, started)
+
+
+def test_results_expire(monkeypatch):
+    cache = QueryCache(max_bytes=10000, max_age=0)
+    cache.put(("q", ()), (1,), {"movies"}, cache.start_read())
+    assert cache.get(("q", ())) is None
+    assert cache.stats()["total"]["expired"] == 1
+
+
+def test_repeated_reads_come_from_the_cache(cache_stats):
+    first = services.get_all_movies()
+    second = services.get_all_movies()
+    assert [movie.title for movie in first] == [movie.title for movie in second]
+    assert cache_stats("get_all_movies")["hits"] == 1
+
+    services.run_query("SELECT COUNT(*) AS total FROM movies")
+    services.run_query("SELECT COUNT(*)   AS total\n FROM movies")
+    assert cache_stats("run_query")["hits"] == 1
+
+
+def test_writes_invalidate_what_they_touch(cache_stats):
+    services.get_movies_by_name("cache_movie")
+    users = services.run_query("SELECT COUNT(*) AS total FROM users")[0]["total"]
+
+    movie_id = services.create_movie(Movie(None, "cache_movie", "cache_genre", release_year=2024, director="Cache Director"))
+    assert [movie.movie_id for movie in services.get_movies_by_name("cache_movie")] == [movie_id]
+    assert [movie.movie_id for movie in services.get_movies_matching_criteria(genre="cache_genre")] == [movie_id]
+    # Nothing wrote to the users table, so that result is still cached
+    assert services.run_query("SELECT COUNT(*) AS total FROM users")[0]["total"] == users
+    assert cache_stats("run_query")["hits"] == 1
+
+    services.delete_movie(movie_id)
+    assert services.get_movies_by_name("cache_movie") == []
+    assert services.get_movies_matching_criteria(genre="cache_genre") == []
+
+
+def test_reads_in_a_transaction_skip_the_cache(cache_stats):
+    services.get_movies_by_name("cache_rolled_back")
+    with pytest.raises(RuntimeError):
+        with services.transaction():
+            services.create_movie(Movie(None, "cache_rolled_back", "cache_genre", release_year=2024, director="Cache Director"))
+            assert len(services.get_movies_by_name("cache_rolled_back")) == 1
+            raise RuntimeError("roll back")
+    assert services.get_movies_by_name("cache_rolled_back") == []
+
+
+def test_cache_status_route(cache_stats):
+    client = create_app().test_client()
+    client.get("/api/movies")
+    client.get("/api/movies")
+    status = client.get("/api/cache/status").get_json()
+    assert status["enabled"] and status["entries"] >= 1
+    assert 0 < status["total"]["hit_ratio"] <= 1
@@ -0,0 +1,135 @@
+import json
+import threading
+import pytest
+from run import create_app
+from api import services
+from api.models import Rating, Movie
+from api.rating_stream import RatingHub, Subscription, event_stream
+import api.rating_stream as rating_stream
+
+
+@pytest.fixture
+def movies():
+    created = []
+    for title in ("stream_movie_one", "stream_movie_two"):
+        movie = Movie(None, title, "test_genre", release_year=2024, director="Test Director")
+        movie.movie_id = services.create_movie(movie)
+        created.append(movie)
+    yield created
+    for movie in created:
+        for rating in services.get_movie_ratings(movie.movie_id):
+            services.delete_rating(rating.rating_id)
+        services.delete_movie(movie.movie_id)
+
+
+def add_rating(movie, score=4, user_id=1):
+    rating = Rating(user_id=user_id, movie_id=movie.movie_id, rating=score, review="Live review", date="2024-01-01")
+    return services.create_rating(rating)
+
+
+def parse_events(body: str):
+    events = []
+    for block in body.split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if line and not line.startswith(":"))
+        if fields.get("event") == "rating":
+            events.append((int(fields["id"]), json.loads(fields["data"])))
+    return events
+
+
+def test_hub_only_sends_matching_ratings(movies):
+    # A hub that isn't woken by commits only finds new ratings by polling, as it would for another worker's writes
+    hub = RatingHub(poll_interval=60)
+    for_first_movie = hub.subscribe(movie_id=movies[0].movie_id)
+    for_everything = hub.subscribe()
+    first_id = add_rating(movies[0], 5)
+    second_id = add_rating(movies[1], 3)
+
+    assert hub.poll() >= 2
+    change = for_first_movie.get(timeout=1)
+    assert change.entity_id == first_id and change.data["rating"] == 5
+    assert for_first_movie.get(timeout=0.01) is None
+    assert [for_everything.get(timeout=1).entity_id for _ in range(2)] == [first_id, second_id]
+
+    hub.unsubscribe(for_first_movie)
+    hub.unsubscribe(for_everything)
+    assert hub.stats()["subscribers"] == 0
+
+
+def test_hub_polls_in_the_background(movies):
+    hub = RatingHub(poll_interval=0.05)
+    subscription = hub.subscribe(user_id=1)
+    rating_id = add_rating(movies[0])
+    change = subscription.get(timeout=5)
+    assert change is not None and change.entity_id == rating_id
+    hub.unsubscribe(subscription)
+
+
+def test_slow_subscriber_is_closed():
+    subscription = Subscription(max_queue=1)
+    subscription.put("first")
+    subscription.put("second")
+    assert subscription.overflowed
+
+
+def test_stream_resumes_from_last_event_id(movies):
+    before = services.get_latest_change_seq()
+    missed_id = add_rating(movies[0], 2)
+    hub = RatingHub(poll_interval=60)
+    stream = event_stream(hub, movie_id=movies[0].movie_id, last_event_id=before, heartbeat=0.01, max_duration=0.2)
+
+    body = "".join(stream)
+    assert body.startswith("retry:")
+    assert ": heartbeat" in body
+    assert [data["id"] for seq, data in parse_events(body)] == [missed_id]
+    # The stream unsubscribes when it ends
+    assert hub.stats()["subscribers"] == 0
+
+
+def test_stream_asks_the_client_to_resync_after_a_long_replay(monkeypatch, movies):
+    monkeypatch.setattr(rating_stream, "POLL_BATCH_SIZE", 1)
+    monkeypatch.setattr(rating_stream, "MAX_REPLAY", 1)
+    before = services.get_latest_change_seq()
+    first_id = add_rating(movies[0], 2)
+    add_rating(movies[0], 3)
+    hub = RatingHub(poll_interval=60)
+    body = "".join(event_stream(hub, last_event_id=before, heartbeat=0.01, max_duration=5))
+
+    events = parse_events(body)
+    assert [data["id"] for seq, data in events] == [first_id]
+    # The stream ends with a resync from the last change it replayed, rather than going on to live events
+    assert body.endswith(f"id: {events[0][0]}\nevent: resync\ndata: {json.dumps({'since': events[0][0]})}\n\n")
+    assert hub.stats()["subscribers"] == 0
+
+
+def test_unread_streams_dont_subscribe():
+    client = create_app().test_client()
+    response = client.head("/api/ratings/stream")
+    assert response.status_code == 200
+    response.close()
+    assert rating_stream.get_hub().subscriber_count() == 0
+
+
+def test_stream_route_sends_live_ratings(movies):
+    app = create_app(RATING_STREAM_HEARTBEAT=0.05, RATING_STREAM_MAX_DURATION=1.5)
+    client = app.test_client()
+    timer = threading.Timer(0.3, add_rating, args=(movies[1], 4))
+    timer.start()
+    response = client.get(f"/api/ratings/stream?movie_id={movies[1].movie_id}")
+    timer.join()
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    assert response.headers["Cache-Control"] == "no-cache"
+    events = parse_events(response.get_data(as_text=True))
+    assert len(events) == 1
+    seq, data = events[0]
+    assert data["op"] == "create"
+    assert data["data"]["movie_id"] == movies[1].movie_id
+    assert rating_stream.get_hub().stats()["subscribers"] == 0
+
+
+def test_stream_route_rejects_bad_parameters():
+    client = create_app().test_client()
+    assert client.get("/api/ratings/stream?movie_id=abc").status_code == 400
+    response = client.get("/api/ratings/stream", headers={"Last-Event-ID": "not-a-number"})
+    assert response.status_code == 400
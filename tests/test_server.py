@@ -0,0 +1,82 @@
+import pytest
+from run import create_app, init_worker
+from api import services
+from api.models import User
+from api.warmup import warm_up, WARM_UP_PATHS
+from api.apidocs import load_openapi_spec
+from utility.startup_benchmark import measure_startup
+
+# This set of tests will test how the app is prepared for a production server (see gunicorn.conf.py)
+
+
+def test_create_app_options():
+    app = create_app(RATING_WRITE_BEHIND=True, COMPRESS_LEVEL=1, lowercase_is_ignored=True)
+    assert app.config["RATING_WRITE_BEHIND"] is True
+    assert app.config["COMPRESS_LEVEL"] == 1
+    assert "lowercase_is_ignored" not in app.config
+
+
+def test_warm_up_requests_every_path():
+    app = create_app()
+    timings = warm_up(app)
+    assert set(timings) == set(WARM_UP_PATHS)
+    for path, timing in timings.items():
+        assert timing["status"] == 200, f"{path} failed to warm up"
+
+    # The compressed bodies are now cached, so the same request is served from the cache
+    compress = app.extensions["compress"]
+    hits = compress.cache.hits
+    app.test_client().get("/api/movies/top", headers={"Accept-Encoding": "gzip"})
+    assert compress.cache.hits == hits + 1
+
+
+def test_init_worker_resets_inherited_state():
+    app = create_app(WARM_UP_PATHS=["/api/movies/top"])
+    app.test_client().get("/api/movies", headers={"Accept-Encoding": "gzip"})
+    user_id = services.create_user(User(None, "forked_user", "forked@example.com"))
+    services.delete_user(user_id)
+    assert services.get_write_stats()["transactions"] > 0
+
+    init_worker(app)
+    # The worker starts with its own empty stats, and only the warm-up paths in its cache
+    assert services.get_write_stats()["transactions"] == 0
+    stats = app.extensions["compress"].cache.stats()
+    assert stats["misses"] == 1
+    assert stats["entries"] <= 1
+
+
+def test_swagger_is_set_up_on_first_request():
+    app = create_app()
+    lazy_swagger = app.extensions["lazy_swagger"]
+    assert lazy_swagger.docs_app is None
+
+    client = app.test_client()
+    assert client.get("/api/").status_code == 200
+    assert lazy_swagger.docs_app is None
+
+    assert client.get("/apidocs/").status_code == 200
+    spec = client.get("/apispec_1.json").get_json()
+    assert "/movies/top" in spec["paths"]
+
+
+def test_swagger_can_be_turned_off():
+    app = create_app(SWAGGER_ENABLED=False)
+    assert "lazy_swagger" not in app.extensions
+    assert app.test_client().get("/apidocs/").status_code == 404
+
+
+def test_openapi_spec_cache(tmp_path):
+    spec_file = tmp_path / "openapi.yaml"
+    spec_file.write_text("openapi: 3.0.0\ninfo:\n  title: First\n")
+    assert load_openapi_spec(spec_file)["info"]["title"] == "First"
+    assert (tmp_path / "__pycache__" / "openapi.json").exists()
+    assert load_openapi_spec(spec_file)["info"]["title"] == "First"
+
+    # Changing the YAML makes the cached copy out of date
+    spec_file.write_text("openapi: 3.0.0\ninfo:\n  title: Second version\n")
+    assert load_openapi_spec(spec_file)["info"]["title"] == "Second version"
+
+
+def test_startup_does_not_load_swagger():
+    result = measure_startup()
+    assert result["swagger_loaded"] is False
@@ -0,0 +1,77 @@
+import os
+import pytest
+from api import services
+from api.models import Movie
+from api.query_cache import QueryCache
+from api.shared_cache import SharedCache, fcntl
+
+pytestmark = pytest.mark.skipif(fcntl is None, reason="the shared cache needs fcntl")
+
+
+@pytest.fixture
+def shared(tmp_path):
+    cache = SharedCache(tmp_path / "movie_data.db.cache", slot_count=64, slot_size=4096)
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def shared_services(shared, monkeypatch):
+    monkeypatch.setattr(services, "shared_cache", shared)
+    monkeypatch.setattr(services, "query_cache", QueryCache(services.QUERY_CACHE_BYTES, generations=shared))
+    return shared
+
+
+def test_results_round_trip_with_their_rows(shared):
+    row = services.run_query("SELECT movie_id, title FROM movies ORDER BY movie_id LIMIT 1")[0]
+    assert shared.put(("q", ()), ((row,), 3), {"movies"}, shared.current())
+    tables, ((cached,), count) = shared.get(("q", ()))
+    assert tables == ("movies",) and count == 3
+    assert cached["title"] == row["title"] and cached[0] == row["movie_id"]
+    assert cached.keys() == ["movie_id", "title"]
+    assert shared.get(("other", ())) is None
+
+
+def test_writes_invalidate_through_the_generations(shared):
+    started = shared.current()
+    shared.put(("movies", ()), (1,), {"movies"}, started)
+    shared.put(("users", ()), (2,), {"users"}, started)
+    shared.invalidate({"movies"})
+    assert shared.get(("movies", ())) is None
+    assert shared.get(("users", ())) == (("users",), (2,))
+    # Read before the write committed, so it isn't stored
+    assert not shared.put(("movies", ()), (3,), {"movies"}, started)
+    # Writes that change the schema invalidate everything
+    shared.invalidate({"*"})
+    assert shared.get(("users", ())) is None
+    assert shared.stats()["stale"] == 2
+
+
+def test_results_too_big_for_a_slot_are_not_stored(shared):
+    assert not shared.put(("big", ()), ("x" * 5000,), {"movies"}, shared.current())
+    assert shared.stats()["not_stored"] == 1
+
+
+def test_workers_share_results_and_invalidations(shared_services):
+    movie_id = services.create_movie(Movie(None, "shared_movie", "shared_genre", release_year=2024, director="Shared Director"))
+    assert services.get_movie_by_id(movie_id).title == "shared_movie"
+
+    # A forked "worker" with its own (empty) query cache finds the result in the shared cache, then renames
+    #  the movie, which this process must see straight away
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            services.query_cache.reset()
+            shared_services.reset()
+            if services.get_movie_by_id(movie_id).title == "shared_movie" and shared_services.stats()["hits"] == 1:
+                movie = services.get_movie_by_id(movie_id)
+                movie.title = "renamed_movie"
+                services.update_movie(movie)
+                status = 0
+        finally:
+            os._exit(status)
+    assert os.waitpid(pid, 0)[1] == 0
+
+    assert services.get_movie_by_id(movie_id).title == "renamed_movie"
+    services.delete_movie(movie_id)
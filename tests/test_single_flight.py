@@ -0,0 +1,112 @@
+import threading
+import time
+import pytest
+from api import services
+from api.query_cache import QueryCache
+from api.single_flight import SingleFlight
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def run_together(flights, key, call, count):
+    results, errors = [], []
+
+    def caller():
+        try:
+            results.append(flights.do(key, call, "test"))
+        except RuntimeError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=caller) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def test_concurrent_calls_share_one_execution():
+    flights = SingleFlight()
+    release = threading.Event()
+    executions = []
+
+    def call():
+        executions.append(1)
+        release.wait(5)
+        return ("result",)
+
+    threads, results, errors = run_together(flights, "key", call, 8)
+    wait_for(lambda: flights.stats()["total"]["coalesced"] == 7)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(executions) == 1
+    assert results == [("result",)] * 8 and not errors
+    stats = flights.stats()
+    assert stats["in_flight"] == 0
+    assert stats["calls"]["test"]["executions"] == 1 and stats["total"]["max_waiters"] == 7
+
+    # Once it has finished, the next call runs again
+    assert flights.do("key", lambda: ("again",)) == ("again",)
+
+
+def test_waiters_get_the_error():
+    flights = SingleFlight()
+    release = threading.Event()
+
+    def call():
+        release.wait(5)
+        raise RuntimeError("failed")
+
+    threads, results, errors = run_together(flights, "key", call, 3)
+    wait_for(lambda: flights.stats()["total"]["coalesced"] == 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert not results and len(errors) == 3
+    assert flights.stats()["total"]["errors"] == 1
+
+
+def test_forget_starts_a_new_execution():
+    flights = SingleFlight()
+    release = threading.Event()
+    threads, results, errors = run_together(flights, "key", lambda: release.wait(5) and "before", 1)
+    wait_for(lambda: flights.stats()["in_flight"] == 1)
+    flights.forget()
+    # A call after forget() doesn't wait for the one that was already running
+    assert flights.do("key", lambda: "after") == "after"
+    release.set()
+    threads[0].join()
+    assert results == ["before"]
+
+
+@pytest.mark.parametrize("cache_bytes", [0, services.QUERY_CACHE_BYTES])
+def test_concurrent_rating_reads_query_once(monkeypatch, cache_bytes):
+    monkeypatch.setattr(services, "query_cache", QueryCache(cache_bytes))
+    monkeypatch.setattr(services, "single_flight", SingleFlight())
+    movie_id = services.get_all_movies()[0].movie_id
+    read_through = services._read_through
+    release = threading.Event()
+
+    def slow_read_through(*args):
+        release.wait(5)
+        return read_through(*args)
+
+    monkeypatch.setattr(services, "_read_through", slow_read_through)
+    ratings = []
+    threads = [
+        threading.Thread(target=lambda: ratings.append(services.get_movie_ratings(movie_id)))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: services.get_single_flight_stats()["total"].get("coalesced", 0) == 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(ratings) == 5
+    assert all([r.rating_id for r in result] == [r.rating_id for r in ratings[0]] for result in ratings)
+    assert services.get_single_flight_stats()["calls"]["get_movie_ratings"]["executions"] == 1
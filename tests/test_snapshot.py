@@ -0,0 +1,86 @@
+import fcntl
+import numpy as np
+import pytest
+from api import services, snapshot
+from api.analytics import AnalyticsEngine
+from api.models import Rating
+from api.snapshot import SnapshotReader, build_snapshot, read_current
+
+
+@pytest.fixture
+def new_rating():
+    rating_ids = []
+
+    def add_rating(score=4):
+        movie_id = services.get_all_movies()[0].movie_id
+        rating_ids.append(services.create_rating(Rating(user_id=1, movie_id=movie_id, rating=score,
+                                                        review="Snapshot review", date="2024-05-01")))
+        return rating_ids[-1]
+
+    yield add_rating
+    for rating_id in rating_ids:
+        services.delete_rating(rating_id)
+
+
+def test_snapshot_is_memory_mapped_and_matches(tmp_path):
+    folder = build_snapshot(tmp_path)
+    assert read_current(tmp_path) == folder.name
+    assert not list(tmp_path.glob(".*.tmp"))
+
+    reader = SnapshotReader(tmp_path)
+    columns = reader.load()
+    assert isinstance(columns.rating_id, np.memmap)
+    assert isinstance(columns.by_movie, np.memmap)
+
+    # Every query gives the same answer from the mapped files as from arrays loaded into this process
+    in_memory = AnalyticsEngine(refresh_interval=0)
+    from_snapshot = AnalyticsEngine(refresh_interval=0, snapshots=reader)
+    assert from_snapshot.movie_averages(limit=1000) == in_memory.movie_averages(limit=1000)
+    assert from_snapshot.genre_averages() == in_memory.genre_averages()
+    assert from_snapshot.year_averages() == in_memory.year_averages()
+    assert from_snapshot.distribution() == in_memory.distribution()
+    movie_id = int(columns.movie_id[0])
+    assert from_snapshot.co_ratings(movie_id) == in_memory.co_ratings(movie_id)
+    assert from_snapshot.stats()["snapshot_version"] == folder.name
+
+
+def test_new_versions_are_picked_up(tmp_path, new_rating, monkeypatch):
+    first = build_snapshot(tmp_path)
+    # Nothing has changed, so there is nothing new to build
+    assert build_snapshot(tmp_path) == first
+
+    reader = SnapshotReader(tmp_path)
+    ratings = len(reader.load())
+    monkeypatch.setattr(snapshot, "KEEP_VERSIONS", 2)
+    for _ in range(3):
+        new_rating()
+        latest = build_snapshot(tmp_path)
+    assert latest != first
+    assert len(reader.load()) == ratings + 3
+    assert reader.version == latest.name
+    # Only the newest versions are kept
+    assert len(list(tmp_path.glob("v*"))) == 2
+    assert not first.exists()
+
+
+def test_only_one_process_builds_at_a_time(tmp_path, new_rating):
+    build_snapshot(tmp_path)
+    new_rating()
+    with open(tmp_path / ".build.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        assert build_snapshot(tmp_path, wait=False) is None
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    assert build_snapshot(tmp_path, wait=False) is not None
+
+
+def test_engine_builds_the_first_snapshot(tmp_path, new_rating, monkeypatch):
+    engine = AnalyticsEngine(refresh_interval=0, snapshots=SnapshotReader(tmp_path))
+    assert engine.distribution()
+    assert read_current(tmp_path) is not None
+
+    # A snapshot older than the limit is rebuilt by the first worker that notices
+    monkeypatch.setattr("api.analytics.SNAPSHOT_MAX_AGE", 0)
+    version = engine.snapshots.version
+    new_rating(5)
+    engine.get_columns()
+    assert engine.snapshots.version != version
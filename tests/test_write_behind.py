@@ -0,0 +1,125 @@
+import queue
+import pytest
+from run import create_app
+from api import services
+from api.models import Rating, Movie
+from api.write_behind import RatingWriter, COMMITTED, FAILED
+import api.write_behind as write_behind
+
+
+@pytest.fixture
+def known_movie():
+    movie = Movie(None, "test_movie", "test_genre", release_year=2024, director="Test Director")
+    movie.movie_id = services.create_movie(movie)
+    yield movie
+    services.delete_movie(movie.movie_id)
+
+
+@pytest.fixture
+def writer():
+    rating_writer = RatingWriter(batch_interval=0.05)
+    yield rating_writer
+    rating_writer.stop()
+
+
+def make_rating(movie, score=4):
+    return Rating(user_id=1, movie_id=movie.movie_id, rating=score, review="Queued review", date="2024-01-01")
+
+
+def test_ratings_are_committed_in_batches(writer, known_movie):
+    # Queue everything before the writer starts so that it all lands in the same batch
+    tickets = [writer.submit(make_rating(known_movie, score)) for score in (3, 4, 5)]
+    writer.start()
+    for ticket in tickets:
+        assert ticket.wait(timeout=5)
+        assert ticket.status == COMMITTED
+        assert ticket.rating.rating_id is not None
+    assert writer.stats()["batches"] == 1
+    assert writer.stats()["committed"] == 3
+
+    ratings = services.get_movie_ratings(known_movie.movie_id)
+    assert sorted(rating.rating for rating in ratings) == [3, 4, 5]
+    # The leaderboard is kept up to date just like with create_rating
+    assert services.get_top_movies(genre=known_movie.genre)[0].rating_count == 3
+    for ticket in tickets:
+        services.delete_rating(ticket.rating.rating_id)
+
+
+def test_bad_rating_fails_alone(writer, known_movie, monkeypatch):
+    good = writer.submit(make_rating(known_movie))
+    bad = writer.submit(make_rating(known_movie))
+    real_insert_rating = services.insert_rating
+
+    def insert_rating(cursor, rating):
+        if rating is bad.rating:
+            cursor.execute("INSERT INTO no_such_table VALUES (1)")
+        return real_insert_rating(cursor, rating)
+
+    monkeypatch.setattr(services, "insert_rating", insert_rating)
+    writer.start()
+    assert good.wait(timeout=5) and bad.wait(timeout=5)
+    assert good.status == COMMITTED
+    assert bad.status == FAILED
+    assert services.get_rating_by_id(good.rating.rating_id) is not None
+    services.delete_rating(good.rating.rating_id)
+
+
+def test_unexpected_errors_dont_stop_the_writer(writer, known_movie, monkeypatch):
+    real_write_transaction = services.write_transaction
+    real_insert_rating = services.insert_rating
+
+    def broken_write_transaction():
+        raise RuntimeError("not a database error")
+
+    def broken_insert_rating(cursor, rating):
+        raise RuntimeError("not a database error either")
+
+    monkeypatch.setattr(services, "write_transaction", broken_write_transaction)
+    writer.start()
+    first = writer.submit(make_rating(known_movie))
+    assert first.wait(timeout=5) and first.status == FAILED
+
+    monkeypatch.setattr(services, "write_transaction", real_write_transaction)
+    monkeypatch.setattr(services, "insert_rating", broken_insert_rating)
+    second = writer.submit(make_rating(known_movie))
+    assert second.wait(timeout=5) and second.status == FAILED
+
+    # The writer is still running
+    monkeypatch.setattr(services, "insert_rating", real_insert_rating)
+    third = writer.submit(make_rating(known_movie))
+    assert third.wait(timeout=5) and third.status == COMMITTED
+    services.delete_rating(third.rating.rating_id)
+
+
+def test_full_queue_pushes_back(known_movie):
+    writer = RatingWriter(max_queue=1)
+    writer.submit(make_rating(known_movie))
+    with pytest.raises(queue.Full):
+        writer.submit(make_rating(known_movie))
+
+
+def test_write_behind_api(known_movie):
+    app = create_app()
+    app.config["TESTING"] = True
+    app.config["RATING_WRITE_BEHIND"] = True
+    client = app.test_client()
+    rating_data = {"user_id": 1, "movie_id": known_movie.movie_id, "rating": 5, "review": "Queued", "date": "2024-01-01"}
+
+    # Without waiting we get a tracking ID back straight away
+    response = client.post("/api/ratings", json=rating_data)
+    assert response.status_code == 202
+    tracking_id = response.get_json()["tracking_id"]
+    ticket = write_behind.get_writer().get_ticket(tracking_id)
+    assert ticket.wait(timeout=5)
+    response = client.get(f"/api/ratings/pending/{tracking_id}")
+    assert response.get_json()["status"] == COMMITTED
+
+    # Waiting gives the same answer as a normal write
+    response = client.post("/api/ratings?wait=true", json=rating_data)
+    assert response.status_code == 201
+    rating_id = response.get_json()["rating"]["rating_id"]
+    assert services.get_rating_by_id(rating_id) is not None
+
+    services.delete_rating(rating_id)
+    services.delete_rating(ticket.rating.rating_id)
+    assert client.get("/api/ratings/pending/unknown").status_code == 404
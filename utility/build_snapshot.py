@@ -0,0 +1,37 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+# Add the project root directory to sys.path so that we can use the api package from this script
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from api.snapshot import build_snapshot, read_manifest, SNAPSHOT_DIRECTORY
+
+# Build the shared analytics snapshot that the workers memory-map (see api/snapshot.py).
+# The workers rebuild it themselves once it is more than MOVIE_API_SNAPSHOT_MAX_AGE seconds out of date,
+#  but it can also be kept fresh from outside the web server by running this with --watch.
+#
+# Usage:
+#   python utility/build_snapshot.py               (build one now if anything has changed)
+#   python utility/build_snapshot.py --watch 10    (check every 10 seconds until stopped)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the memory-mapped analytics snapshot")
+    parser.add_argument("--directory", type=Path, default=SNAPSHOT_DIRECTORY, help="where the snapshots are kept")
+    parser.add_argument("--watch", type=float, metavar="SECONDS", help="keep building a new one this often")
+    args = parser.parse_args()
+
+    while True:
+        started = time.perf_counter()
+        folder = build_snapshot(args.directory)
+        manifest = read_manifest(folder)
+        print(f"{folder.name}: {manifest['ratings']} ratings up to change {manifest['change_seq']} "
+              f"({time.perf_counter() - started:.3f}s)")
+        if args.watch is None:
+            break
+        time.sleep(args.watch)
+
+
+if __name__ == '__main__':
+    main()
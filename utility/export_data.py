@@ -0,0 +1,74 @@
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+# Add the project root directory to sys.path so that we can use the api package from this script
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from api.export import ExportSnapshot, EXPORT_COLUMNS, EXPORT_FORMATS, FETCH_SIZE
+
+# Export the tables to files, the opposite of load_data.py.
+# Every table is read from the same snapshot of the database, so the files agree with each other even if
+#  the API is busy saving ratings at the time. The rows are streamed to the files a batch at a time, so
+#  memory use doesn't grow with the size of the tables.
+# The CSV files have the same columns as the ones in utility/data, so they can be copied there and loaded
+#  again with load_data.py.
+#
+# Usage:
+#   python utility/export_data.py                                  (every table as NDJSON into data/export)
+#   python utility/export_data.py --format csv --tables ratings --output-dir /tmp/export
+
+DEFAULT_OUTPUT_DIR = Path(__file__).parents[1] / 'data' / 'export'
+
+
+def export_data(output_dir: Path, export_format: str = "ndjson", tables=None, fetch_size: int = FETCH_SIZE) -> dict:
+    """
+    Export tables to files named after them, e.g. ratings.csv.
+    Returns:
+        dict: The snapshot's change sequence number and the rows, bytes and speed of each table's export.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    extension = EXPORT_FORMATS[export_format][1]
+    started = time.perf_counter()
+    with ExportSnapshot() as snapshot:
+        for table in tables or EXPORT_COLUMNS:
+            with open(output_dir / f"{table}.{extension}", "w", encoding="utf-8", newline="") as file:
+                for chunk in snapshot.export(table, export_format, fetch_size):
+                    file.write(chunk)
+        results = [stats.to_dict() for stats in snapshot.stats.values()]
+        change_seq = snapshot.change_seq
+    seconds = time.perf_counter() - started
+    rows = sum(result["rows"] for result in results)
+    return {
+        "change_seq": change_seq,
+        "tables": results,
+        "rows": rows,
+        "seconds": round(seconds, 4),
+        "rows_per_second": round(rows / seconds) if seconds > 0 else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the tables to NDJSON or CSV files")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="ndjson", help="the file format")
+    parser.add_argument("--tables", nargs="+", choices=list(EXPORT_COLUMNS), help="the tables to export (default all)")
+    parser.add_argument("--output-dir", type=Path, default=DEFAULT_OUTPUT_DIR, help="where to write the files")
+    parser.add_argument("--fetch-size", type=int, default=FETCH_SIZE, help="how many rows to read at a time")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    summary = export_data(args.output_dir, args.format, args.tables, args.fetch_size)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    for result in summary["tables"]:
+        print(f"{result['table']:<8} {result['rows']:>9} rows  {result['bytes'] / 1_000_000:8.2f} MB  "
+              f"{result['seconds']:7.3f} s  {result['rows_per_second'] or 0:>9} rows/s")
+    print(f"Exported {summary['rows']} rows to {args.output_dir} in {summary['seconds']:.3f} s "
+          f"({summary['rows_per_second'] or 0} rows/s), up to change {summary['change_seq']}")
+
+
+if __name__ == '__main__':
+    main()
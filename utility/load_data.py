@@ -1,6 +1,11 @@
 import pandas as pd
 from pathlib import Path
 import sqlite3
+import sys
+
+# Add the project root directory to sys.path so that we can use the api package from this script
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from api import services
     
 # Set the path of where to find the data files
 RAW_DATA_PATH = Path(__file__).parent / 'data'
@@ -14,6 +19,8 @@ def load_data():
     movie_data = pd.read_csv(RAW_DATA_PATH / 'movies.csv', index_col=0)
     rating_data = pd.read_csv(RAW_DATA_PATH / 'ratings.csv', index_col=0)
     user_data = pd.read_csv(RAW_DATA_PATH / 'users.csv', index_col=0)
+    # ratings.csv has US style dates (1/31/2023), the API stores them as YYYY-MM-DD so they sort and compare as dates
+    rating_data['date'] = rating_data['date'].map(services.normalize_date)
     
     # Create the tables in the SQLite database
     create_tables()
@@ -21,9 +28,14 @@ def load_data():
     # Create a SQLite database
     conn = sqlite3.connect(DATABASE_PATH / 'movie_data.db')
     # Write the dataframes to the database
+    # Ratings go last, because they refer to the movies and users
     movie_data.to_sql('movies', conn, if_exists='append', index=False)
-    rating_data.to_sql('ratings', conn, if_exists='append', index=False)
     user_data.to_sql('users', conn, if_exists='append', index=False)
+    rating_data.to_sql('ratings', conn, if_exists='append', index=False)
+
+    # The derived tables (leaderboards etc.) are built from the data we just loaded
+    services.rebuild_derived_tables(conn)
+    conn.close()
     print('Data loaded into SQLite database')
 
 def create_tables():
@@ -43,16 +55,8 @@ def create_tables():
                 ''')
     
     cursor.execute('''DROP TABLE IF EXISTS ratings''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS ratings (
-            rating_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            movie_id INTEGER,
-            rating INTEGER,
-            review TEXT,
-            date DATE
-        )
-    ''')
+    # The ratings table refers to the movies and users tables (see "Referential integrity" in api/services.py)
+    cursor.execute(services.RATINGS_TABLE_DDL.format(table='ratings'))
     
     cursor.execute('''DROP TABLE IF EXISTS users''')
     cursor.execute('''
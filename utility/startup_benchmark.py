@@ -0,0 +1,94 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+# Measure how long a new worker process takes to get the app ready, so we know how quickly we can add workers.
+# Each run starts a fresh Python process (as a new worker would), imports run.py, calls create_app() and
+#  reports the wall time and how many modules were imported along the way.
+#
+# Usage:
+#   python utility/startup_benchmark.py --runs 10
+#   python utility/startup_benchmark.py --max-seconds 0.5 --max-modules 300   (exits with 1 if over budget)
+
+PROJECT_ROOT = Path(__file__).parents[1]
+
+# The code each fresh process runs, it prints its measurements as JSON
+MEASURE_STARTUP = """
+import json, sys, time
+modules_before = len(sys.modules)
+started = time.perf_counter()
+import run
+imported = time.perf_counter()
+app = run.create_app()
+finished = time.perf_counter()
+print(json.dumps({
+    "import_seconds": imported - started,
+    "create_app_seconds": finished - imported,
+    "total_seconds": finished - started,
+    "modules": len(sys.modules) - modules_before,
+    "swagger_loaded": "flasgger" in sys.modules,
+}))
+"""
+
+
+def measure_startup() -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE_STARTUP],
+        cwd=PROJECT_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run_benchmark(runs: int) -> dict:
+    """
+    Start the app in a fresh process the given number of times.
+    Returns:
+        dict: The median of each measurement over the runs.
+    """
+    results = [measure_startup() for _ in range(runs)]
+    summary = {
+        name: statistics.median(result[name] for result in results)
+        for name in ("import_seconds", "create_app_seconds", "total_seconds", "modules")
+    }
+    summary["runs"] = runs
+    summary["swagger_loaded"] = any(result["swagger_loaded"] for result in results)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long the app takes to start in a new process")
+    parser.add_argument("--runs", type=int, default=5, help="how many fresh processes to time")
+    parser.add_argument("--max-seconds", type=float, help="fail if the median start up takes longer than this")
+    parser.add_argument("--max-modules", type=int, help="fail if more modules than this are imported")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    summary = run_benchmark(args.runs)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(f"Median of {summary['runs']} runs:")
+        print(f"  import run.py : {summary['import_seconds'] * 1000:.1f} ms")
+        print(f"  create_app()  : {summary['create_app_seconds'] * 1000:.1f} ms")
+        print(f"  total         : {summary['total_seconds'] * 1000:.1f} ms")
+        print(f"  modules       : {summary['modules']}")
+        print(f"  Swagger loaded at start up: {summary['swagger_loaded']}")
+
+    over_budget = []
+    if args.max_seconds is not None and summary["total_seconds"] > args.max_seconds:
+        over_budget.append(f"start up took {summary['total_seconds']:.3f}s, the budget is {args.max_seconds}s")
+    if args.max_modules is not None and summary["modules"] > args.max_modules:
+        over_budget.append(f"{summary['modules']} modules were imported, the budget is {args.max_modules}")
+    for message in over_budget:
+        print(f"Over budget: {message}", file=sys.stderr)
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+    main()